@@ -33,6 +33,7 @@ def run_cmd(pipeline_configs, debug):
         raise e
     finally:
         future.cancel()
+        loop.run_until_complete(agent.state_manager.close())
         if session:
             loop.run_until_complete(session.close())
         loop.stop()
@@ -0,0 +1,187 @@
+import asyncio
+from collections import deque
+from time import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class AdmissionRejected(Exception):
+    """Message is not admitted for processing, the client should retry later."""
+
+
+class Turn:
+    """One or several messages of a user, which are processed as a single dialog turn."""
+    __slots__ = ('utterances', 'admitted', 'result')
+
+    def __init__(self, utterance: Any) -> None:
+        loop = asyncio.get_event_loop()
+        self.utterances = [utterance]
+        self.admitted = loop.create_future()
+        self.result = loop.create_future()
+
+    @property
+    def utterance(self) -> Any:
+        if len(self.utterances) == 1:
+            return self.utterances[0]
+        return ' '.join(str(i) for i in self.utterances)
+
+
+class _UserQueue:
+    __slots__ = ('active', 'turns')
+
+    def __init__(self) -> None:
+        self.active = False
+        self.turns = deque()
+
+
+class UserAdmission:
+    """Admits messages of each user one turn at a time.
+
+    A message of a user, whose previous turn is still being processed, is handled by the policy:
+
+    * ``serialize`` - the message is queued and processed after the current turn;
+    * ``coalesce`` - queued messages are merged into a single turn, their utterances are joined with
+      spaces and all of them get the response of this turn;
+    * ``reject`` - ``AdmissionRejected`` is raised.
+
+    No more than ``max_queued`` messages of a user are waiting, next ones are rejected. A turn is released
+    on flush of its workflow record, so if processing of the record fails and the record has no deadline,
+    the user stays active, and all next messages are queued and then rejected.
+    """
+    policies = ('serialize', 'coalesce', 'reject')
+
+    def __init__(self, policy: str = 'serialize', max_queued: int = 10) -> None:
+        if policy not in self.policies:
+            raise ValueError(f'unknown concurrent messages policy {policy!r}, expected one of {self.policies}')
+        self.policy = policy
+        self.max_queued = max_queued
+        self.rejected = 0
+        self.coalesced = 0
+        self._users: Dict[Hashable, _UserQueue] = {}
+
+    def _queued_count(self, queue: _UserQueue) -> int:
+        return sum(len(turn.utterances) for turn in queue.turns)
+
+    def enqueue(self, user_id: Hashable, utterance: Any) -> Tuple[Turn, bool]:
+        """Returns the turn of the message and whether the message leads the turn, i.e. should be registered.
+
+        A leading message should wait for ``turn.admitted``, other messages of the turn should wait for
+        ``turn.result``.
+        """
+        queue = self._users.setdefault(user_id, _UserQueue())
+        if queue.active:
+            if self.policy == 'reject' or self._queued_count(queue) >= self.max_queued:
+                self.rejected += 1
+                raise AdmissionRejected(f'previous message of user {user_id} is still being processed')
+            if self.policy == 'coalesce' and queue.turns:
+                queue.turns[-1].utterances.append(utterance)
+                self.coalesced += 1
+                return queue.turns[-1], False
+        turn = Turn(utterance)
+        queue.turns.append(turn)
+        self._admit_next(user_id, queue)
+        return turn, True
+
+    def _admit_next(self, user_id: Hashable, queue: _UserQueue) -> None:
+        while not queue.active and queue.turns:
+            turn = queue.turns.popleft()
+            if turn.admitted.done():
+                # the message was cancelled while it was waiting
+                continue
+            queue.active = True
+            turn.admitted.set_result(None)
+        if not queue.active:
+            del self._users[user_id]
+
+    def release(self, user_id: Hashable) -> None:
+        """Finishes the current turn of the user and admits the next one."""
+        queue = self._users.get(user_id)
+        if queue is not None and queue.active:
+            queue.active = False
+            self._admit_next(user_id, queue)
+
+    def get_stats(self) -> Dict:
+        return {
+            'policy': self.policy,
+            'active_users': sum(queue.active for queue in self._users.values()),
+            'queued': sum(self._queued_count(queue) for queue in self._users.values()),
+            'rejected': self.rejected,
+            'coalesced': self.coalesced
+        }
+
+
+class AdmissionController:
+    """Limits the number of workflows, which are processed by the agent concurrently.
+
+    No more than ``max_concurrent`` workflows are processed at a time, next messages wait in a queue of
+    ``max_queued`` messages. A message is shed, i.e. it is answered with ``overload_response`` without
+    running the pipeline, if the queue is full or if it would miss its deadline. The completion time of
+    a queued message is estimated with ``get_response_time``, the mean response time of the agent: every
+    ``max_concurrent`` workflows ahead of the message take one response time.
+    """
+    def __init__(self, max_concurrent: int, max_queued: int = 100, overload_response: str = '',
+                 get_response_time: Optional[Callable[[], float]] = None) -> None:
+        if max_concurrent < 1:
+            raise ValueError(f'max_concurrent should be positive, got {max_concurrent}')
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.overload_response = overload_response
+        self.get_response_time = get_response_time
+        self.active = 0
+        self.shed = 0
+        self.shed_by_deadline = 0
+        self._waiters = deque()
+
+    def _misses_deadline(self, deadline_timestamp: Optional[float], position: int) -> bool:
+        if not deadline_timestamp or self.get_response_time is None:
+            return False
+        rounds = (self.active + position) // self.max_concurrent + 1
+        return time() + rounds * self.get_response_time() > deadline_timestamp
+
+    def _shed(self, by_deadline: bool = False) -> bool:
+        self.shed += 1
+        self.shed_by_deadline += by_deadline
+        return False
+
+    async def acquire(self, deadline_timestamp: Optional[float] = None) -> bool:
+        """Waits for a free workflow slot, returns False if the message is shed instead."""
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.max_queued:
+            return self._shed()
+        if self._misses_deadline(deadline_timestamp, len(self._waiters)):
+            return self._shed(by_deadline=True)
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was passed to the message just before it was cancelled
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        if deadline_timestamp and time() >= deadline_timestamp:
+            self.release()
+            return self._shed(by_deadline=True)
+        return True
+
+    def release(self) -> None:
+        """Frees the slot of a finished workflow, the slot is passed to the first waiting message."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def get_stats(self) -> Dict:
+        return {
+            'max_concurrent': self.max_concurrent,
+            'active': self.active,
+            'queued': len(self._waiters),
+            'shed': self.shed,
+            'shed_by_deadline': self.shed_by_deadline
+        }
@@ -1,11 +1,13 @@
 import asyncio
 from time import time
-from typing import Any
+from typing import Any, Optional
 
+from .admission import AdmissionController, UserAdmission
 from .log import BaseResponseLogger
 from .pipeline import Pipeline
 from .state_manager import StateManager
-from .workflow_manager import WorkflowManager
+from .state_schema import Bot, Dialog, Human
+from .workflow_manager import WorkflowManager, WorkflowRecord
 
 
 class Agent:
@@ -15,21 +17,77 @@ class Agent:
                  pipeline: Pipeline,
                  state_manager: StateManager,
                  workflow_manager: WorkflowManager,
-                 response_logger: BaseResponseLogger) -> None:
+                 response_logger: BaseResponseLogger,
+                 user_admission: Optional[UserAdmission] = None,
+                 admission_controller: Optional[AdmissionController] = None) -> None:
         self.pipeline = pipeline
         self.state_manager = state_manager
         self.workflow_manager = workflow_manager
         self._response_logger = response_logger
+        self.user_admission = user_admission
+        self.admission_controller = admission_controller
 
     def flush_record(self, dialog_id: str):
         workflow_record = self.workflow_manager.flush_record(dialog_id)
-        if 'timeout_response_task' in workflow_record:
-            workflow_record['timeout_response_task'].cancel()
+        if workflow_record.timeout_response_task:
+            workflow_record.timeout_response_task.cancel()
+        self._release_workflow(workflow_record.get('user_external_id'))
         return workflow_record
 
+    def _release_workflow(self, user_id):
+        if self.admission_controller is not None:
+            self.admission_controller.release()
+        self._release_user(user_id)
+
+    def _release_user(self, user_id):
+        if self.user_admission is not None and user_id is not None:
+            self.user_admission.release(user_id)
+
     async def register_msg(self, utterance, deadline_timestamp=None,
                            require_response=False, **kwargs):
-        dialog = await self.state_manager.get_or_create_dialog(**kwargs)
+        user_id = kwargs.get('user_external_id')
+        if self.user_admission is None or user_id is None:
+            return await self._register_msg(utterance, deadline_timestamp, require_response, **kwargs)
+
+        # a message of a user with a turn in progress is queued, merged or rejected, so
+        # there is a single workflow record of the user's dialog at a time
+        turn, leads_turn = self.user_admission.enqueue(user_id, utterance)
+        if not leads_turn:
+            return await asyncio.shield(turn.result)
+        try:
+            await turn.admitted
+            result = await self._register_msg(turn.utterance, deadline_timestamp, require_response, **kwargs)
+        except asyncio.CancelledError:
+            turn.result.cancel()
+            raise
+        except Exception as e:
+            turn.result.set_exception(e)
+            # the exception is retrieved, so it isn't reported if the turn has no merged messages
+            turn.result.exception()
+            raise
+        turn.result.set_result(result)
+        return result
+
+    async def _register_msg(self, utterance, deadline_timestamp=None, require_response=False, **kwargs):
+        user_id = kwargs.get('user_external_id')
+        if self.admission_controller is not None:
+            try:
+                admitted = await self.admission_controller.acquire(deadline_timestamp)
+            except BaseException:
+                self._release_user(user_id)
+                raise
+            if not admitted:
+                try:
+                    return await self._shed_msg(utterance, deadline_timestamp, require_response, **kwargs)
+                finally:
+                    self._release_user(user_id)
+
+        try:
+            dialog = await self.state_manager.get_or_create_dialog(**kwargs)
+        except BaseException:
+            # the user and the workflow slot are released on flush of the workflow record, which won't be added
+            self._release_workflow(user_id)
+            raise
         dialog_id = str(dialog.id)
         service = self.pipeline.get_service_by_name('input')
         message_attrs = kwargs.pop('message_attrs', {})
@@ -39,9 +97,11 @@ class Agent:
             kwargs['event'] = event
             kwargs['hold_flush'] = True
 
+        schedule = self.pipeline.new_schedule()
         self.workflow_manager.add_workflow_record(
-            dialog=dialog, deadline_timestamp=deadline_timestamp, **kwargs)
+            dialog=dialog, deadline_timestamp=deadline_timestamp, schedule=schedule, **kwargs)
         task_id = self.workflow_manager.add_task(dialog_id, service, utterance, 0)
+        self.pipeline.mark_launched(schedule, service)
         self._response_logger.log_start(task_id, {'dialog': dialog}, service)
         asyncio.create_task(self.process(task_id, utterance, message_attrs=message_attrs))
         if deadline_timestamp:
@@ -53,18 +113,41 @@ class Agent:
             await event.wait()
             return self.flush_record(dialog_id)
 
+    async def _shed_msg(self, utterance, deadline_timestamp=None, require_response=False, **kwargs):
+        """Answers the message with the overload response, the message isn't processed by the pipeline.
+
+        The dialog isn't loaded, and the shed turn isn't saved, so that the overload doesn't add load on the db.
+        """
+        if not require_response:
+            return
+        human = Human(external_id=kwargs.get('user_external_id'))
+        dialog = Dialog(human=human, channel_type=kwargs.get('channel_type'))
+        dialog.bot = Bot()
+        message_attrs = kwargs.pop('message_attrs', {})
+        await self.state_manager.add_human_utterance(dialog, utterance, 'input', message_attrs=message_attrs)
+        await self.state_manager.add_bot_utterance_last_chance(
+            dialog, {'text': self.admission_controller.overload_response, 'annotations': {}}, 'overload')
+        return WorkflowRecord(dialog=dialog, deadline_timestamp=deadline_timestamp, **kwargs)
+
+    def skip_service(self, workflow_record, service):
+        self.workflow_manager.skip_service(workflow_record['dialog'].id, service)
+        self.pipeline.mark_finished(workflow_record['schedule'], service, skipped=True)
+
     async def process(self, task_id, response: Any = None, **kwargs):
         workflow_record, task_data = self.workflow_manager.complete_task(task_id, response, **kwargs)
         if not workflow_record:
             return
-        service = task_data['service']
+        service = task_data.service
 
         self._response_logger.log_end(task_id, workflow_record, service)
+        if task_data.workflow_record is workflow_record:
+            # late response, the workflow record is already flushed
+            return
 
         if isinstance(response, Exception):
             # Skip all services, which are depends on failured one
             for i in service.dependent_services:
-                self.workflow_manager.skip_service(workflow_record['dialog'].id, i)
+                self.skip_service(workflow_record, i)
         else:
             response_data = service.apply_response_formatter(response)
             # Updating workflow with service response
@@ -72,7 +155,7 @@ class Agent:
                 await service.state_processor_method(
                     dialog=workflow_record['dialog'], payload=response_data,
                     label=service.label,
-                    message_attrs=kwargs.pop('message_attrs', {}), ind=task_data['ind']
+                    message_attrs=kwargs.pop('message_attrs', {}), ind=task_data.ind
                 )
 
             # Processing the case, when service is a skill selector
@@ -80,7 +163,7 @@ class Agent:
                 skipped_services = {s for s in service.next_services if s.label not in set(response_data)}
 
                 for s in skipped_services:
-                    self.workflow_manager.skip_service(workflow_record['dialog'].id, s)
+                    self.skip_service(workflow_record, s)
 
             # Flush record  and return zero next services if service is is_responder
             elif service.is_responder():
@@ -88,14 +171,17 @@ class Agent:
                     self.flush_record(workflow_record['dialog'].id)
                 return
 
-        # Calculating next steps
-        done, waiting, skipped = self.workflow_manager.get_services_status(workflow_record['dialog'].id)
-        next_services = self.pipeline.get_next_services(done, waiting, skipped)
+        # Calculating next steps, failed service is treated as skipped one, if its last task has failed
+        schedule = workflow_record['schedule']
+        if not self.workflow_manager.has_pending_tasks(workflow_record['dialog'].id, service):
+            self.pipeline.mark_finished(schedule, service, skipped=isinstance(response, Exception))
+        next_services = self.pipeline.get_ready_services(schedule)
 
         await self.create_processing_tasks(workflow_record, next_services)
 
     async def create_processing_tasks(self, workflow_record, next_services):
         for service in next_services:
+            self.pipeline.mark_launched(workflow_record['schedule'], service)
             tasks = service.apply_dialog_formatter(workflow_record)
             for ind, task_data in enumerate(tasks):
                 task_id = self.workflow_manager.add_task(workflow_record['dialog'].id, service, task_data, ind)
@@ -109,6 +195,25 @@ class Agent:
                         )
                     )
                 )
+                if service.timeout:
+                    self.workflow_manager.set_task_timer(
+                        workflow_record['dialog'].id,
+                        task_id,
+                        asyncio.get_event_loop().call_later(service.timeout, self.expire_task, task_id)
+                    )
+
+    def expire_task(self, task_id):
+        task = self.workflow_manager.get_task(task_id)
+        if task is None:
+            return
+        # the task is completed with the error before it's cancelled, so the error isn't replaced by
+        # a cancellation error from the connector
+        asyncio.ensure_future(
+            self.process(task_id, asyncio.TimeoutError(f'{task.service.name} has not responded '
+                                                       f'in {task.service.timeout} s'))
+        )
+        if task.task_object:
+            task.task_object.cancel()
 
     async def timeout_process(self, dialog_id, deadline_timestamp):
         await asyncio.sleep(deadline_timestamp - time())
@@ -116,8 +221,9 @@ class Agent:
         if not workflow_record:
             return
         next_services = [self.pipeline.timeout_service]
-        for k, v in self.workflow_manager.get_pending_tasks(dialog_id).items():
-            v['task_object'].cancel()
-            self._response_logger.log_end(k, workflow_record, v['task_data']['service'], True)
+        for task_id, task in self.workflow_manager.get_pending_tasks(dialog_id).items():
+            if task.task_object:
+                task.task_object.cancel()
+            self._response_logger.log_end(task_id, workflow_record, task.service, True)
 
         await self.create_processing_tasks(workflow_record, next_services)
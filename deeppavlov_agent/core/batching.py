@@ -0,0 +1,120 @@
+import asyncio
+from collections import Counter
+from typing import Dict, List, Optional
+
+
+async def collect_batch(queue: asyncio.Queue, batch_size: int, max_wait: float = 0) -> List:
+    """Waits for the first item of the queue, then collects up to ``batch_size`` items.
+
+    Items, which are already in the queue, are taken at once. If the batch is still not full,
+    the batch is waiting for new items no longer than ``max_wait`` seconds after the first item.
+    """
+    batch = [await queue.get()]
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + max_wait
+    while len(batch) < batch_size:
+        if not queue.empty():
+            batch.append(queue.get_nowait())
+            continue
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.wait({getter}, timeout=timeout)
+        if not getter.cancel():
+            batch.append(getter.result())
+    return batch
+
+
+class BatchStats:
+    """Collects sizes of batches, which were sent to a service, and states of adaptive batch size controllers."""
+    def __init__(self, name: str = '') -> None:
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.max_size = 0
+        self.sizes = Counter()
+        self.in_flight = 0
+        self.errors = 0
+        self.controllers = []
+
+    def add(self, size: int) -> None:
+        self.batches += 1
+        self.items += size
+        self.max_size = max(self.max_size, size)
+        self.sizes[size] += 1
+
+    def get_stats(self) -> Dict:
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'mean_size': self.items / self.batches if self.batches else 0,
+            'max_size': self.max_size,
+            'sizes': {str(k): v for k, v in sorted(self.sizes.items())},
+            'in_flight': self.in_flight,
+            'errors': self.errors,
+            'adaptive': [i.get_stats() for i in self.controllers]
+        }
+
+
+class AdaptiveBatchSize:
+    """Adjusts batch size to keep p95 latency of batches under the target, maximizing throughput.
+
+    Latencies of the batches are collected in rounds of ``window`` batches. After each round the batch
+    size is halved if p95 latency exceeds the target, and is increased by one if p95 latency is under
+    the target and most batches were full, i.e. a larger batch would be used. The size is kept within
+    ``[min_size, max_size]``.
+    """
+    def __init__(self, min_size: int, max_size: int, target_p95: float, window: int = 20) -> None:
+        if not 1 <= min_size <= max_size:
+            raise ValueError(f'batch size bounds should satisfy 1 <= min_size <= max_size, '
+                             f'got {min_size} and {max_size}')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_p95 = target_p95
+        self.window = window
+        self.size = min_size
+        self.last_p95 = None
+        self.latency_by_size = {}
+        self._latencies = []
+        self._full_batches = 0
+
+    def record(self, batch_size: int, latency: float) -> None:
+        """Registers latency of the batch in seconds and adjusts the batch size after each round."""
+        previous = self.latency_by_size.get(batch_size)
+        self.latency_by_size[batch_size] = latency if previous is None else 0.8 * previous + 0.2 * latency
+        self._latencies.append(latency)
+        if batch_size >= self.size:
+            self._full_batches += 1
+        if len(self._latencies) < self.window:
+            return
+
+        latencies = sorted(self._latencies)
+        self.last_p95 = latencies[max(0, -(-len(latencies) * 95 // 100) - 1)]
+        if self.last_p95 > self.target_p95:
+            self.size = max(self.min_size, self.size // 2)
+        elif self._full_batches * 2 > len(self._latencies):
+            self.size = min(self.max_size, self.size + 1)
+        self._latencies = []
+        self._full_batches = 0
+
+    def get_stats(self) -> Dict:
+        return {
+            'batch_size': self.size,
+            'p95_ms': None if self.last_p95 is None else self.last_p95 * 1000,
+            'latency_ms_by_size': {str(k): v * 1000 for k, v in sorted(self.latency_by_size.items())}
+        }
+
+
+def make_batch_controller(config: Dict) -> Optional[AdaptiveBatchSize]:
+    """Creates a controller from ``target_p95_ms``, ``min_batch_size`` and ``batch_size`` config keys.
+
+    Returns None, if ``target_p95_ms`` is not set, i.e. the static ``batch_size`` is used.
+    """
+    target_p95_ms = config.get('target_p95_ms')
+    if target_p95_ms is None:
+        return None
+    if not isinstance(target_p95_ms, (int, float)) or target_p95_ms <= 0:
+        raise ValueError(f'target_p95_ms should be a positive number, got {target_p95_ms!r}')
+    return AdaptiveBatchSize(min_size=config.get('min_batch_size', 1), max_size=config.get('batch_size', 1),
+                             target_p95=target_p95_ms / 1000, window=config.get('adaptive_window', 20))
@@ -0,0 +1,108 @@
+import json
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+class Codec:
+    """Serializes payloads of agent to service messages."""
+    name: str
+    content_type: str
+
+    def encode(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+    @property
+    def accept(self) -> str:
+        """Value of the Accept header: the codec's content type is preferred, JSON is always accepted."""
+        if self.content_type == JSON_CONTENT_TYPE:
+            return JSON_CONTENT_TYPE
+        return f'{self.content_type}, {JSON_CONTENT_TYPE};q=0.9'
+
+
+class JSONCodec(Codec):
+    name = 'json'
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class OrJSONCodec(Codec):
+    name = 'orjson'
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def decode(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    content_type = MSGPACK_CONTENT_TYPES[0]
+
+    def encode(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+_codecs = {
+    'json': (JSONCodec, json),
+    'orjson': (OrJSONCodec, orjson),
+    'msgpack': (MsgpackCodec, msgpack)
+}
+_instances = {}
+
+
+def get_codec(name: Optional[str] = None) -> Codec:
+    """Returns codec by name, ``None`` means the default JSON codec."""
+    name = name or 'json'
+    if name not in _codecs:
+        raise ValueError(f'unknown codec {name!r}, expected one of {sorted(_codecs)}')
+    codec_class, module = _codecs[name]
+    if module is None:
+        raise ValueError(f'{name} codec requires {name} package to be installed')
+    if name not in _instances:
+        _instances[name] = codec_class()
+    return _instances[name]
+
+
+def get_json_codec() -> Codec:
+    """Returns the fastest installed JSON codec."""
+    return get_codec('orjson' if orjson is not None else 'json')
+
+
+def decode(data: bytes, content_type: Optional[str] = None) -> Any:
+    """Decodes a message body by its content type. Messages without content type are treated as JSON."""
+    if content_type and content_type.split(';')[0].strip() in MSGPACK_CONTENT_TYPES:
+        return get_codec('msgpack').decode(data)
+    return get_json_codec().decode(data)
+
+
+async def post(session, url: str, obj: Any, codec: Codec) -> Any:
+    """Posts the object encoded with the codec and decodes the response by its content type."""
+    headers = {'Content-Type': codec.content_type, 'Accept': codec.accept}
+    async with session.post(url, data=codec.encode(obj), headers=headers) as resp:
+        resp.raise_for_status()
+        return decode(await resp.read(), resp.content_type)
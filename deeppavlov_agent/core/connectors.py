@@ -1,22 +1,44 @@
 import asyncio
 from typing import Any, Callable, Dict, List
-from collections import defaultdict
+from collections import defaultdict, deque
+from logging import getLogger
+from time import time
 
 import aiohttp
 
+from . import codecs
+from .batching import BatchStats, collect_batch
 from .transport.base import ServiceGatewayConnectorBase
 
+logger = getLogger(__name__)
+
 
 class HTTPConnector:
-    def __init__(self, session: aiohttp.ClientSession, url: str):
+    """Sends each task to the service url.
+
+    If ``hedge_urls`` are given, a duplicate request is sent to the next hedge url when the response
+    takes longer than p95 of recent latencies (``hedge_delay_ms`` until enough latencies are collected),
+    and the first successful response is used.
+    """
+    min_latency_samples = 20
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, hedge_urls: List[str] = None,
+                 hedge_delay_ms: float = 100, codec: codecs.Codec = None):
         self.session = session
         self.url = url
+        self.codec = codec or codecs.get_codec()
+        self.hedge_urls = list(hedge_urls or [])
+        self.hedge_delay = hedge_delay_ms / 1000
+        self.hedged_requests = 0
+        self._latencies = deque(maxlen=200)
+        self._next_hedge_ind = 0
 
     async def send(self, payload: Dict, callback: Callable):
         try:
-            async with self.session.post(self.url, json=payload['payload']) as resp:
-                resp.raise_for_status()
-                response = await resp.json()
+            if self.hedge_urls:
+                response = await self.hedged_post(payload['payload'])
+            else:
+                response = await self.post(self.url, payload['payload'])
             await callback(
                 task_id=payload['task_id'],
                 response=response[0]
@@ -28,6 +50,39 @@ class HTTPConnector:
                 response=response
             )
 
+    async def post(self, url: str, data: Dict):
+        start_time = time()
+        response = await codecs.post(self.session, url, data, self.codec)
+        self._latencies.append(time() - start_time)
+        return response
+
+    def get_hedge_delay(self) -> float:
+        if len(self._latencies) < self.min_latency_samples:
+            return self.hedge_delay
+        latencies = sorted(self._latencies)
+        return latencies[len(latencies) * 95 // 100]
+
+    async def hedged_post(self, data: Dict):
+        requests = {asyncio.ensure_future(self.post(self.url, data))}
+        try:
+            done, _ = await asyncio.wait(requests, timeout=self.get_hedge_delay())
+            if not done:
+                hedge_url = self.hedge_urls[self._next_hedge_ind % len(self.hedge_urls)]
+                self._next_hedge_ind += 1
+                self.hedged_requests += 1
+                requests.add(asyncio.ensure_future(self.post(hedge_url, data)))
+            error = None
+            while requests:
+                done, requests = await asyncio.wait(requests, return_when=asyncio.FIRST_COMPLETED)
+                for request in done:
+                    if request.exception() is None:
+                        return request.result()
+                    error = request.exception()
+            raise error
+        finally:
+            for request in requests:
+                request.cancel()
+
 
 class AioQueueConnector:
     def __init__(self, queue):
@@ -38,31 +93,108 @@ class AioQueueConnector:
 
 
 class QueueListenerBatchifyer:
-    def __init__(self, session, url, queue, batch_size):
+    def __init__(self, session, url, queue, batch_size, *, max_wait_ms=0, batch_stats=None, batch_controller=None,
+                 max_in_flight=1, router=None, retries=0, retry_backoff_ms=100, codec=None):
         self.session = session
         self.url = url
+        self.codec = codec or codecs.get_codec()
+        self.router = router
         self.queue = queue
         self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_stats = batch_stats or BatchStats()
+        self.batch_controller = batch_controller
+        if batch_controller:
+            self.batch_stats.controllers.append(batch_controller)
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.retry_backoff = retry_backoff_ms / 1000
+        self._last_fanout = None
 
     async def call_service(self, process_callable):
-        while True:
-            batch = []
-            rest = self.queue.qsize()
-            for _ in range(min(self.batch_size, rest)):
-                item = await self.queue.get()
-                batch.append(item)
-            if batch:
-                model_payload = self.glue_tasks(batch)
-                async with self.session.post(self.url, json=model_payload) as resp:
-                    response = await resp.json()
-                for task, task_response in zip(batch, response):
-                    asyncio.create_task(
-                        process_callable(
-                            task_id=task['task_id'],
-                            response=task_response
-                        )
+        # batches are taken from the queue only when there is a free slot, so idle workers of
+        # the same connector can take them
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        sending = set()
+        try:
+            while True:
+                await in_flight.acquire()
+                batch_size = self.batch_controller.size if self.batch_controller else self.batch_size
+                try:
+                    batch = await collect_batch(self.queue, batch_size, self.max_wait)
+                except BaseException:
+                    in_flight.release()
+                    raise
+                self.batch_stats.add(len(batch))
+                previous_fanout, self._last_fanout = self._last_fanout, asyncio.get_event_loop().create_future()
+                send_task = asyncio.ensure_future(
+                    self.send_batch(batch, process_callable, in_flight, previous_fanout, self._last_fanout)
+                )
+                sending.add(send_task)
+                send_task.add_done_callback(sending.discard)
+        finally:
+            # batches in flight are stopped together with the worker
+            for send_task in sending:
+                send_task.cancel()
+            await asyncio.gather(*sending, return_exceptions=True)
+
+    async def send_batch(self, batch, process_callable, in_flight, previous_fanout, fanout):
+        """Sends the batch and passes responses to the agent. If the batch has failed after all retries,
+        the exception is passed as a response of each task of the batch, so the worker keeps running.
+        """
+        try:
+            self.batch_stats.in_flight += 1
+            try:
+                responses = await self.post_batch(batch)
+            except Exception as e:
+                logger.warning(f'batch of {len(batch)} tasks to {self.url} has failed: {e!r}')
+                self.batch_stats.errors += 1
+                responses = [e] * len(batch)
+            finally:
+                self.batch_stats.in_flight -= 1
+                in_flight.release()
+            # responses are passed to the agent in the order, in which batches were sent
+            if previous_fanout is not None:
+                await previous_fanout
+            for task, task_response in zip(batch, responses):
+                asyncio.create_task(
+                    process_callable(
+                        task_id=task['task_id'],
+                        response=task_response
                     )
-            await asyncio.sleep(0.1)
+                )
+        finally:
+            fanout.set_result(None)
+
+    async def post_batch(self, batch):
+        model_payload = self.glue_tasks(batch)
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.post(model_payload, len(batch))
+            except Exception as e:
+                # client errors would be repeated on retry
+                client_error = isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500
+                if attempt == self.retries or client_error:
+                    raise
+                logger.info(f'retrying batch to {self.url} ({attempt + 1}/{self.retries}) after {e!r}')
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+    async def post(self, model_payload, tasks_count):
+        replica = await self.router.acquire() if self.router else None
+        start_time = time()
+        ok = False
+        try:
+            response = await codecs.post(self.session, replica.url if replica else self.url, model_payload, self.codec)
+            if not isinstance(response, list) or len(response) != tasks_count:
+                raise ValueError(f'service should return a list of {tasks_count} responses, got {response!r:.200}')
+            ok = True
+        finally:
+            latency = time() - start_time
+            if replica:
+                self.router.release(replica, latency, ok)
+        if self.batch_controller:
+            self.batch_controller.record(tasks_count, latency)
+        return response
 
     def glue_tasks(self, batch):
         if len(batch) == 1:
@@ -132,14 +264,14 @@ class ServiceGatewayHTTPConnector(ServiceGatewayConnectorBase):
         self._session = aiohttp.ClientSession()
         self._service_name = service_config['name']
         self._url = service_config['url']
+        self._codec = codecs.get_codec(service_config.get('codec'))
 
     async def send_to_service(self, payloads: List[Dict]) -> List[Any]:
         batch = defaultdict(list)
         for payload in payloads:
             for key, value in payload.items():
                 batch[key].extend(value)
-        async with await self._session.post(self._url, json=batch) as resp:
-            responses_batch = await resp.json()
+        responses_batch = await codecs.post(self._session, self._url, batch, self._codec)
 
         return responses_batch
 
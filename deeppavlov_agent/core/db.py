@@ -1,5 +1,7 @@
 import motor.motor_asyncio
 
+from .storage import MemoryStorage, SQLiteStorage
+
 
 class DataBase:
     _inst = None
@@ -9,11 +11,20 @@ class DataBase:
             cls._inst = super(DataBase, cls).__new__(cls)
         return cls._inst
 
-    def __init__(self, host, port, name):
-        if isinstance(port, str):
-            port = int(port)
-        self.client = motor.motor_asyncio.AsyncIOMotorClient(host, port)
-        self.db = self.client[name]
+    def __init__(self, host=None, port=None, name=None, backend='mongo', path=None):
+        if backend == 'mongo':
+            if isinstance(port, str):
+                port = int(port)
+            self.client = motor.motor_asyncio.AsyncIOMotorClient(host, port)
+            self.db = self.client[name]
+        elif backend == 'memory':
+            self.client = None
+            self.db = MemoryStorage()
+        elif backend == 'sqlite':
+            self.client = None
+            self.db = SQLiteStorage(path or f'{name or "dp_agent"}.sqlite')
+        else:
+            raise ValueError(f'unknown database backend: {backend}')
 
     def get_db(self):
         return self.db
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, Optional
+
+from .state_schema import Dialog
+
+
+class BaseDialogCache:
+    """Keeps recently active dialogs in memory, keyed by user external id."""
+
+    def get(self, user_external_id: str) -> Optional[Dialog]:
+        raise NotImplementedError
+
+    def put(self, dialog: Dialog) -> None:
+        raise NotImplementedError
+
+    def pop(self, user_external_id: str) -> Optional[Dialog]:
+        raise NotImplementedError
+
+    def pop_by_dialog_id(self, dialog_id) -> Optional[Dialog]:
+        raise NotImplementedError
+
+    def get_stats(self) -> Dict:
+        raise NotImplementedError
+
+
+class LRUDialogCache(BaseDialogCache):
+    """Size and TTL bounded LRU cache of saved dialogs.
+
+    Only one agent process should write to the database, when the cache is used, otherwise
+    cached dialogs can get stale.
+    """
+    def __init__(self, max_size: int = 1000, ttl: float = 300) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._dialogs = OrderedDict()
+        self._keys_by_dialog_id = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_external_id: str) -> Optional[Dialog]:
+        entry = self._dialogs.get(user_external_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        dialog, stored_at = entry
+        if monotonic() - stored_at > self._ttl:
+            self.pop(user_external_id)
+            self.misses += 1
+            return None
+        self._dialogs.move_to_end(user_external_id)
+        self.hits += 1
+        return dialog
+
+    def put(self, dialog: Dialog) -> None:
+        user_external_id = dialog.human.external_id
+        self.pop(user_external_id)
+        self._dialogs[user_external_id] = (dialog, monotonic())
+        self._keys_by_dialog_id[dialog._id] = user_external_id
+        while len(self._dialogs) > self._max_size:
+            _, (evicted, _) = self._dialogs.popitem(last=False)
+            self._keys_by_dialog_id.pop(evicted._id, None)
+            self.evictions += 1
+
+    def pop(self, user_external_id: str) -> Optional[Dialog]:
+        entry = self._dialogs.pop(user_external_id, None)
+        if entry is None:
+            return None
+        self._keys_by_dialog_id.pop(entry[0]._id, None)
+        return entry[0]
+
+    def pop_by_dialog_id(self, dialog_id) -> Optional[Dialog]:
+        user_external_id = self._keys_by_dialog_id.get(dialog_id)
+        if user_external_id is None:
+            return None
+        return self.pop(user_external_id)
+
+    def get_stats(self) -> Dict:
+        return {
+            'size': len(self._dialogs),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
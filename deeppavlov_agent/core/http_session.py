@@ -0,0 +1,72 @@
+import asyncio
+from typing import Dict, Optional
+
+import aiohttp
+
+SESSION_PARAMETERS = {
+    'limit': 100,
+    'limit_per_host': 0,
+    'keepalive_timeout': 15,
+    'ttl_dns_cache': 10,
+    'total_timeout': 300,
+    'connect_timeout': None,
+    'read_timeout': None
+}
+
+
+def check_session_config(config: Dict) -> Dict:
+    """Returns session config with defaults for the missing parameters."""
+    unknown = set(config) - set(SESSION_PARAMETERS)
+    if unknown:
+        raise ValueError(f'unknown http session parameters {sorted(unknown)}, '
+                         f'expected some of {sorted(SESSION_PARAMETERS)}')
+    return {**SESSION_PARAMETERS, **config}
+
+
+def make_session(config: Dict) -> aiohttp.ClientSession:
+    config = check_session_config(config)
+    connector = aiohttp.TCPConnector(limit=config['limit'], limit_per_host=config['limit_per_host'],
+                                     keepalive_timeout=config['keepalive_timeout'],
+                                     ttl_dns_cache=config['ttl_dns_cache'])
+    timeout = aiohttp.ClientTimeout(total=config['total_timeout'], sock_connect=config['connect_timeout'],
+                                    sock_read=config['read_timeout'])
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def get_connection_pool_stats(session: aiohttp.ClientSession) -> Dict:
+    connector = session.connector
+    if connector is None:
+        return {'closed': True}
+    # aiohttp doesn't provide public pool counters, so private attributes are read with fallbacks
+    waiters = getattr(connector, '_waiters', {})
+    return {
+        'limit': connector.limit,
+        'limit_per_host': connector.limit_per_host,
+        'acquired': len(getattr(connector, '_acquired', ())),
+        'idle': sum(len(i) for i in getattr(connector, '_conns', {}).values()),
+        'waiting': sum(len(i) for i in waiters.values()) if isinstance(waiters, dict) else len(waiters)
+    }
+
+
+class ClientSessionPool:
+    """HTTP client sessions of connectors.
+
+    Connectors without their own session config share the default session, a connector with the
+    ``session`` config key gets a dedicated session with its own connection pool.
+    """
+    def __init__(self, default_config: Optional[Dict] = None) -> None:
+        self._default_config = check_session_config(default_config or {})
+        self.sessions = {}
+
+    def get_session(self, name: Optional[str] = None, config: Optional[Dict] = None) -> aiohttp.ClientSession:
+        key = name if config is not None else 'default'
+        if key not in self.sessions:
+            self.sessions[key] = make_session(self._default_config if config is None else config)
+        return self.sessions[key]
+
+    def get_stats(self) -> Dict:
+        return {name: get_connection_pool_stats(session) for name, session in self.sessions.items()}
+
+    async def close(self) -> None:
+        await asyncio.gather(*[session.close() for session in self.sessions.values()])
+        self.sessions = {}
@@ -59,6 +59,7 @@ class LocalResponseLogger(BaseResponseLogger):
     def __init__(self, enabled: bool, cleanup_timedelta: int = 300) -> None:
         self._services_load = defaultdict(int)
         self._services_response_time = defaultdict(dict)
+        self._services_response_time_sum = defaultdict(float)
         self._tasks_buffer = dict()
         self._enabled = enabled
         self._timedelta = timedelta(seconds=cleanup_timedelta)
@@ -85,13 +86,19 @@ class LocalResponseLogger(BaseResponseLogger):
             else:
                 break
 
-        for service_response_time in self._services_response_time.values():
+        for service_name, service_response_time in self._services_response_time.items():
             for start_time in list(service_response_time.keys()):
                 if start_time < time_threshold:
-                    del service_response_time[start_time]
+                    self._services_response_time_sum[service_name] -= service_response_time.pop(start_time)
                 else:
                     break
 
+    def _add_response_time(self, service_name: str, start_time: datetime, end_time: datetime) -> None:
+        service_response_time = self._services_response_time[service_name]
+        response_time = (end_time - start_time).total_seconds()
+        self._services_response_time_sum[service_name] += response_time - service_response_time.get(start_time, 0)
+        service_response_time[start_time] = response_time
+
     def log_start(self, task_id: str, workflow_record: dict, service: Service) -> None:
         start_time = datetime.utcnow()
 
@@ -112,26 +119,30 @@ class LocalResponseLogger(BaseResponseLogger):
             self._services_load['agent'] -= 1
             start_time = self._tasks_buffer.pop(workflow_record['dialog'].id, None)
             if start_time is not None and not cancelled:
-                self._services_response_time['agent'][start_time] = (end_time - start_time).total_seconds()
+                self._add_response_time('agent', start_time, end_time)
         elif not service.is_input():
             start_time = self._tasks_buffer.pop(task_id, None)
             if start_time is not None:
                 self._services_load[service.label] -= 1
                 if not cancelled:
-                    self._services_response_time[service.label][start_time] = (end_time - start_time).total_seconds()
+                    self._add_response_time(service.label, start_time, end_time)
         self._cleanup(end_time)
         if self._enabled:
             self._log(end_time, task_id, workflow_record, service, 'end\t')
 
     def get_current_load(self):
         self._cleanup(datetime.now())
-        response_time = {}
-        for service_name, time_dict in self._services_response_time.items():
-            sm = sum(time_dict.values())
-            ct = len(time_dict)
-            response_time[service_name] = sm / ct if ct else 0
+        response_time = {service_name: self.get_response_time(service_name)
+                         for service_name in self._services_response_time}
         response = {
             'current_load': dict(self._services_load),
             'response_time': response_time
         }
         return response
+
+    def get_response_time(self, service_name: str = 'agent') -> float:
+        """Mean response time of the service (of the whole agent by default) for the last cleanup_timedelta."""
+        time_dict = self._services_response_time.get(service_name)
+        if not time_dict:
+            return 0
+        return self._services_response_time_sum[service_name] / len(time_dict)
@@ -1,6 +1,24 @@
 from collections import defaultdict, Counter
 
 
+class Schedule:
+    """Scheduling state of a single workflow, which is updated incrementally as services finish.
+
+    Services are referenced by their indexes in the compiled pipeline plan, ``launched`` and ``finished``
+    are bitmasks over these indexes.
+    """
+    __slots__ = ('remaining', 'skipped_previous', 'launched', 'finished', 'in_flight', 'candidates', 'terminal')
+
+    def __init__(self, in_degrees):
+        self.remaining = list(in_degrees)
+        self.skipped_previous = [0] * len(in_degrees)
+        self.launched = 0
+        self.finished = 0
+        self.in_flight = 0
+        self.candidates = []
+        self.terminal = False
+
+
 class Pipeline:
     def __init__(self, services, input_service, responder_service, last_chance_service, timeout_service):
         self.last_chance_service = last_chance_service
@@ -17,6 +35,7 @@ class Pipeline:
         self.add_input_service(input_service)
         self.add_responder_service(responder_service)
         self.fill_dependent_service_chains_and_required_services()
+        self.compile_plan()
 
     def get_service_by_name(self, service_name):
         if not service_name:
@@ -38,6 +57,32 @@ class Pipeline:
                 self.services[name_prev_service].next_services.add(service)
         return wrong_names  # wrong names means that some service_names, used in previous services don't exist
 
+    def compile_plan(self):
+        """Indexes services and precomputes predecessor bitmasks and successor lists for scheduling."""
+        plan_services = list(self.services.values())
+        plan_services.extend(s for s in (self.last_chance_service, self.timeout_service) if s)
+        self._plan_services = plan_services
+        self._plan_index = {s.name: i for i, s in enumerate(plan_services)}
+        self._previous_masks = []
+        self._successors = []
+        for service in plan_services:
+            mask = 0
+            for i in service.previous_services:
+                mask |= 1 << self._plan_index[i.name]
+            self._previous_masks.append(mask)
+            self._successors.append([self._plan_index[i.name] for i in service.next_services])
+        self._in_degrees = [bin(mask).count('1') for mask in self._previous_masks]
+        self._terminal_services = {s for s in (self.last_chance_service, self.timeout_service) if s}
+        self._responders = [s for s in self.services.values() if s.is_responder()]
+
+    def _names_mask(self, names):
+        mask = 0
+        for name in names:
+            ind = self._plan_index.get(name)
+            if ind is not None:
+                mask |= 1 << ind
+        return mask
+
     def get_next_services(self, done: set = None, waiting: set = None, skipped: set = None):
         done = done or set()
         waiting = waiting or set()
@@ -45,25 +90,18 @@ class Pipeline:
 
         if (self.last_chance_service and self.last_chance_service.name in done) or \
            (self.timeout_service and self.timeout_service.name in done):
-            return [service for service in self.services.values() if service.is_responder()]
-        completed_names = done | skipped
-        service_names = set(self.services.keys())
-        next_service_names = set()
-        while service_names:
-            sn = service_names.pop()
-            service = self.services[sn]
-            if {i.name for i in service.previous_services} <= completed_names:
-                next_service_names.add(sn)
-            else:
-                for i in service.next_services:
-                    service_names.discard(i.name)
-
-        next_service_names = next_service_names - completed_names - waiting
+            return list(self._responders)
+        skipped_mask = self._names_mask(skipped)
+        completed_mask = self._names_mask(done) | skipped_mask
+        excluded_mask = completed_mask | self._names_mask(waiting)
 
         next_services = []
-        for sn in next_service_names:
-            service = self.services[sn]
-            if not {i.name for i in service.previous_services} <= skipped:
+        for ind, service in enumerate(self.services.values()):
+            previous_mask = self._previous_masks[ind]
+            if excluded_mask >> ind & 1 or previous_mask & ~completed_mask:
+                continue
+            # services, which previous services are all skipped, are not executed
+            if previous_mask & ~skipped_mask:
                 next_services.append(service)
 
         if not next_services and not waiting:
@@ -71,6 +109,50 @@ class Pipeline:
 
         return next_services
 
+    def new_schedule(self) -> Schedule:
+        return Schedule(self._in_degrees)
+
+    def mark_launched(self, schedule: Schedule, service) -> None:
+        bit = 1 << self._plan_index[service.name]
+        if not schedule.launched & bit:
+            schedule.launched |= bit
+            schedule.in_flight += 1
+
+    def mark_finished(self, schedule: Schedule, service, skipped: bool = False) -> None:
+        """Registers that service is done or skipped (or failed). Takes O(number of next services)."""
+        ind = self._plan_index[service.name]
+        bit = 1 << ind
+        if schedule.finished & bit:
+            return
+        schedule.finished |= bit
+        if schedule.launched & bit:
+            schedule.in_flight -= 1
+        if service in self._terminal_services:
+            schedule.terminal = True
+        for next_ind in self._successors[ind]:
+            schedule.remaining[next_ind] -= 1
+            if skipped:
+                schedule.skipped_previous[next_ind] += 1
+            if not schedule.remaining[next_ind]:
+                schedule.candidates.append(next_ind)
+
+    def get_ready_services(self, schedule: Schedule):
+        """Returns services, which became ready to launch since the previous call. Same rules as get_next_services."""
+        if schedule.terminal:
+            return [s for s in self._responders if not schedule.launched >> self._plan_index[s.name] & 1]
+        next_services = []
+        for ind in schedule.candidates:
+            if (schedule.launched | schedule.finished) >> ind & 1:
+                continue
+            if schedule.skipped_previous[ind] < self._in_degrees[ind]:
+                next_services.append(self._plan_services[ind])
+        schedule.candidates = []
+
+        if not next_services and not schedule.in_flight and self.last_chance_service:
+            return [self.last_chance_service]
+
+        return next_services
+
     def add_responder_service(self, service):
         if not service.is_responder():
             raise ValueError('service should be a responder')
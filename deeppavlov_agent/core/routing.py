@@ -0,0 +1,99 @@
+import asyncio
+from time import monotonic
+from typing import Dict, List, Optional
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class Replica:
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0
+
+    def get_stats(self) -> Dict:
+        return {
+            'state': self.state,
+            'outstanding': self.outstanding,
+            'ewma_latency_ms': None if self.ewma_latency is None else self.ewma_latency * 1000,
+            'requests': self.requests,
+            'errors': self.errors
+        }
+
+
+class ReplicaRouter:
+    """Chooses a replica of a service for each request.
+
+    ``least_outstanding`` policy chooses a replica with the least number of running requests, ``ewma``
+    policy chooses a replica with the least EWMA latency weighted by the number of running requests.
+    A replica is ejected (circuit is open) after ``failure_threshold`` consecutive failures, and after
+    ``recovery_time`` seconds a single probe request is sent to it (circuit is half-open). The replica
+    is returned to the rotation, if the probe succeeds.
+    """
+    policies = ('least_outstanding', 'ewma')
+
+    def __init__(self, urls: List[str], policy: str = 'least_outstanding', failure_threshold: int = 3,
+                 recovery_time: float = 10, name: str = '') -> None:
+        if policy not in self.policies:
+            raise ValueError(f'unknown routing policy {policy!r}, expected one of {self.policies}')
+        self.name = name
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.replicas = [Replica(url) for url in dict.fromkeys(urls)]
+
+    def _score(self, replica: Replica) -> float:
+        if self.policy == 'ewma':
+            # replicas without latency measurements are tried first
+            return (replica.ewma_latency or 0) * (replica.outstanding + 1)
+        return replica.outstanding
+
+    def choose(self) -> Optional[Replica]:
+        """Returns the replica for a request or None, if all replicas are ejected."""
+        now = monotonic()
+        available = []
+        for replica in self.replicas:
+            if replica.state == OPEN and now - replica.opened_at >= self.recovery_time:
+                replica.state = HALF_OPEN
+            if replica.state == CLOSED or (replica.state == HALF_OPEN and not replica.outstanding):
+                available.append(replica)
+        if not available:
+            return None
+        replica = min(available, key=self._score)
+        replica.outstanding += 1
+        replica.requests += 1
+        return replica
+
+    async def acquire(self) -> Replica:
+        """Waits until some replica becomes available and chooses it."""
+        while True:
+            replica = self.choose()
+            if replica is not None:
+                return replica
+            now = monotonic()
+            reprobe_times = [i.opened_at + self.recovery_time - now for i in self.replicas if i.state == OPEN]
+            await asyncio.sleep(max(min(reprobe_times, default=0), 0.01))
+
+    def release(self, replica: Replica, latency: float, ok: bool = True) -> None:
+        replica.outstanding -= 1
+        if ok:
+            replica.consecutive_failures = 0
+            replica.state = CLOSED
+            if replica.ewma_latency is None:
+                replica.ewma_latency = latency
+            else:
+                replica.ewma_latency = 0.8 * replica.ewma_latency + 0.2 * latency
+            return
+        replica.errors += 1
+        replica.consecutive_failures += 1
+        if replica.state == HALF_OPEN or replica.consecutive_failures >= self.failure_threshold:
+            replica.state = OPEN
+            replica.opened_at = monotonic()
+
+    def get_stats(self) -> Dict:
+        return {replica.url: replica.get_stats() for replica in self.replicas}
@@ -3,7 +3,7 @@ class Service:
                  batch_size=1, tags=None, names_previous_services=None,
                  names_required_previous_services=None,
                  workflow_formatter=None, dialog_formatter=None, response_formatter=None,
-                 label=None):
+                 label=None, timeout=None):
         self.name = name
         self.batch_size = batch_size
         self.state_processor_method = state_processor_method
@@ -19,6 +19,7 @@ class Service:
         self.dependent_services = set()
         self.next_services = set()
         self.label = label or self.name
+        self.timeout = timeout
 
     def is_sselector(self):
         return 'selector' in self.tags
@@ -51,5 +52,5 @@ class Service:
         return self.response_formatter(payload)
 
 
-def simple_workflow_formatter(workflow_record):
-    return workflow_record['dialog'].to_dict()
+def simple_workflow_formatter(workflow_record, history_window=None):
+    return workflow_record['dialog'].to_dict(history_window=history_window)
@@ -0,0 +1,28 @@
+from bisect import bisect
+from hashlib import md5
+
+
+def stable_hash(key: str) -> int:
+    """Hash of the key, which is the same in all processes, unlike the built-in ``hash``."""
+    return int.from_bytes(md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring, which maps keys (e.g. user ids) to shards ``0..shards - 1``.
+
+    Each shard is placed on the ring at ``vnodes`` points, so keys are spread evenly, and when
+    the number of shards changes, only keys of the added or removed shard change their shard.
+    """
+    def __init__(self, shards: int, vnodes: int = 64) -> None:
+        if shards < 1:
+            raise ValueError(f'number of shards should be positive, got {shards}')
+        self.shards = shards
+        points = sorted((stable_hash(f'shard-{shard}-{i}'), shard) for shard in range(shards) for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def get_shard(self, key: str) -> int:
+        if self.shards == 1:
+            return 0
+        ind = bisect(self._hashes, stable_hash(str(key))) % len(self._hashes)
+        return self._shards[ind]
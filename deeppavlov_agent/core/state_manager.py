@@ -1,14 +1,29 @@
+import warnings
+from copy import copy
 from typing import Dict
 
 from datetime import datetime
 
+from .dialog_cache import BaseDialogCache
 from .state_schema import Bot, BotUtterance, Dialog, Human, HumanUtterance
+from .write_behind import WriteBehindQueue
 import logging
 
 
 class StateManager:
-    def __init__(self, db):
+    def __init__(self, db, history_depth=None, dialog_cache: BaseDialogCache = None, bulk_save=False,
+                 write_behind_queue_size=0, write_behind_batch_size=50):
+        invalid_depth = isinstance(history_depth, bool) or not isinstance(history_depth, int) or history_depth < 1
+        if history_depth is not None and invalid_depth:
+            raise ValueError(f'history_depth should be a positive integer or None, got {history_depth!r}')
         self._db = db
+        self._history_depth = history_depth
+        self._dialog_cache = dialog_cache
+        self._bulk_save = bulk_save
+        self._write_behind = None
+        if write_behind_queue_size:
+            self._write_behind = WriteBehindQueue(self._persist_dialog, max_size=write_behind_queue_size,
+                                                  batch_size=write_behind_batch_size)
 
     async def add_human_utterance(self, dialog: Dialog, payload: Dict, label: str, **kwargs) -> None:
         dialog.add_human_utterance()
@@ -20,18 +35,22 @@ class StateManager:
         hypothesis = {'skill_name': label, 'annotations': {}}
         for h in payload:
             dialog.utterances[-1].hypotheses.append({**hypothesis, **h})
+        dialog.utterances[-1].mark_dirty()
 
     async def add_annotation(self, dialog: Dialog, payload: Dict, label: str, **kwargs):
         dialog.utterances[-1].annotations[label] = payload
+        dialog.utterances[-1].mark_dirty()
 
     async def add_annotation_prev_bot_utt(self, dialog: Dialog, payload: Dict, label: str, **kwargs):
         if len(dialog.utterances) > 1:
             dialog.utterances[-2].annotations[label] = payload
             dialog.utterances[-2].actual = False
+            dialog.utterances[-2].mark_dirty()
 
     async def add_hypothesis_annotation(self, dialog: Dialog, payload: Dict, label: str, **kwargs):
         ind = kwargs['ind']
         dialog.utterances[-1].hypotheses[ind]['annotations'][label] = payload
+        dialog.utterances[-1].mark_dirty()
 
     async def add_hypothesis_annotation_batch(self, dialog: Dialog, payload: Dict, label: str, **kwargs):
         if isinstance(dialog.utterances[-1], BotUtterance):
@@ -42,6 +61,7 @@ class StateManager:
         else:
             for i in range(len(payload["batch"])):
                 dialog.utterances[-1].hypotheses[i]['annotations'][label] = payload["batch"][i]
+        dialog.utterances[-1].mark_dirty()
 
     async def add_text(self, dialog: Dialog, payload: str, label: str, **kwargs):
         dialog.utterances[-1].text = payload
@@ -100,43 +120,126 @@ class StateManager:
         dialog.utterances[-1].user = dialog.bot.to_dict()
 
     async def save_dialog(self, dialog: Dialog, payload: Dict, label: str, **kwargs) -> None:
-        await dialog.save(self._db)
+        if self._write_behind is not None:
+            await self._write_behind.put(dialog)
+        else:
+            await self._persist_dialog(dialog)
+
+    async def _persist_dialog(self, dialog: Dialog) -> None:
+        await dialog.save(self._db, bulk=self._bulk_save)
+        if self._dialog_cache:
+            # the saved dialog may be already used by the next turn, so the cache gets a copy of its history
+            cached_dialog = copy(dialog)
+            if self._history_depth is not None:
+                cached_dialog.trim_history(self._history_depth)
+            else:
+                cached_dialog.utterances = list(dialog.utterances)
+                cached_dialog.human_utterances = list(dialog.human_utterances)
+                cached_dialog.bot_utterances = list(dialog.bot_utterances)
+            self._dialog_cache.put(cached_dialog)
+
+    async def flush(self) -> None:
+        """Waits until all dialogs, queued for saving, are written to db."""
+        if self._write_behind is not None:
+            await self._write_behind.flush()
+
+    async def close(self) -> None:
+        """Saves queued dialogs and stops the background saving, should be called on shutdown."""
+        if self._write_behind is not None:
+            await self._write_behind.close()
 
     async def get_or_create_dialog(self, user_external_id, channel_type, **kwargs):
-        return await Dialog.get_or_create_by_ext_id(self._db, user_external_id, channel_type)
+        if self._write_behind is not None:
+            dialog = self._write_behind.get_pending(user_external_id)
+            if dialog:
+                return dialog
+        if self._dialog_cache:
+            dialog = self._dialog_cache.get(user_external_id)
+            # dialog, which processing has failed before saving, is reloaded from db
+            if dialog and (not dialog.utterances or dialog.utterances[-1]._id):
+                return dialog
+            self._dialog_cache.pop(user_external_id)
+        return await Dialog.get_or_create_by_ext_id(self._db, user_external_id, channel_type, self._history_depth)
+
+    def get_cache_stats(self):
+        if self._dialog_cache:
+            return self._dialog_cache.get_stats()
+        return None
+
+    async def load_previous_utterances(self, dialog: Dialog, count: int) -> int:
+        return await dialog.load_previous_utterances(self._db, count)
 
     async def get_dialog_by_id(self, dialog_id):
+        await self.flush()
         return await Dialog.get_by_id(self._db, dialog_id)
 
     async def get_dialogs_by_user_ext_id(self, user_external_id):
+        await self.flush()
         return await Dialog.get_many_by_ext_id(self._db, user_external_id)
 
     async def get_all_dialogs(self):
-        return await Dialog.get_all(self._db)
+        warnings.warn('get_all_dialogs loads all dialogs into memory, use iter_dialogs instead',
+                      DeprecationWarning, stacklevel=2)
+        return [dialog async for dialog in self.iter_dialogs()]
+
+    async def iter_dialogs(self, date_from=None, date_to=None, batch_size=100):
+        await self.flush()
+        async for dialog in Dialog.iter_all(self._db, date_from, date_to, batch_size):
+            yield dialog
 
     async def drop_active_dialog(self, user_external_id):
+        await self.flush()
+        if self._dialog_cache:
+            self._dialog_cache.pop(user_external_id)
         user = await Human.get_or_create(self._db, user_external_id)
         await Dialog.drop_active(self._db, user._id)
 
+    async def flush_dialog(self, dialog_id=None, utt_id=None):
+        """Saves queued dialogs and drops the dialog, found by its dialog_id or by its bot utterance, from the cache.
+
+        Is called before the dialog is changed by another agent process, so that it is reloaded from db.
+        """
+        await self.flush()
+        if not self._dialog_cache:
+            return
+        if dialog_id is not None:
+            dialog = await Dialog.get_by_dialog_id(self._db, dialog_id, False)
+            if dialog:
+                self._dialog_cache.pop_by_dialog_id(dialog._id)
+        if utt_id is not None:
+            utt = await BotUtterance.get_by_id(self._db, utt_id)
+            if utt:
+                self._dialog_cache.pop_by_dialog_id(utt._dialog_id)
+
     async def set_rating_dialog(self, user_external_id, dialog_id, rating):
+        await self.flush()
         dialog = await Dialog.get_by_dialog_id(self._db, dialog_id, False)
         if not dialog:
             return False
+        if self._dialog_cache:
+            self._dialog_cache.pop_by_dialog_id(dialog._id)
         if 'ratings' not in dialog.attributes:
             dialog.attributes['ratings'] = []
         dialog.attributes['ratings'].append({'rating': rating, 'user_external_id': user_external_id, 'datetime': datetime.now()})
         await dialog.save(self._db)
 
     async def set_rating_utterance(self, user_external_id, utt_id, rating):
+        await self.flush()
         utt = await BotUtterance.get_by_id(self._db, utt_id)
         if not utt:
             return False
+        if self._dialog_cache:
+            self._dialog_cache.pop_by_dialog_id(utt._dialog_id)
         if 'ratings' not in utt.attributes:
             utt.attributes['ratings'] = []
         utt.attributes['ratings'].append({'rating': rating, 'user_external_id': user_external_id, 'datetime': datetime.now()})
+        utt.mark_dirty()
         await utt.save(self._db)
 
     async def drop_and_rating_active_dialog(self, user_external_id, rating):
+        await self.flush()
+        if self._dialog_cache:
+            self._dialog_cache.pop(user_external_id)
         user = await Human.get_or_create(self._db, user_external_id)
         await Dialog.set_rating_drop_active(self._db, user._id, rating)
 
@@ -1,3 +1,4 @@
+import asyncio
 import uuid
 from hashlib import md5
 from collections import defaultdict
@@ -9,6 +10,7 @@ import pymongo
 from bson.objectid import ObjectId
 
 from . import STATE_API_VERSION
+from .storage import InsertOperation, UpdateOperation, get_bulk_operations
 
 USER_PROFILE = {
     "name": None,
@@ -22,9 +24,44 @@ USER_PROFILE = {
 }
 
 
-class HumanUtterance:
+class CachedDictMixin:
+    """Keeps a snapshot of ``to_dict()`` output until one of the serialized fields changes.
+
+    ``to_dict()`` returns a shallow copy of the snapshot, so a formatter, which assigns keys of the dict,
+    doesn't change the input of other services. Nested containers are shared with the utterance.
+
+    Assigning any attribute listed in ``serialized_fields`` drops the snapshot and marks the utterance
+    not actual, so it is written on the next save, even if a save in progress has already taken it.
+    In-place changes of nested containers (e.g. ``utt.annotations[label] = ...``) are not tracked,
+    so code doing them should call ``mark_dirty()`` afterwards.
+    """
+    serialized_fields = frozenset()
+
+    def __setattr__(self, key, value):
+        if key in self.serialized_fields:
+            object.__setattr__(self, '_dict_cache', None)
+            object.__setattr__(self, 'actual', False)
+        object.__setattr__(self, key, value)
+
+    def mark_dirty(self):
+        self._dict_cache = None
+        self.actual = False
+
+    def to_dict(self):
+        cached = getattr(self, '_dict_cache', None)
+        if cached is None:
+            cached = self._to_dict()
+            self._dict_cache = cached
+        return dict(cached)
+
+    def _to_dict(self):
+        raise NotImplementedError
+
+
+class HumanUtterance(CachedDictMixin):
     collection_name = 'human_utterance'
     fieldlist = ['text', 'user', 'annotations', 'hypotheses']
+    serialized_fields = frozenset(['utt_id', 'text', 'user', 'annotations', 'hypotheses', 'date_time', 'attributes'])
 
     def __init__(self, _in_dialog_id, _dialog_id=None, _id=None, text=None, user=None, utt_id=None,
                  annotations=None, date_time=None, hypotheses=None, actual=False, attributes=None):
@@ -44,10 +81,16 @@ class HumanUtterance:
     @classmethod
     async def prepare_collection(cls, db):
         await db[cls.collection_name].create_index('_dialog_id')
+        await db[cls.collection_name].create_index(
+            [
+                ('_dialog_id', pymongo.ASCENDING),
+                ('_in_dialog_id', pymongo.DESCENDING)
+            ]
+        )
         await db[cls.collection_name].create_index('date_time')
         await db[cls.collection_name].create_index('utt_id')
 
-    def to_dict(self):
+    def _to_dict(self):
         return {
             'utt_id': self.utt_id,
             'text': self.text,
@@ -58,11 +101,28 @@ class HumanUtterance:
             'attributes': self.attributes
         }
 
-    async def save(self, db):
-        data = self.to_dict()
+    def get_save_data(self):
+        data = self._to_dict()
         data['date_time'] = self.date_time
         data['_dialog_id'] = self._dialog_id
         data['_in_dialog_id'] = self._in_dialog_id
+        return data
+
+    def get_save_operation(self):
+        """Returns the write operation and the id of the utterance document.
+
+        The id of a new document is generated on the agent side, but it is assigned to the utterance only
+        after the write succeeds, so a failed write is retried as an insert.
+        """
+        data = self.get_save_data()
+        if not self._id:
+            data['_id'] = ObjectId()
+            return InsertOperation(data), data['_id']
+        data.pop('utt_id')
+        return UpdateOperation({'_id': self._id}, {'$set': data}), self._id
+
+    async def save(self, db):
+        data = self.get_save_data()
         if not self._id:
             result = await db[self.collection_name].insert_one(data)
             self._id = result.inserted_id
@@ -76,10 +136,18 @@ class HumanUtterance:
         return self._id
 
     @classmethod
-    async def get_many(cls, db, dialog_id):
+    async def get_many(cls, db, dialog_id, limit=None, before=None):
+        query = {'_dialog_id': dialog_id}
+        if before is not None:
+            query['_in_dialog_id'] = {'$lt': before}
+        cursor = db[cls.collection_name].find(query)
+        if limit:
+            cursor = cursor.sort('_in_dialog_id', pymongo.DESCENDING).limit(limit)
         result = []
-        async for document in db[cls.collection_name].find({'_dialog_id': dialog_id}):
+        async for document in cursor:
             result.append(cls(actual=True, **document))
+        if limit:
+            result.reverse()
         return result
 
     @classmethod
@@ -96,8 +164,10 @@ class HumanUtterance:
             return cls(**utt)
 
 
-class BotUtterance:
+class BotUtterance(CachedDictMixin):
     collection_name = 'bot_utterance'
+    serialized_fields = frozenset(['utt_id', 'text', 'orig_text', 'active_skill', 'confidence', 'annotations',
+                                   'date_time', 'user', 'attributes'])
 
     def __init__(self, _in_dialog_id, _dialog_id=None, _id=None, text=None, utt_id=None,
                  user=None, annotations=None, date_time=None, active_skill=None,
@@ -113,16 +183,23 @@ class BotUtterance:
         self.confidence = confidence or 1
         self.user = user or {}
         self.annotations = annotations or {}
-        self.actual = actual
         self.attributes = attributes or {}
+        # is set after the serialized fields, since setting them marks the utterance not actual
+        self.actual = actual
 
     @classmethod
     async def prepare_collection(cls, db):
         await db[cls.collection_name].create_index('_dialog_id')
+        await db[cls.collection_name].create_index(
+            [
+                ('_dialog_id', pymongo.ASCENDING),
+                ('_in_dialog_id', pymongo.DESCENDING)
+            ]
+        )
         await db[cls.collection_name].create_index('date_time')
         await db[cls.collection_name].create_index('utt_id')
 
-    def to_dict(self):
+    def _to_dict(self):
         return {
             'utt_id': self.utt_id,
             'text': self.text,
@@ -135,11 +212,28 @@ class BotUtterance:
             'attributes': self.attributes,
         }
 
-    async def save(self, db):
-        data = self.to_dict()
+    def get_save_data(self):
+        data = self._to_dict()
         data['date_time'] = self.date_time
         data['_dialog_id'] = self._dialog_id
         data['_in_dialog_id'] = self._in_dialog_id
+        return data
+
+    def get_save_operation(self):
+        """Returns the write operation and the id of the utterance document.
+
+        The id of a new document is generated on the agent side, but it is assigned to the utterance only
+        after the write succeeds, so a failed write is retried as an insert.
+        """
+        data = self.get_save_data()
+        if not self._id:
+            data['_id'] = ObjectId()
+            return InsertOperation(data), data['_id']
+        data.pop('utt_id')
+        return UpdateOperation({'_id': self._id}, {'$set': data}), self._id
+
+    async def save(self, db):
+        data = self.get_save_data()
         if not self._id:
             result = await db[self.collection_name].insert_one(data)
             self._id = result.inserted_id
@@ -152,10 +246,18 @@ class BotUtterance:
         return self._id
 
     @classmethod
-    async def get_many(cls, db, dialog_id):
+    async def get_many(cls, db, dialog_id, limit=None, before=None):
+        query = {'_dialog_id': dialog_id}
+        if before is not None:
+            query['_in_dialog_id'] = {'$lt': before}
+        cursor = db[cls.collection_name].find(query)
+        if limit:
+            cursor = cursor.sort('_in_dialog_id', pymongo.DESCENDING).limit(limit)
         result = []
-        async for document in db[cls.collection_name].find({'_dialog_id': dialog_id}):
+        async for document in cursor:
             result.append(cls(actual=True, **document))
+        if limit:
+            result.reverse()
         return result
 
     @classmethod
@@ -222,12 +324,19 @@ class Dialog:
         await db[cls.collection_name].create_index('date_finish')
         await db[cls.collection_name].create_index('dialog_id')
 
-    def to_dict(self):
+    def to_dict(self, history_window=None):
+        utterances, human_utterances, bot_utterances = self.utterances, self.human_utterances, self.bot_utterances
+        if history_window is not None:
+            if isinstance(history_window, bool) or not isinstance(history_window, int) or history_window < 1:
+                raise ValueError(f'history_window should be a positive integer, got {history_window!r}')
+            utterances = utterances[-history_window:]
+            human_utterances = human_utterances[-history_window:]
+            bot_utterances = bot_utterances[-history_window:]
         return {
             'dialog_id': self.dialog_id,
-            'utterances': [i.to_dict() for i in self.utterances],
-            'human_utterances': [i.to_dict() for i in self.human_utterances],
-            'bot_utterances': [i.to_dict() for i in self.bot_utterances],
+            'utterances': [i.to_dict() for i in utterances],
+            'human_utterances': [i.to_dict() for i in human_utterances],
+            'bot_utterances': [i.to_dict() for i in bot_utterances],
             'human': self.human.to_dict(),
             'bot': self.bot.to_dict(),
             'channel_type': self.channel_type,
@@ -235,20 +344,46 @@ class Dialog:
             'date_finish': str(self.date_finish),
         }
 
-    async def load_external_info(self, db):
+    async def load_external_info(self, db, history_depth=None):
+        """Loads utterances and bot of the dialog.
+
+        If ``history_depth`` is set, only the last ``history_depth`` human and bot utterances are fetched,
+        and ``utterances`` keeps the last ``history_depth`` of them. Older ones can be fetched with
+        ``load_previous_utterances``.
+        """
         if self._id:
-            self.human_utterances = await HumanUtterance.get_many(db, self._id)
-            self.bot_utterances = await BotUtterance.get_many(db, self._id)
+            self.human_utterances = await HumanUtterance.get_many(db, self._id, limit=history_depth)
+            self.bot_utterances = await BotUtterance.get_many(db, self._id, limit=history_depth)
             self.utterances = sorted(chain(self.human_utterances, self.bot_utterances), key=lambda x: x._in_dialog_id)
+            if history_depth is not None:
+                self.utterances = self.utterances[-history_depth:]
             self.bot = await Bot.get_or_create(db, self._bot_id)
 
+    async def load_previous_utterances(self, db, count):
+        """Prepends up to ``count`` utterances, preceding the earliest loaded one. Returns number of loaded ones."""
+        if not self._id or not self.utterances:
+            return 0
+        before = self.utterances[0]._in_dialog_id
+        human_utterances = await HumanUtterance.get_many(db, self._id, limit=count, before=before)
+        bot_utterances = await BotUtterance.get_many(db, self._id, limit=count, before=before)
+        previous = sorted(chain(human_utterances, bot_utterances), key=lambda x: x._in_dialog_id)[-count:]
+        self.utterances = previous + self.utterances
+        # human_utterances and bot_utterances may already reach further back than utterances
+        if self.human_utterances:
+            human_utterances = [i for i in human_utterances if i._in_dialog_id < self.human_utterances[0]._in_dialog_id]
+        if self.bot_utterances:
+            bot_utterances = [i for i in bot_utterances if i._in_dialog_id < self.bot_utterances[0]._in_dialog_id]
+        self.human_utterances = human_utterances + self.human_utterances
+        self.bot_utterances = bot_utterances + self.bot_utterances
+        return len(previous)
+
     @classmethod
-    async def get_or_create_by_user(cls, db, human, channel_type):
+    async def get_or_create_by_user(cls, db, human, channel_type, history_depth=None):
         if human._id:
             dialog = await db[cls.collection_name].find_one({'_human_id': human._id, '_active': True})
             if dialog:
                 dialog_obj = cls(actual=True, human=human, **dialog)
-                await dialog_obj.load_external_info(db)
+                await dialog_obj.load_external_info(db, history_depth)
                 return dialog_obj
         dialog_obj = cls(_human_id=human._id, human=human, channel_type=channel_type)
         dialog_obj.bot = Bot()
@@ -268,18 +403,57 @@ class Dialog:
 
     @classmethod
     async def get_all(cls, db):
-        humans = {i._id: i for i in await Human.get_all(db)}
-        bots = {i._id: i for i in await Bot.get_all(db)}
+        """Loads all dialogs into a list, ``iter_all`` should be used for large databases."""
+        return [dialog async for dialog in cls.iter_all(db)]
+
+    @classmethod
+    async def iter_all(cls, db, date_from=None, date_to=None, batch_size=100):
+        """Yields dialogs in ``date_start`` order, holding in memory only ``batch_size`` dialogs at once.
+
+        Humans, bots and utterances are fetched with one query per collection for each batch of dialogs.
+        """
+        query = {}
+        if date_from or date_to:
+            query['date_start'] = {}
+            if date_from:
+                query['date_start']['$gte'] = date_from
+            if date_to:
+                query['date_start']['$lt'] = date_to
+        batch = []
+        cursor = db[cls.collection_name].find(query).sort('date_start', pymongo.ASCENDING).batch_size(batch_size)
+        async for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                for dialog in await cls._load_batch(db, batch):
+                    yield dialog
+                batch = []
+        if batch:
+            for dialog in await cls._load_batch(db, batch):
+                yield dialog
+
+    @classmethod
+    async def _load_batch(cls, db, documents):
+        dialog_ids = [i['_id'] for i in documents]
+        human_ids = list({i['_human_id'] for i in documents})
+        bot_ids = list({i['_bot_id'] for i in documents if i.get('_bot_id')})
+        humans = {}
+        async for document in db[Human.collection_name].find({'_id': {'$in': human_ids}}):
+            humans[document['_id']] = Human(**document)
+        bots = {}
+        async for document in db[Bot.collection_name].find({'_id': {'$in': bot_ids}}):
+            bots[document['_id']] = Bot(**document)
         utterances = defaultdict(list)
-        for doc in await HumanUtterance.get_all(db):
-            utterances[doc._dialog_id].append(doc)
-        for doc in await BotUtterance.get_all(db):
-            utterances[doc._dialog_id].append(doc)
+        for utterance_class in (HumanUtterance, BotUtterance):
+            async for document in db[utterance_class.collection_name].find({'_dialog_id': {'$in': dialog_ids}}):
+                utterances[document['_dialog_id']].append(utterance_class(actual=True, **document))
         result = []
-        async for document in db[cls.collection_name].find():
-            dialog = cls(actual=True, human=humans[document['_human_id']], **document)
-            dialog.bot = bots[document['_bot_id']]
-            dialog.utterances = sorted(utterances[document['_id']], key=lambda x: x._in_dialog_id)
+        for document in documents:
+            human = humans.get(document['_human_id']) or Human(external_id=None, _id=document['_human_id'])
+            dialog = cls(actual=True, human=human, **document)
+            dialog.bot = bots.get(document.get('_bot_id')) or Bot()
+            dialog.utterances = sorted(utterances.pop(document['_id'], []), key=lambda x: x._in_dialog_id)
+            dialog.human_utterances = [i for i in dialog.utterances if isinstance(i, HumanUtterance)]
+            dialog.bot_utterances = [i for i in dialog.utterances if isinstance(i, BotUtterance)]
             result.append(dialog)
         return result
 
@@ -323,14 +497,19 @@ class Dialog:
             await db[cls.collection_name].update_one({'_id': dialog['_id']}, {'$set': {'_active': False, 'attributes': attributes}})
 
     @classmethod
-    async def get_or_create_by_ext_id(cls, db, external_id, channel_type):
+    async def get_or_create_by_ext_id(cls, db, external_id, channel_type, history_depth=None):
         human = await Human.get_or_create(db, external_id)
-        return await cls.get_or_create_by_user(db, human, channel_type)
+        return await cls.get_or_create_by_user(db, human, channel_type, history_depth)
 
     @classmethod
     async def get_channels(cls, db):
         return await db[cls.collection_name].distinct('channel_type')
 
+    def trim_history(self, history_depth):
+        self.utterances = self.utterances[-history_depth:]
+        self.human_utterances = self.human_utterances[-history_depth:]
+        self.bot_utterances = self.bot_utterances[-history_depth:]
+
     def add_human_utterance(self):
         ind = 0
         if self.utterances:
@@ -347,13 +526,12 @@ class Dialog:
         self.utterances.append(utterance_obj)
         self.bot_utterances.append(utterance_obj)
 
-    async def save(self, db, force=False):
-        self._human_id = await self.human.save(db)
-        if self.bot:
-            self._bot_id = await self.bot.save(db)
+    def get_save_data(self):
         data = {'attributes': self.attributes}
         if self.utterances:
-            data['date_start'] = self.utterances[0].date_time
+            # utterances may hold only the recent part of history, so the stored date_start is kept
+            self.date_start = self.date_start or self.utterances[0].date_time
+            data['date_start'] = self.date_start
             data['date_finish'] = self.utterances[-1].date_time
         if not self._id:
             data.update({
@@ -363,18 +541,99 @@ class Dialog:
                 '_active': self._active,
                 'channel_type': self.channel_type,
             })
-            dialog = await db[self.collection_name].insert_one(data)
-            self._id = dialog.inserted_id
-        else:
-            await db[self.collection_name].update_one(
-                {'_id': self._id},
-                {'$set': data}
-            )
+        return data
+
+    def get_unsaved_utterances(self, force=False):
+        unsaved = []
         for utt in self.utterances[::-1]:
             if utt.actual and not force:
                 break
-            utt._dialog_id = self._id
-            await utt.save(db)
+            unsaved.append(utt)
+        return unsaved
+
+    def _take_unsaved_utterances(self, force=False):
+        """Takes utterances to save and marks them actual before the first write of the save.
+
+        So the save writes the state of the dialog at its start: utterances, which are added or changed
+        (and marked not actual) by the next turn while the dialog is being saved, are left for the next save.
+        """
+        unsaved = self.get_unsaved_utterances(force)
+        for utt in unsaved:
+            utt.actual = True
+        return unsaved
+
+    async def save(self, db, force=False, bulk=False):
+        if bulk:
+            return await self.save_bulk(db, force)
+        unsaved = self._take_unsaved_utterances(force)
+        data = self.get_save_data()
+        try:
+            self._human_id = await self.human.save(db)
+            if self.bot:
+                self._bot_id = await self.bot.save(db)
+            if not self._id:
+                data.update(_human_id=self._human_id, _bot_id=self._bot_id)
+                dialog = await db[self.collection_name].insert_one(data)
+                self._id = dialog.inserted_id
+            else:
+                await db[self.collection_name].update_one(
+                    {'_id': self._id},
+                    {'$set': data}
+                )
+            for utt in reversed(unsaved):
+                utt._dialog_id = self._id
+                await utt.save(db)
+        except BaseException:
+            for utt in unsaved:
+                utt.actual = False
+            raise
+
+    async def save_bulk(self, db, force=False):
+        """Saves dialog in at most two sequential round trips.
+
+        Human and bot are saved first, since the dialog document refers to them. Then the dialog document
+        and all unsaved utterances are written concurrently, with a single ``bulk_write`` per utterance
+        collection. Ids of new documents are generated on the agent side.
+        """
+        unsaved = self._take_unsaved_utterances(force)
+        data = self.get_save_data()
+        dialog_id = self._id or ObjectId()
+        operations = defaultdict(list)
+        for utt in unsaved:
+            utt._dialog_id = dialog_id
+            operations[utt.collection_name].append((utt, *utt.get_save_operation()))
+        try:
+            if self.bot:
+                self._human_id, self._bot_id = await asyncio.gather(self.human.save(db), self.bot.save(db))
+            else:
+                self._human_id = await self.human.save(db)
+        except BaseException:
+            for utt in unsaved:
+                utt.actual = False
+            raise
+
+        if not self._id:
+            data.update(_id=dialog_id, _human_id=self._human_id, _bot_id=self._bot_id)
+            writes = [db[self.collection_name].insert_one(data)]
+        else:
+            writes = [db[self.collection_name].update_one({'_id': dialog_id}, {'$set': data})]
+        for collection_name, collection_operations in operations.items():
+            bulk_operations = get_bulk_operations(db, [operation for _, operation, _ in collection_operations])
+            writes.append(db[collection_name].bulk_write(bulk_operations, ordered=False))
+
+        # ids are assigned only to documents, which are written, so the rest are inserted on the next save
+        dialog_result, *results = await asyncio.gather(*writes, return_exceptions=True)
+        if not isinstance(dialog_result, BaseException):
+            self._id = dialog_id
+        for result, collection_operations in zip(results, operations.values()):
+            if not isinstance(result, BaseException):
+                for utt, _, document_id in collection_operations:
+                    utt._id = document_id
+        for result in (dialog_result, *results):
+            if isinstance(result, BaseException):
+                for utt in unsaved:
+                    utt.actual = False
+                raise result
 
 
 class Human:
@@ -460,6 +719,7 @@ class Human:
                     'attributes': self.attributes
                 }
             })
+        self.prev_state = self.get_state()
         return self._id
 
 
@@ -527,6 +787,7 @@ class Bot:
                     'attributes': self.attributes
                 }
             })
+        self.prev_state = self.get_state()
         return self._id
 
 
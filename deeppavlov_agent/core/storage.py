@@ -0,0 +1,498 @@
+"""Storage backends, which can replace Mongo DB for single-node deployments and benchmarks.
+
+Backends implement the subset of the motor collection API, used by ``state_schema``: ``find_one``, ``find``
+(with ``sort``, ``limit`` and ``batch_size``), ``insert_one``, ``update_one`` (``$set`` only), ``bulk_write``
+(``InsertOperation`` and ``UpdateOperation``, which are converted to pymongo operations for Mongo),
+``distinct`` and ``create_index``. Queries support equality and ``$lt``, ``$lte``, ``$gt``, ``$gte``, ``$ne``
+and ``$in`` conditions on top-level fields.
+"""
+import asyncio
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime
+from functools import partial
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional
+
+import bson
+import pymongo
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.results import InsertOneResult
+
+_comparison_operators = {
+    '$eq': lambda value, arg: value == arg,
+    '$lt': lambda value, arg: value is not None and value < arg,
+    '$lte': lambda value, arg: value is not None and value <= arg,
+    '$gt': lambda value, arg: value is not None and value > arg,
+    '$gte': lambda value, arg: value is not None and value >= arg,
+    '$ne': lambda value, arg: value != arg,
+    '$in': lambda value, arg: value in arg,
+}
+
+
+def _is_operator_condition(condition: Any) -> bool:
+    return isinstance(condition, dict) and bool(condition) and all(k.startswith('$') for k in condition)
+
+
+def match_document(document: Dict, query: Optional[Dict]) -> bool:
+    for field, condition in (query or {}).items():
+        value = document.get(field)
+        if _is_operator_condition(condition):
+            for operator, arg in condition.items():
+                if operator not in _comparison_operators:
+                    raise ValueError(f'Unsupported query operator: {operator}')
+                if not _comparison_operators[operator](value, arg):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def apply_update(document: Dict, update: Dict) -> None:
+    for operator, fields in update.items():
+        if operator != '$set':
+            raise ValueError(f'Unsupported update operator: {operator}')
+        document.update(fields)
+
+
+def index_fields(keys) -> List[str]:
+    if isinstance(keys, str):
+        return [keys]
+    return [key for key, _ in keys]
+
+
+def sort_documents(documents: List[Dict], sort: List) -> List[Dict]:
+    for field, direction in reversed(sort):
+        # documents without the field go first in ascending order, as in Mongo
+        documents.sort(key=lambda x: (x.get(field) is not None, x.get(field) if x.get(field) is not None else 0),
+                       reverse=direction == pymongo.DESCENDING)
+    return documents
+
+
+class InsertOperation(NamedTuple):
+    document: Dict
+
+    def to_pymongo(self) -> InsertOne:
+        return InsertOne(self.document)
+
+
+class UpdateOperation(NamedTuple):
+    filter: Dict
+    update: Dict
+
+    def to_pymongo(self) -> UpdateOne:
+        return UpdateOne(self.filter, self.update)
+
+
+def get_bulk_operations(db, operations: List) -> List:
+    """Returns operations for ``bulk_write`` of the database, Mongo takes pymongo operations."""
+    if isinstance(db, BaseStorage):
+        return operations
+    return [operation.to_pymongo() for operation in operations]
+
+
+class WriteResult:
+    def __init__(self, matched_count: int = 0, modified_count: int = 0, inserted_count: int = 0) -> None:
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.inserted_count = inserted_count
+
+
+class BaseCursor:
+    """Lazy query, executed when iteration starts."""
+    def __init__(self, collection, query: Optional[Dict]) -> None:
+        self._collection = collection
+        self._query = query or {}
+        self._sort = []
+        self._limit = 0
+        self._batch_size = 100
+        self._results = None
+
+    def sort(self, key_or_list, direction=pymongo.ASCENDING):
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        self._batch_size = batch_size
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._results is None:
+            self._results = self._collection.iter_find(self._query, self._sort, self._limit, self._batch_size)
+        return await self._results.__anext__()
+
+    async def to_list(self, length=None):
+        return [document async for document in self][:length]
+
+
+class BaseCollection:
+    def find(self, query: Optional[Dict] = None) -> BaseCursor:
+        return BaseCursor(self, query)
+
+    async def find_one(self, query: Optional[Dict] = None) -> Optional[Dict]:
+        result = await self.execute_find(query or {}, [], 1)
+        return result[0] if result else None
+
+    async def execute_find(self, query: Dict, sort: List, limit: int) -> List[Dict]:
+        raise NotImplementedError
+
+    async def iter_find(self, query: Dict, sort: List, limit: int, batch_size: int) -> AsyncIterator[Dict]:
+        for document in await self.execute_find(query, sort, limit):
+            yield document
+
+    async def insert_one(self, document: Dict) -> InsertOneResult:
+        raise NotImplementedError
+
+    async def update_one(self, query: Dict, update: Dict) -> WriteResult:
+        raise NotImplementedError
+
+    async def bulk_write(self, operations: List, ordered: bool = True) -> WriteResult:
+        raise NotImplementedError
+
+    async def distinct(self, key: str) -> List:
+        raise NotImplementedError
+
+    async def create_index(self, keys) -> None:
+        raise NotImplementedError
+
+
+class BaseStorage:
+    _collection_class = BaseCollection
+
+    def __init__(self) -> None:
+        self._collections = {}
+
+    def __getitem__(self, name: str) -> BaseCollection:
+        if name not in self._collections:
+            self._collections[name] = self._collection_class(self, name)
+        return self._collections[name]
+
+
+class MemoryCollection(BaseCollection):
+    """Collection, stored in process memory. Documents are copied on every read and write, as with a real db."""
+    def __init__(self, storage, name: str) -> None:
+        self._name = name
+        self._documents = {}
+        self._indexes = {}
+
+    def _index_add(self, document: Dict) -> None:
+        for field, index in self._indexes.items():
+            try:
+                index[document.get(field)][document['_id']] = None
+            except TypeError:  # unhashable values are not indexed
+                pass
+
+    def _index_discard(self, document: Dict) -> None:
+        for field, index in self._indexes.items():
+            try:
+                index[document.get(field)].pop(document['_id'], None)
+            except TypeError:
+                pass
+
+    def _candidates(self, query: Dict):
+        for field, condition in query.items():
+            if field == '_id' and not _is_operator_condition(condition):
+                document = self._documents.get(condition)
+                return [document] if document else []
+            if field in self._indexes and not _is_operator_condition(condition):
+                try:
+                    ids = self._indexes[field].get(condition, ())
+                except TypeError:
+                    continue
+                return [self._documents[i] for i in ids]
+        return self._documents.values()
+
+    async def execute_find(self, query: Dict, sort: List, limit: int) -> List[Dict]:
+        result = [i for i in self._candidates(query) if match_document(i, query)]
+        if sort:
+            result = sort_documents(result, sort)
+        if limit:
+            result = result[:limit]
+        return deepcopy(result)
+
+    def _insert(self, document: Dict) -> Any:
+        document.setdefault('_id', ObjectId())
+        if document['_id'] in self._documents:
+            raise ValueError(f'Duplicate _id {document["_id"]} in {self._name} collection')
+        stored = deepcopy(document)
+        self._documents[stored['_id']] = stored
+        self._index_add(stored)
+        return stored['_id']
+
+    def _update(self, query: Dict, update: Dict) -> int:
+        for document in self._candidates(query):
+            if match_document(document, query):
+                self._index_discard(document)
+                apply_update(document, deepcopy(update))
+                self._index_add(document)
+                return 1
+        return 0
+
+    async def insert_one(self, document: Dict) -> InsertOneResult:
+        return InsertOneResult(self._insert(document), True)
+
+    async def update_one(self, query: Dict, update: Dict) -> WriteResult:
+        updated = self._update(query, update)
+        return WriteResult(matched_count=updated, modified_count=updated)
+
+    async def bulk_write(self, operations: List, ordered: bool = True) -> WriteResult:
+        result = WriteResult()
+        for operation in operations:
+            if isinstance(operation, InsertOperation):
+                self._insert(operation.document)
+                result.inserted_count += 1
+            elif isinstance(operation, UpdateOperation):
+                updated = self._update(operation.filter, operation.update)
+                result.matched_count += updated
+                result.modified_count += updated
+            else:
+                raise ValueError(f'Unsupported bulk operation: {type(operation).__name__}')
+        return result
+
+    async def distinct(self, key: str) -> List:
+        result = []
+        for document in self._documents.values():
+            if key in document and document[key] not in result:
+                result.append(document[key])
+        return result
+
+    async def create_index(self, keys) -> None:
+        for field in index_fields(keys):
+            if field not in self._indexes and field != '_id':
+                # index values are dicts, used as insertion ordered sets
+                self._indexes[field] = defaultdict(dict)
+                for document in self._documents.values():
+                    try:
+                        self._indexes[field][document.get(field)][document['_id']] = None
+                    except TypeError:
+                        pass
+
+
+class MemoryStorage(BaseStorage):
+    _collection_class = MemoryCollection
+
+
+def _sql_value(value: Any) -> Any:
+    """Maps a document value to an sqlite value, which keeps equality and ordering. Returns None if impossible."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return None
+
+
+def _column(field: str) -> str:
+    return '"f_' + field.replace('"', '""') + '"'
+
+
+class SQLiteCollection(BaseCollection):
+    """Collection, stored as a table of bson documents. Indexed fields are duplicated into table columns."""
+    def __init__(self, storage, name: str) -> None:
+        self._storage = storage
+        self._table = '"' + name.replace('"', '""') + '"'
+        self._indexed = set()
+        self._ready = False
+
+    def _ensure_table(self, connection: sqlite3.Connection) -> None:
+        if self._ready:
+            return
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {self._table} (_id TEXT PRIMARY KEY, doc BLOB NOT NULL)')
+        columns = [row[1] for row in connection.execute(f'PRAGMA table_info({self._table})')]
+        self._indexed = {column[2:] for column in columns if column.startswith('f_')}
+        self._ready = True
+
+    def _row_values(self, document: Dict) -> List:
+        return [_sql_value(document['_id']), bson.encode(document)] + \
+            [_sql_value(document.get(field)) for field in sorted(self._indexed)]
+
+    def _insert_sql(self) -> str:
+        columns = ['_id', 'doc'] + [_column(field) for field in sorted(self._indexed)]
+        return f'INSERT INTO {self._table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+
+    def _update_sql(self) -> str:
+        columns = ['doc'] + [_column(field) for field in sorted(self._indexed)]
+        return f'UPDATE {self._table} SET {", ".join(c + " = ?" for c in columns)} WHERE _id = ?'
+
+    def _where(self, query: Dict):
+        """Translates query conditions on indexed fields into sql. Returns sql, arguments and exactness flag."""
+        clauses, args, exact = [], [], True
+        sql_operators = {'$lt': '<', '$lte': '<=', '$gt': '>', '$gte': '>='}
+        for field, condition in query.items():
+            column = '_id' if field == '_id' else _column(field)
+            if field != '_id' and field not in self._indexed:
+                exact = False
+                continue
+            conditions = condition.items() if _is_operator_condition(condition) else [('$eq', condition)]
+            for operator, arg in conditions:
+                if operator == '$in':
+                    values = [_sql_value(i) for i in arg]
+                    if None in values:
+                        exact = False
+                        continue
+                    clauses.append(f'{column} IN ({", ".join("?" * len(values))})' if values else '0')
+                    args.extend(values)
+                    continue
+                value = _sql_value(arg)
+                if value is None or operator not in sql_operators and operator != '$eq':
+                    exact = False
+                    continue
+                clauses.append(f'{column} {sql_operators.get(operator, "=")} ?')
+                args.append(value)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', args, exact
+
+    def _find(self, query: Dict, sort: List, limit: int, offset: int = 0) -> List[Dict]:
+        connection = self._storage.connection
+        self._ensure_table(connection)
+        where, args, exact = self._where(query)
+        sql_sort = exact and all(field == '_id' or field in self._indexed for field, _ in sort)
+        sql = f'SELECT doc FROM {self._table}{where}'
+        if sort and sql_sort:
+            order = []
+            for field, direction in sort:
+                column = '_id' if field == '_id' else _column(field)
+                order.append(f'{column} {"DESC" if direction == pymongo.DESCENDING else "ASC"}')
+            sql += ' ORDER BY ' + ', '.join(order)
+        if limit and sql_sort:
+            sql += f' LIMIT {int(limit)}'
+            if offset:
+                sql += f' OFFSET {int(offset)}'
+        result = [bson.decode(row[0]) for row in connection.execute(sql, args)]
+        if not exact:
+            result = [i for i in result if match_document(i, query)]
+        if sort and not sql_sort:
+            result = sort_documents(result, sort)
+        if limit:
+            result = result[:limit]
+        return result
+
+    def _find_page(self, query: Dict, sort: List, limit: int, page_size: int, offset: int):
+        """Returns documents of the page and whether the query is paged. Queries, which can't be executed
+        by sqlite entirely, are not paged: all their documents are returned at once."""
+        self._ensure_table(self._storage.connection)
+        _, _, exact = self._where(query)
+        if not exact or not all(field == '_id' or field in self._indexed for field, _ in sort):
+            return self._find(query, sort, limit), False
+        # documents with equal sort keys are ordered by _id, so pages don't overlap
+        return self._find(query, sort + [('_id', pymongo.ASCENDING)], page_size, offset), True
+
+    def _insert(self, connection: sqlite3.Connection, document: Dict) -> Any:
+        document.setdefault('_id', ObjectId())
+        connection.execute(self._insert_sql(), self._row_values(document))
+        return document['_id']
+
+    def _update(self, connection: sqlite3.Connection, query: Dict, update: Dict) -> int:
+        documents = self._find(query, [], 1)
+        if not documents:
+            return 0
+        document = documents[0]
+        apply_update(document, update)
+        values = self._row_values(document)
+        connection.execute(self._update_sql(), values[1:] + values[:1])
+        return 1
+
+    def _write(self, func, *args):
+        connection = self._storage.connection
+        self._ensure_table(connection)
+        with connection:
+            return func(connection, *args)
+
+    def _bulk_write(self, connection: sqlite3.Connection, operations: List) -> WriteResult:
+        result = WriteResult()
+        for operation in operations:
+            if isinstance(operation, InsertOperation):
+                self._insert(connection, operation.document)
+                result.inserted_count += 1
+            elif isinstance(operation, UpdateOperation):
+                updated = self._update(connection, operation.filter, operation.update)
+                result.matched_count += updated
+                result.modified_count += updated
+            else:
+                raise ValueError(f'Unsupported bulk operation: {type(operation).__name__}')
+        return result
+
+    def _distinct(self, key: str) -> List:
+        result = []
+        for document in self._find({}, [], 0):
+            if key in document and document[key] not in result:
+                result.append(document[key])
+        return result
+
+    def _create_index(self, keys) -> None:
+        connection = self._storage.connection
+        self._ensure_table(connection)
+        fields = [field for field in index_fields(keys) if field != '_id']
+        with connection:
+            for field in fields:
+                if field in self._indexed:
+                    continue
+                connection.execute(f'ALTER TABLE {self._table} ADD COLUMN {_column(field)}')
+                rows = connection.execute(f'SELECT _id, doc FROM {self._table}').fetchall()
+                connection.executemany(f'UPDATE {self._table} SET {_column(field)} = ? WHERE _id = ?',
+                                       [(_sql_value(bson.decode(doc).get(field)), _id) for _id, doc in rows])
+                self._indexed.add(field)
+            if fields:
+                index_name = '"' + '_'.join([self._table.strip('"')] + fields).replace('"', '""') + '_idx"'
+                columns = ', '.join(_column(field) for field in fields)
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {self._table} ({columns})')
+
+    async def execute_find(self, query: Dict, sort: List, limit: int) -> List[Dict]:
+        return await self._storage.run(self._find, query, sort, limit)
+
+    async def iter_find(self, query: Dict, sort: List, limit: int, batch_size: int) -> AsyncIterator[Dict]:
+        """Fetches ``batch_size`` documents at a time, so only one batch of rows is held in memory."""
+        offset = 0
+        while not limit or offset < limit:
+            page_size = min(batch_size, limit - offset) if limit else batch_size
+            documents, paged = await self._storage.run(self._find_page, query, sort, limit, page_size, offset)
+            for document in documents:
+                yield document
+            if not paged or len(documents) < page_size:
+                return
+            offset += page_size
+
+    async def insert_one(self, document: Dict) -> InsertOneResult:
+        return InsertOneResult(await self._storage.run(self._write, self._insert, document), True)
+
+    async def update_one(self, query: Dict, update: Dict) -> WriteResult:
+        updated = await self._storage.run(self._write, self._update, query, update)
+        return WriteResult(matched_count=updated, modified_count=updated)
+
+    async def bulk_write(self, operations: List, ordered: bool = True) -> WriteResult:
+        return await self._storage.run(self._write, self._bulk_write, operations)
+
+    async def distinct(self, key: str) -> List:
+        return await self._storage.run(self._distinct, key)
+
+    async def create_index(self, keys) -> None:
+        await self._storage.run(self._create_index, keys)
+
+
+class SQLiteStorage(BaseStorage):
+    """SQLite database in WAL mode. All queries are executed in a single background thread."""
+    _collection_class = SQLiteCollection
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    async def run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args))
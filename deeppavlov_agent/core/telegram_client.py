@@ -28,4 +28,7 @@ def run_tg(token, proxy, agent):
 
     dp.message_handler()(tg_msg_processor.handle_message)
 
-    executor.start_polling(dp, skip_updates=True)
+    async def on_shutdown(dp):
+        await agent.state_manager.close()
+
+    executor.start_polling(dp, skip_updates=True, on_shutdown=on_shutdown)
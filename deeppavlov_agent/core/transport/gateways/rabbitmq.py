@@ -1,20 +1,25 @@
 import asyncio
-import json
 import time
+import traceback
 from logging import getLogger
 from typing import Dict, List, Optional, Callable
 
 import aio_pika
 from aio_pika import Connection, Channel, Exchange, Queue, IncomingMessage, Message
 
+from ... import codecs
+from ...batching import collect_batch, make_batch_controller
+from ...sharding import HashRing
 from ..base import AgentGatewayBase, ServiceGatewayBase, ChannelGatewayBase
 from ..messages import ServiceTaskMessage, ServiceResponseMessage, ToChannelMessage, FromChannelMessage
-from ..messages import TMessageBase, ServiceErrorMessage, get_transport_message
+from ..messages import MessageBase, TMessageBase, ServiceErrorMessage, decode_message, encode_message
 
 AGENT_IN_EXCHANGE_NAME_TEMPLATE = '{agent_namespace}_e_in'
 AGENT_OUT_EXCHANGE_NAME_TEMPLATE = '{agent_namespace}_e_out'
 AGENT_QUEUE_NAME_TEMPLATE = '{agent_namespace}_q_agent_{agent_name}'
 AGENT_ROUTING_KEY_TEMPLATE = 'agent.{agent_name}'
+AGENT_SHARD_QUEUE_NAME_TEMPLATE = '{agent_namespace}_q_agent_{agent_name}_shard_{shard_id}'
+AGENT_SHARD_ROUTING_KEY_TEMPLATE = 'agent.{agent_name}.shard.{shard_id}'
 
 SERVICE_QUEUE_NAME_TEMPLATE = '{agent_namespace}_q_service_{service_name}'
 SERVICE_ROUTING_KEY_TEMPLATE = 'service.{service_name}'
@@ -25,6 +30,70 @@ CHANNEL_ROUTING_KEY_TEMPLATE = 'agent.{agent_name}.channel.{channel_id}.any'
 logger = getLogger(__name__)
 
 
+def get_agent_routing_key(agent_name: str, shard_id: Optional[int] = None) -> str:
+    if shard_id is None:
+        return AGENT_ROUTING_KEY_TEMPLATE.format(agent_name=agent_name)
+    return AGENT_SHARD_ROUTING_KEY_TEMPLATE.format(agent_name=agent_name, shard_id=shard_id)
+
+
+def get_delivery_mode(name: str) -> aio_pika.DeliveryMode:
+    try:
+        return aio_pika.DeliveryMode[name.upper()]
+    except KeyError:
+        raise ValueError(f'unknown delivery mode {name!r}, expected one of '
+                         f'{[i.name.lower() for i in aio_pika.DeliveryMode]}') from None
+
+
+class BatchPublisher:
+    """Publishes messages to an exchange in batches.
+
+    Messages are buffered for ``window_ms`` milliseconds or until ``max_batch_size`` messages are
+    buffered, then the whole batch is published concurrently, so waiting for publisher confirms of
+    the batch takes a single broker round trip. With zero window the batch consists of messages,
+    which were published during the same event loop iteration. ``publish`` returns after the message
+    is confirmed and raises if publishing of this message has failed.
+    """
+    def __init__(self, exchange: Exchange, window_ms: float = 0, max_batch_size: int = 100) -> None:
+        self._exchange = exchange
+        self._window = window_ms / 1000
+        self._max_batch_size = max_batch_size
+        self._buffer = []
+        self._flush_handle = None
+        self.batches = 0
+        self.messages = 0
+
+    async def publish(self, message: Message, routing_key: str) -> None:
+        loop = asyncio.get_event_loop()
+        confirmed = loop.create_future()
+        self._buffer.append((message, routing_key, confirmed))
+        if len(self._buffer) >= self._max_batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._window, self.flush)
+        await confirmed
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._buffer = self._buffer, []
+        if batch:
+            asyncio.ensure_future(self._publish_batch(batch))
+
+    async def _publish_batch(self, batch: List) -> None:
+        self.batches += 1
+        self.messages += len(batch)
+        results = await asyncio.gather(*[self._exchange.publish(message=message, routing_key=routing_key)
+                                         for message, routing_key, _ in batch], return_exceptions=True)
+        for (_, _, confirmed), result in zip(batch, results):
+            if confirmed.done():
+                continue
+            if isinstance(result, BaseException):
+                confirmed.set_exception(result)
+            else:
+                confirmed.set_result(None)
+
+
 # TODO: add proper RabbitMQ SSL authentication
 class RabbitMQTransportBase:
     _config: dict
@@ -42,6 +111,23 @@ class RabbitMQTransportBase:
         self._config = config
         self._in_queue = None
         self._utterance_lifetime_sec = config['utterance_lifetime_sec']
+        self._codec = codecs.get_codec(config.get('codec'))
+        # schema version 1 is readable by the agents and the services of previous versions,
+        # messages of both versions are read regardless of this setting
+        self._schema_version = config.get('message_schema_version', 1)
+        # dialogs are distributed among agent processes by consistent hash of user id
+        self._agent_shards = config.get('agent_shards', 1)
+        self._shards_ring = HashRing(self._agent_shards)
+
+    def _make_message(self, message: MessageBase,
+                      delivery_mode: aio_pika.DeliveryMode = aio_pika.DeliveryMode.PERSISTENT) -> Message:
+        body, headers = encode_message(message, self._codec, self._schema_version)
+        return Message(body=body, headers=headers, content_type=self._codec.content_type,
+                       delivery_mode=delivery_mode, expiration=self._utterance_lifetime_sec)
+
+    @staticmethod
+    def _read_message(message: IncomingMessage) -> TMessageBase:
+        return decode_message(message.body, message.content_type, message.headers)
 
     async def _connect(self) -> None:
         agent_namespace = self._config['agent_namespace']
@@ -103,52 +189,79 @@ class RabbitMQAgentGateway(RabbitMQTransportBase, AgentGatewayBase):
 
         self._loop = asyncio.get_event_loop()
         self._agent_name = self._config['agent_name']
+        self._shard_id = self._config.get('agent_shard_id')
+        if self._agent_shards > 1 and self._shard_id not in range(self._agent_shards):
+            raise ValueError(f'agent_shard_id should be set to one of 0..{self._agent_shards - 1} '
+                             f'for agent with {self._agent_shards} shards, got {self._shard_id!r}')
+        if self._agent_shards == 1:
+            self._shard_id = None
+        # tasks expire in utterance_lifetime_sec anyway, so they may be published without persistence
+        self._task_delivery_mode = get_delivery_mode(self._config.get('task_delivery_mode', 'persistent'))
 
         self._loop.run_until_complete(self._connect())
+        self._publisher = BatchPublisher(self._agent_out_exchange, self._config.get('publish_window_ms', 0),
+                                         self._config.get('publish_batch_size', 100))
         self._loop.run_until_complete(self._setup_queues())
         self._loop.run_until_complete(self._in_queue.consume(callback=self._on_message_callback))
         logger.info('Agent in queue started consuming')
 
     async def _setup_queues(self) -> None:
         agent_namespace = self._config['agent_namespace']
-        in_queue_name = AGENT_QUEUE_NAME_TEMPLATE.format(agent_namespace=agent_namespace, agent_name=self._agent_name)
+        if self._shard_id is None:
+            in_queue_name = AGENT_QUEUE_NAME_TEMPLATE.format(agent_namespace=agent_namespace,
+                                                             agent_name=self._agent_name)
+        else:
+            in_queue_name = AGENT_SHARD_QUEUE_NAME_TEMPLATE.format(agent_namespace=agent_namespace,
+                                                                   agent_name=self._agent_name,
+                                                                   shard_id=self._shard_id)
         self._in_queue = await self._agent_in_channel.declare_queue(name=in_queue_name, durable=True)
         logger.info(f'Declared agent in queue: {in_queue_name}')
 
-        routing_key = AGENT_ROUTING_KEY_TEMPLATE.format(agent_name=self._agent_name)
+        routing_key = get_agent_routing_key(self._agent_name, self._shard_id)
         await self._in_queue.bind(exchange=self._agent_in_exchange, routing_key=routing_key)
         logger.info(f'Queue: {in_queue_name} bound to routing key: {routing_key}')
 
     async def _on_message_callback(self, message: IncomingMessage) -> None:
-        message_in: TMessageBase = get_transport_message(json.loads(message.body, encoding='utf-8'))
+        message_in: TMessageBase = self._read_message(message)
         await message.ack()
 
+        # only headers are logged, so that bodies are not decoded before they are needed
         if isinstance(message_in, ServiceResponseMessage):
-            logger.debug(f'Received service response message {str(message_in.to_json())}')
+            logger.debug(f'Received service response message {message_in.header}')
             await self._loop.create_task(self._on_service_callback(task_id=message_in.task_id,
                                                                    response=message_in.response))
 
         elif isinstance(message_in, ServiceErrorMessage):
-            logger.debug(f'Received service error message {str(message_in.to_json())}')
+            logger.debug(f'Received service error message {message_in.header}')
             await self._loop.create_task(self._on_service_callback(task_id=message_in.task_id,
                                                                    response=message_in.exception))
 
         elif isinstance(message_in, FromChannelMessage):
-            logger.debug(f'Received message from channel {str(message_in.to_json())}')
-            await self._loop.create_task(self._on_channel_callback(utterance=message_in.utterance,
-                                                                   channel_id=message_in.channel_id,
-                                                                   user_id=message_in.user_id,
-                                                                   reset_dialog=message_in.reset_dialog))
+            logger.debug(f'Received message from channel {message_in.header}')
+            # the turn is not awaited, so that service responses are consumed meanwhile
+            self._loop.create_task(self._process_channel_message(message_in))
+
+    async def _process_channel_message(self, message_in: FromChannelMessage) -> None:
+        try:
+            response = await self._on_channel_callback(utterance=message_in.utterance,
+                                                       user_external_id=message_in.user_id,
+                                                       channel_type=message_in.channel_id,
+                                                       require_response=True)
+        except Exception:
+            logger.exception(f'Failed to process message from channel {message_in.header}')
+            return
+        await self.send_to_channel(channel_id=message_in.channel_id,
+                                   user_id=message_in.user_id,
+                                   response=response['dialog'].utterances[-1].text)
 
     async def send_to_service(self, service_name: str, payload: dict) -> None:
-        task = ServiceTaskMessage(agent_name=self._agent_name, payload=payload)
+        # responses are routed back to the shard, which holds the workflow record of the dialog
+        task = ServiceTaskMessage(agent_name=self._agent_name, payload=payload, shard_id=self._shard_id)
 
-        message = Message(body=json.dumps(task.to_json()).encode('utf-8'),
-                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                          expiration=self._utterance_lifetime_sec)
+        message = self._make_message(task, self._task_delivery_mode)
 
         routing_key = SERVICE_ROUTING_KEY_TEMPLATE.format(service_name=service_name)
-        await self._agent_out_exchange.publish(message=message, routing_key=routing_key)
+        await self._publisher.publish(message=message, routing_key=routing_key)
         logger.debug(f'Published task {payload["task_id"]} with routing key {routing_key}')
 
     async def send_to_channel(self, channel_id: str, user_id: str, response: str) -> None:
@@ -157,36 +270,48 @@ class RabbitMQAgentGateway(RabbitMQTransportBase, AgentGatewayBase):
                                            user_id=user_id,
                                            response=response)
 
-        channel_message_json = channel_message.to_json()
-        message = Message(body=json.dumps(channel_message_json).encode('utf-8'),
-                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                          expiration=self._utterance_lifetime_sec)
+        message = self._make_message(channel_message)
 
         routing_key = CHANNEL_ROUTING_KEY_TEMPLATE.format(agent_name=self._agent_name, channel_id=channel_id)
         await self._agent_out_exchange.publish(message=message, routing_key=routing_key)
-        logger.debug(f'Published channel message: {str(channel_message_json)}')
+        logger.debug(f'Published channel message: {channel_message.header}')
 
 
 # TODO: add separate service infer timeouts
 class RabbitMQServiceGateway(RabbitMQTransportBase, ServiceGatewayBase):
+    """Consumes service tasks, assembles them into batches and sends the batches to the service.
+
+    Incoming messages are put into a bounded buffer. A batch is taken from the buffer when one of
+    ``max_in_flight`` inference slots is free: all buffered messages up to the batch size are taken,
+    and if the batch is not full, it is waiting for new messages no longer than ``max_wait_ms``.
+    Prefetch count is enough to fill all the slots and to collect the next batch meanwhile.
+    """
     _service_name: str
     _batch_size: int
-    _incoming_messages_buffer: List[IncomingMessage]
-    _add_to_buffer_lock: asyncio.Lock
-    _infer_lock: asyncio.Lock
+    _max_wait: float
+    _max_in_flight: int
+    _prefetch_count: int
+    _incoming_messages_buffer: asyncio.Queue
+    _infer_slots: asyncio.Semaphore
 
     def __init__(self, config: dict, to_service_callback: Callable) -> None:
         super(RabbitMQServiceGateway, self).__init__(config=config, to_service_callback=to_service_callback)
         self._loop = asyncio.get_event_loop()
-        self._service_name = self._config['service']['name']
-        self._batch_size = self._config['service'].get('batch_size', 1)
-
-        self._incoming_messages_buffer = []
-        self._add_to_buffer_lock = asyncio.Lock()
-        self._infer_lock = asyncio.Lock()
+        service_config = self._config['service']
+        self._service_name = service_config['name']
+        self._batch_size = service_config.get('batch_size', 1)
+        self._max_wait = service_config.get('max_wait_ms', 0) / 1000
+        self._max_in_flight = service_config.get('max_in_flight', 1)
+        self._prefetch_count = service_config.get('prefetch_count', self._batch_size * (self._max_in_flight + 1))
+        # if target_p95_ms is set, batch_size is an upper bound of the adaptive batch size
+        self._batch_controller = make_batch_controller(service_config)
+
+        self._incoming_messages_buffer = asyncio.Queue(maxsize=self._prefetch_count)
+        self._infer_slots = asyncio.Semaphore(self._max_in_flight)
 
         self._loop.run_until_complete(self._connect())
         self._loop.run_until_complete(self._setup_queues())
+        self._batches_task = self._loop.create_task(self._collect_batches())
         self._loop.run_until_complete(self._in_queue.consume(callback=self._on_message_callback))
         logger.info(f'Service in queue started consuming')
 
@@ -206,80 +331,102 @@ class RabbitMQServiceGateway(RabbitMQTransportBase, ServiceGatewayBase):
             await self._in_queue.bind(exchange=self._agent_out_exchange, routing_key=service_routing_key)
             logger.info(f'Queue: {in_queue_name} bound to routing key: {service_routing_key}')
 
-        await self._agent_out_channel.set_qos(prefetch_count=self._batch_size * 2)
+        await self._agent_out_channel.set_qos(prefetch_count=self._prefetch_count)
 
     async def _on_message_callback(self, message: IncomingMessage) -> None:
-        await self._add_to_buffer_lock.acquire()
-        self._incoming_messages_buffer.append(message)
+        await self._incoming_messages_buffer.put(message)
         logger.debug('Incoming message received')
 
-        if len(self._incoming_messages_buffer) < self._batch_size:
-            self._add_to_buffer_lock.release()
-
-        await self._infer_lock.acquire()
+    async def _collect_batches(self) -> None:
+        while True:
+            await self._infer_slots.acquire()
+            batch_size = self._batch_controller.size if self._batch_controller else self._batch_size
+            try:
+                messages_batch = await collect_batch(self._incoming_messages_buffer, batch_size, self._max_wait)
+            except BaseException:
+                self._infer_slots.release()
+                raise
+            self._loop.create_task(self._infer_batch(messages_batch))
+
+    async def _infer_batch(self, messages_batch: List[IncomingMessage]) -> None:
+        tasks_batch: List[ServiceTaskMessage] = []
+        read_messages: List[IncomingMessage] = []
         try:
-            messages_batch = self._incoming_messages_buffer
-
-            if messages_batch:
-                self._incoming_messages_buffer = []
-
-                if self._add_to_buffer_lock.locked():
-                    self._add_to_buffer_lock.release()
-                tasks_batch: List[ServiceTaskMessage] = [get_transport_message(json.loads(message.body,
-                                                                                          encoding='utf-8'))
-                                                         for message in messages_batch]
-
-                # TODO: Think about proper infer errors and aknowledge handling
-                processed_ok = await self._process_tasks(tasks_batch)
-
-                if processed_ok:
-                    for message in messages_batch:
-                        await message.ack()
+            for message in messages_batch:
+                try:
+                    task = self._read_message(message)
+                    # the body is decoded lazily, it's checked here, as a task can't be answered without its id
+                    task.payload['task_id']
+                except Exception:
+                    logger.exception('Failed to read service task message')
+                    await message.reject()
                 else:
-                    for message in messages_batch:
-                        await message.reject()
-
-            elif self._add_to_buffer_lock.locked():
-                self._add_to_buffer_lock.release()
+                    tasks_batch.append(task)
+                    read_messages.append(message)
+
+            if tasks_batch:
+                try:
+                    await self._process_tasks(tasks_batch)
+                except Exception as e:
+                    logger.exception(f'Batch of {len(tasks_batch)} tasks has failed')
+                    # the agent completes the tasks with the error instead of waiting for their deadline
+                    formatted_exc = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+                    await asyncio.gather(*[self._send_error(task, formatted_exc) for task in tasks_batch])
         finally:
-            self._infer_lock.release()
+            self._infer_slots.release()
+
+        for message in read_messages:
+            await message.ack()
 
-    async def _process_tasks(self, tasks_batch: List[ServiceTaskMessage]) -> bool:
+    async def _process_tasks(self, tasks_batch: List[ServiceTaskMessage]) -> None:
         task_uuids_batch, payloads = \
             zip(*[(task.payload['task_id'], task.payload['payload']) for task in tasks_batch])
 
         logger.debug(f'Prepared for infering tasks {str(task_uuids_batch)}')
 
+        start_time = time.time()
         try:
             responses_batch = await asyncio.wait_for(self._to_service_callback(payloads),
                                                      self._utterance_lifetime_sec)
+        except asyncio.TimeoutError:
+            if self._batch_controller:
+                self._batch_controller.record(len(tasks_batch), time.time() - start_time)
+            raise asyncio.TimeoutError(f'{self._service_name} has not responded in {self._utterance_lifetime_sec} s')
+        if self._batch_controller:
+            self._batch_controller.record(len(tasks_batch), time.time() - start_time)
 
-            results_replies = []
+        results_replies = []
 
-            for i, response in enumerate(responses_batch):
-                results_replies.append(
-                    self._send_results(tasks_batch[i], response)
-                )
+        for i, response in enumerate(responses_batch):
+            results_replies.append(
+                self._send_results(tasks_batch[i], response)
+            )
 
-            await asyncio.gather(*results_replies)
-            logger.debug(f'Processed tasks {str(task_uuids_batch)}')
-            return True
-        except asyncio.TimeoutError:
-            return False
+        await asyncio.gather(*results_replies)
+        logger.debug(f'Processed tasks {str(task_uuids_batch)}')
 
     async def _send_results(self, task: ServiceTaskMessage, response: Dict) -> None:
         result = ServiceResponseMessage(agent_name=task.agent_name,
                                         task_id=task.payload["task_id"],
                                         response=response)
 
-        message = Message(body=json.dumps(result.to_json()).encode('utf-8'),
-                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                          expiration=self._utterance_lifetime_sec)
+        message = self._make_message(result)
 
-        routing_key = AGENT_ROUTING_KEY_TEMPLATE.format(agent_name=task.agent_name)
+        routing_key = get_agent_routing_key(task.agent_name, task.shard_id)
         await self._agent_in_exchange.publish(message=message, routing_key=routing_key)
         logger.debug(f'Sent response for task {str(task.payload["task_id"])} with routing key {routing_key}')
 
+    async def _send_error(self, task: ServiceTaskMessage, formatted_exc: str) -> None:
+        error = ServiceErrorMessage(agent_name=task.agent_name,
+                                    task_id=task.payload['task_id'],
+                                    formatted_exc=formatted_exc)
+
+        message = self._make_message(error)
+
+        routing_key = get_agent_routing_key(task.agent_name, task.shard_id)
+        await self._agent_in_exchange.publish(message=message, routing_key=routing_key)
+        logger.debug(f'Sent error for task {str(task.payload["task_id"])} with routing key {routing_key}')
+
 
 class RabbitMQChannelGateway(RabbitMQTransportBase, ChannelGatewayBase):
     _agent_name: str
@@ -311,11 +458,10 @@ class RabbitMQChannelGateway(RabbitMQTransportBase, ChannelGatewayBase):
         logger.info(f'Queue: {in_queue_name} bound to routing key: {routing_key}')
 
     async def _on_message_callback(self, message: IncomingMessage) -> None:
-        message_json = json.loads(message.body, encoding='utf-8')
-        message_to_channel: ToChannelMessage = ToChannelMessage.from_json(message_json)
+        message_to_channel: ToChannelMessage = self._read_message(message)
         await self._loop.create_task(self._to_channel_callback(message_to_channel.user_id, message_to_channel.response))
         await message.ack()
-        logger.debug(f'Processed message to channel: {str(message_json)}')
+        logger.debug(f'Processed message to channel: {message_to_channel.header}')
 
     async def send_to_agent(self, utterance: str, channel_id: str, user_id: str, reset_dialog: bool) -> None:
         message_from_channel = FromChannelMessage(agent_name=self._agent_name,
@@ -324,11 +470,9 @@ class RabbitMQChannelGateway(RabbitMQTransportBase, ChannelGatewayBase):
                                                   utterance=utterance,
                                                   reset_dialog=reset_dialog)
 
-        message_json = message_from_channel.to_json()
-        message = Message(body=json.dumps(message_json).encode('utf-8'),
-                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                          expiration=self._utterance_lifetime_sec)
+        message = self._make_message(message_from_channel)
 
-        routing_key = AGENT_ROUTING_KEY_TEMPLATE.format(agent_name=self._agent_name)
+        shard_id = self._shards_ring.get_shard(user_id) if self._agent_shards > 1 else None
+        routing_key = get_agent_routing_key(self._agent_name, shard_id)
         await self._agent_in_exchange.publish(message=message, routing_key=routing_key)
-        logger.debug(f'Processed message to agent: {str(message_json)}')
+        logger.debug(f'Processed message to agent: {message_from_channel.header}')
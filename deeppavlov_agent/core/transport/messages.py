@@ -1,50 +1,112 @@
-from typing import Any, Dict, TypeVar
+from typing import Any, Dict, Optional, Tuple, TypeVar
 
+from .. import codecs
+
+SCHEMA_VERSION = 2
+SCHEMA_HEADER = 'schema_version'
+
+_NOT_DECODED = object()
 
-class MessageBase:
-    agent_name: str
-    msg_type: str
 
-    def __init__(self, msg_type: str, agent_name: str):
-        self.msg_type = msg_type
+class MessageBase:
+    """Transport message, which consists of header fields and a single body field.
+
+    Header fields are small values (names and ids), which are sent in the headers of a transport
+    message. The body field (a task payload, a service response, an utterance) is encoded with
+    a codec and sent as the message body. The body of a received message is decoded on the first
+    access, so a message can be dispatched by its header without parsing the whole dialog.
+    """
+    __slots__ = ('agent_name', '_body', '_raw_body', '_content_type')
+    msg_type: str = None
+    header_fields: Tuple[str, ...] = ('agent_name',)
+    # fields, which are sent only if they are set, so messages without them are readable by previous versions
+    optional_fields: Tuple[str, ...] = ()
+    body_field: str = None
+
+    def __init__(self, agent_name: str, body: Any) -> None:
         self.agent_name = agent_name
+        self._body = body
+        self._raw_body = None
+        self._content_type = None
+
+    def _get_body(self) -> Any:
+        if self._body is _NOT_DECODED:
+            self._body = codecs.decode(self._raw_body, self._content_type)
+            self._raw_body = None
+        return self._body
+
+    @property
+    def header(self) -> Dict:
+        header = {field: getattr(self, field) for field in self.header_fields}
+        for field in self.optional_fields:
+            if header[field] is None:
+                del header[field]
+        header['msg_type'] = self.msg_type
+        return header
 
     @classmethod
-    def from_json(cls, message_json):
+    def from_json(cls, message_json: Dict) -> 'MessageBase':
         return cls(**message_json)
 
-    def to_json(self) -> dict:
-        return self.__dict__
+    def to_json(self) -> Dict:
+        message_json = self.header
+        message_json[self.body_field] = self._get_body()
+        return message_json
+
+    @classmethod
+    def from_raw(cls, header: Dict, raw_body: bytes, content_type: Optional[str] = None) -> 'MessageBase':
+        """Creates message from the received header and the body, which is decoded on the first access."""
+        message = cls.__new__(cls)
+        for field in cls.header_fields:
+            value = header.get(field) if field in cls.optional_fields else header[field]
+            setattr(message, field, value.decode('utf-8') if isinstance(value, bytes) else value)
+        message._body = _NOT_DECODED
+        message._raw_body = raw_body
+        message._content_type = content_type
+        return message
 
 
 TMessageBase = TypeVar('TMessageBase', bound=MessageBase)
 
 
 class ServiceTaskMessage(MessageBase):
-    payload: Dict
+    __slots__ = ('shard_id',)
+    msg_type = 'service_task'
+    header_fields = MessageBase.header_fields + ('shard_id',)
+    optional_fields = ('shard_id',)
+    body_field = 'payload'
 
-    def __init__(self, agent_name: str, payload: Dict) -> None:
-        super().__init__('service_task', agent_name)
-        self.payload = payload
+    def __init__(self, agent_name: str, payload: Dict, shard_id: Optional[int] = None) -> None:
+        super().__init__(agent_name, payload)
+        self.shard_id = shard_id
+
+    payload = property(MessageBase._get_body)
 
 
 class ServiceResponseMessage(MessageBase):
-    response: Any
-    task_id: str
+    __slots__ = ('task_id',)
+    msg_type = 'service_response'
+    header_fields = MessageBase.header_fields + ('task_id',)
+    body_field = 'response'
 
     def __init__(self, task_id: str, agent_name: str, response: Any) -> None:
-        super().__init__('service_response', agent_name)
+        super().__init__(agent_name, response)
         self.task_id = task_id
-        self.response = response
+
+    response = property(MessageBase._get_body)
 
 
 class ServiceErrorMessage(MessageBase):
-    formatted_exc: str
+    __slots__ = ('task_id',)
+    msg_type = 'error'
+    header_fields = MessageBase.header_fields + ('task_id',)
+    body_field = 'formatted_exc'
 
     def __init__(self, task_id: str, agent_name: str, formatted_exc: str) -> None:
-        super().__init__('error', agent_name)
+        super().__init__(agent_name, formatted_exc)
         self.task_id = task_id
-        self.formatted_exc = formatted_exc
+
+    formatted_exc = property(MessageBase._get_body)
 
     @property
     def exception(self) -> Exception:
@@ -52,30 +114,33 @@ class ServiceErrorMessage(MessageBase):
 
 
 class ToChannelMessage(MessageBase):
-    channel_id: str
-    user_id: str
-    response: str
+    __slots__ = ('channel_id', 'user_id')
+    msg_type = 'to_channel_message'
+    header_fields = MessageBase.header_fields + ('channel_id', 'user_id')
+    body_field = 'response'
 
     def __init__(self, agent_name: str, channel_id: str, user_id: str, response: str) -> None:
-        super().__init__('to_channel_message', agent_name)
+        super().__init__(agent_name, response)
         self.channel_id = channel_id
         self.user_id = user_id
-        self.response = response
+
+    response = property(MessageBase._get_body)
 
 
 class FromChannelMessage(MessageBase):
-    channel_id: str
-    user_id: str
-    utterance: str
-    reset_dialog: bool
+    __slots__ = ('channel_id', 'user_id', 'reset_dialog')
+    msg_type = 'from_channel_message'
+    header_fields = MessageBase.header_fields + ('channel_id', 'user_id', 'reset_dialog')
+    body_field = 'utterance'
 
     def __init__(self, agent_name: str, channel_id: str, user_id: str, utterance: str, reset_dialog: bool) -> None:
-        super().__init__('from_channel_message', agent_name)
+        super().__init__(agent_name, utterance)
         self.channel_id = channel_id
         self.user_id = user_id
-        self.utterance = utterance
         self.reset_dialog = reset_dialog
 
+    utterance = property(MessageBase._get_body)
+
 
 _message_wrappers_map = {
     'service_task': ServiceTaskMessage,
@@ -86,12 +151,41 @@ _message_wrappers_map = {
 }
 
 
-def get_transport_message(message_json: dict) -> TMessageBase:
-    message_type = message_json.pop('msg_type')
-
+def _get_message_class(message_type: str):
     if message_type not in _message_wrappers_map:
         raise ValueError(f'Unknown transport message type: {message_type}')
+    return _message_wrappers_map[message_type]
 
-    message_wrapper_class: TMessageBase = _message_wrappers_map[message_type]
 
+def get_transport_message(message_json: dict) -> TMessageBase:
+    message_type = message_json.pop('msg_type')
+    message_wrapper_class = _get_message_class(message_type)
     return message_wrapper_class.from_json(message_json)
+
+
+def encode_message(message: MessageBase, codec: codecs.Codec,
+                   schema_version: int = SCHEMA_VERSION) -> Tuple[bytes, Dict]:
+    """Returns body and headers of the transport message.
+
+    Messages of schema version 1 are sent as a single encoded dict without headers, so they can be
+    read by the agents and the services, which don't support headers yet.
+    """
+    if schema_version == 1:
+        return codec.encode(message.to_json()), {}
+    header = message.header
+    header[SCHEMA_HEADER] = SCHEMA_VERSION
+    return codec.encode(message._get_body()), header
+
+
+def decode_message(body: bytes, content_type: Optional[str] = None, headers: Optional[Dict] = None) -> TMessageBase:
+    """Reads the transport message of any schema version, the body of a versioned message is decoded lazily."""
+    schema_version = (headers or {}).get(SCHEMA_HEADER)
+    if schema_version is None:
+        return get_transport_message(codecs.decode(body, content_type))
+    if schema_version > SCHEMA_VERSION:
+        raise ValueError(f'Unsupported transport message schema version {schema_version}, '
+                         f'the latest supported is {SCHEMA_VERSION}')
+    message_type = headers['msg_type']
+    if isinstance(message_type, bytes):
+        message_type = message_type.decode('utf-8')
+    return _get_message_class(message_type).from_raw(headers, body, content_type)
@@ -2,6 +2,13 @@ TRANSPORT_SETTINGS = {
     'agent_namespace': 'deeppavlov_agent',
     'agent_name': 'dp_agent',
     'utterance_lifetime_sec': 120,
+    'codec': 'json',
+    'message_schema_version': 1,
+    'agent_shards': 1,
+    'agent_shard_id': None,
+    'task_delivery_mode': 'persistent',
+    'publish_window_ms': 0,
+    'publish_batch_size': 100,
     'channels': {},
     'transport': {
         'type': 'AMQP',
@@ -1,36 +1,130 @@
-from collections import defaultdict
 from uuid import uuid4
-from typing import Optional, Dict, List
+from typing import Any, Optional, Dict, List
 from time import time
 
 from .state_schema import Dialog
 from .service import Service
 
+NOT_STARTED, WAITING, DONE, SKIPPED, ERROR = range(5)
+
+
+class _Record:
+    """Base class for slot based records, which supports dict-like read access to the fields."""
+    __slots__ = ()
+    _fields = frozenset()
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self._fields:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in self._fields and getattr(self, key) is not None
+
+
+class TaskRecord(_Record):
+    __slots__ = ('service', 'service_index', 'payload', 'dialog', 'ind', 'task_object', 'timer',
+                 'send_time', 'done_time', 'error', 'workflow_record')
+    _fields = frozenset(('service', 'payload', 'dialog', 'ind', 'task_object', 'workflow_record'))
+
+    def __init__(self, service: Service, service_index: int, payload: Any, dialog: str, ind: int) -> None:
+        self.service = service
+        self.service_index = service_index
+        self.payload = payload
+        self.dialog = dialog
+        self.ind = ind
+        self.task_object = None
+        self.timer = None
+        self.send_time = time()
+        self.done_time = None
+        self.error = False
+        self.workflow_record = None
+
+
+class WorkflowRecord(_Record):
+    """State of a dialog, which is being processed by the pipeline.
+
+    Services are referenced by integer indexes interned by WorkflowManager: ``service_status`` holds
+    status codes and ``pending_counts`` holds numbers of pending tasks. Keyword arguments, which are not
+    record fields, are stored in ``extra`` and are accessible with ``record[key]`` as well.
+    """
+    __slots__ = ('dialog', 'deadline_timestamp', 'schedule', 'hold_flush', 'event', 'timeout_response_task',
+                 'service_status', 'pending_counts', 'tasks', 'extra')
+    _fields = frozenset(('dialog', 'deadline_timestamp', 'schedule', 'hold_flush', 'event',
+                         'timeout_response_task', 'tasks'))
+
+    def __init__(self, dialog: Dialog, deadline_timestamp: Optional[float] = None, schedule=None,
+                 hold_flush: bool = False, event=None, **kwargs) -> None:
+        self.dialog = dialog
+        self.deadline_timestamp = deadline_timestamp
+        self.schedule = schedule
+        self.hold_flush = hold_flush
+        self.event = event
+        self.timeout_response_task = None
+        self.service_status = bytearray()
+        self.pending_counts = []
+        self.tasks = {}
+        self.extra = kwargs
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return getattr(self, key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return super().get(key, default)
+        return self.extra.get(key, default)
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self.extra
+
+    def ensure_service(self, service_index: int) -> None:
+        missing = service_index + 1 - len(self.service_status)
+        if missing > 0:
+            self.service_status.extend(bytes(missing))
+            self.pending_counts.extend([0] * missing)
+
 
 class WorkflowManager:
     def __init__(self):
-        self.tasks = defaultdict(dict)
-        self.workflow_records = defaultdict(dict)
+        self.tasks = {}
+        self.workflow_records = {}
+        self._service_indexes = {}
+        self._service_names = []
+
+    def _get_service_index(self, service: Service) -> int:
+        service_index = self._service_indexes.get(service.name)
+        if service_index is None:
+            service_index = len(self._service_names)
+            self._service_indexes[service.name] = service_index
+            self._service_names.append(service.name)
+        return service_index
 
     def add_workflow_record(self, dialog: Dialog, deadline_timestamp: Optional[float] = None, **kwargs) -> None:
-        if str(dialog.id) in self.workflow_records.keys():
+        if str(dialog.id) in self.workflow_records:
             raise ValueError(f'dialog with id {dialog.id} is already in workflow')
-        workflow_record = {'dialog': dialog, 'services': defaultdict(dict), 'tasks': dict()}
-        if deadline_timestamp:
-            workflow_record['deadline_timestamp'] = deadline_timestamp
-        workflow_record.update(kwargs)
-        self.workflow_records[str(dialog.id)] = workflow_record
+        self.workflow_records[str(dialog.id)] = WorkflowRecord(dialog, deadline_timestamp, **kwargs)
 
-    def get_workflow_record(self, dialog_id):
-        workflow_record = self.workflow_records.get(dialog_id, None)
-        if workflow_record:
-            return workflow_record
-        return None
+    def get_workflow_record(self, dialog_id) -> Optional[WorkflowRecord]:
+        return self.workflow_records.get(dialog_id, None)
 
     def get_dialog_by_id(self, dialog_id: str) -> Dialog:
         workflow_record = self.workflow_records.get(dialog_id, None)
         if workflow_record:
-            return workflow_record['dialog']
+            return workflow_record.dialog
         return None
 
     def add_task(self, dialog_id: str, service: Service, payload: Dict, ind: int) -> str:
@@ -38,41 +132,53 @@ class WorkflowManager:
         if not workflow_record:
             return None
         task_id = uuid4().hex
-        task_data = {'service': service, 'payload': payload, 'dialog': dialog_id, 'ind': ind}
-        if service.name not in workflow_record['services']:
-            workflow_record['services'][service.name] = {'pending_tasks': set(), 'done': False, 'skipped': False}
-        workflow_record['services'][service.name][task_id] = {
-            'send': True, 'done': False, 'error': False,
-            'agent_send_time': time(), 'agent_done_time': None
-        }
-
-        workflow_record['services'][service.name]['pending_tasks'].add(task_id)
-        workflow_record['tasks'][task_id] = {'task_data': task_data, 'task_object': None}
-        self.tasks[task_id] = task_data
+        service_index = self._get_service_index(service)
+        workflow_record.ensure_service(service_index)
+        if workflow_record.service_status[service_index] == NOT_STARTED:
+            workflow_record.service_status[service_index] = WAITING
+        workflow_record.pending_counts[service_index] += 1
+
+        task = TaskRecord(service, service_index, payload, dialog_id, ind)
+        workflow_record.tasks[task_id] = task
+        self.tasks[task_id] = task
         return task_id
 
+    def get_task(self, task_id: str) -> Optional[TaskRecord]:
+        return self.tasks.get(task_id)
+
     def set_task_object(self, dialog_id, task_id, task_object):
         workflow_record = self.workflow_records.get(dialog_id, None)
-        if workflow_record and task_id in workflow_record['tasks']:
-            workflow_record['tasks'][task_id]['task_object'] = task_object
+        if workflow_record and task_id in workflow_record.tasks:
+            workflow_record.tasks[task_id].task_object = task_object
+
+    def set_task_timer(self, dialog_id, task_id, timer):
+        workflow_record = self.workflow_records.get(dialog_id, None)
+        if workflow_record and task_id in workflow_record.tasks:
+            workflow_record.tasks[task_id].timer = timer
 
     def set_timeout_response_task(self, dialog_id, task_object):
         workflow_record = self.workflow_records.get(dialog_id, None)
         if workflow_record:
-            workflow_record['timeout_response_task'] = task_object
+            workflow_record.timeout_response_task = task_object
 
-    def get_pending_tasks(self, dialog_id):
+    def get_pending_tasks(self, dialog_id) -> Dict[str, TaskRecord]:
         workflow_record = self.workflow_records.get(dialog_id, None)
         if workflow_record:
-            return workflow_record['tasks']
+            return workflow_record.tasks
+
+    def has_pending_tasks(self, dialog_id: str, service: Service) -> bool:
+        workflow_record = self.workflow_records.get(dialog_id, None)
+        service_index = self._service_indexes.get(service.name)
+        if workflow_record and service_index is not None and service_index < len(workflow_record.pending_counts):
+            return workflow_record.pending_counts[service_index] > 0
+        return False
 
     def skip_service(self, dialog_id: str, service: Service) -> None:
         workflow_record = self.workflow_records.get(dialog_id, None)
         if workflow_record:
-            if service in workflow_record['services']:
-                workflow_record['services'][service.name]['skipped'] = True
-            else:
-                workflow_record['services'][service.name] = {'pending_tasks': set(), 'done': False, 'skipped': True}
+            service_index = self._get_service_index(service)
+            workflow_record.ensure_service(service_index)
+            workflow_record.service_status[service_index] = SKIPPED
 
     def get_services_status(self, dialog_id: str) -> List:
         done = set()
@@ -80,13 +186,16 @@ class WorkflowManager:
         skipped = set()
         workflow_record = self.workflow_records.get(dialog_id, None)
         if workflow_record:
-            for k, v in workflow_record['services'].items():
-                if v['skipped'] or v.get('error', False):
-                    skipped.add(k)
-                elif v['done']:
-                    done.add(k)
+            for service_index, status in enumerate(workflow_record.service_status):
+                if status == NOT_STARTED:
+                    continue
+                service_name = self._service_names[service_index]
+                if status in (SKIPPED, ERROR):
+                    skipped.add(service_name)
+                elif status == DONE:
+                    done.add(service_name)
                 else:
-                    waiting.add(k)
+                    waiting.add(service_name)
         return done, waiting, skipped
 
     def complete_task(self, task_id, response, **kwargs) -> Dict:
@@ -94,31 +203,29 @@ class WorkflowManager:
         if not task:
             return None, None
 
-        workflow_record = self.workflow_records.get(task['dialog'], None)
+        if task.timer:
+            task.timer.cancel()
+        task.done_time = time()
+        task.error = isinstance(response, Exception)
+        workflow_record = self.workflow_records.get(task.dialog, None)
         if not workflow_record:
-            return None, task
-
-        workflow_record['tasks'].pop(task_id, None)
-        workflow_record['services'][task['service'].name]['pending_tasks'].discard(task_id)
-
-        if not workflow_record['services'][task['service'].name]['pending_tasks']:
-            workflow_record['services'][task['service'].name]['done'] = True
-        workflow_record['services'][task['service'].name][task_id]['agent_done_time'] = time()
-
-        if isinstance(response, Exception):
-            workflow_record['services'][task['service'].name][task_id]['error'] = True
-            if not workflow_record['services'][task['service'].name]['pending_tasks']:
-                workflow_record['services'][task['service'].name]['error'] = True
-        else:
-            workflow_record['services'][task['service'].name][task_id]['done'] = True
-        workflow_record['services'][task['service'].name][task_id].update(**kwargs)
+            # late response for a flushed workflow record
+            return task.workflow_record, task
+
+        workflow_record.tasks.pop(task_id, None)
+        service_index = task.service_index
+        workflow_record.pending_counts[service_index] -= 1
+        if not workflow_record.pending_counts[service_index] \
+                and workflow_record.service_status[service_index] != SKIPPED:
+            workflow_record.service_status[service_index] = ERROR if task.error else DONE
         return workflow_record, task
 
-    def flush_record(self, dialog_id: str) -> Dict:
+    def flush_record(self, dialog_id: str) -> WorkflowRecord:
         workflow_record = self.workflow_records.pop(dialog_id, None)
         if not workflow_record:
             return None
-        for i in workflow_record.pop('tasks', {}).keys():
-            self.tasks[i]['workflow_record'] = workflow_record
+        for task in workflow_record.tasks.values():
+            task.workflow_record = workflow_record
+        workflow_record.tasks = {}
 
         return workflow_record
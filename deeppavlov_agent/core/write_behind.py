@@ -0,0 +1,78 @@
+import asyncio
+from collections import OrderedDict
+from logging import getLogger
+from typing import Awaitable, Callable, Optional
+
+from .state_schema import Dialog
+
+logger = getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Persists dialogs in background, so the response can be sent before the dialog is saved.
+
+    Dialogs are keyed by user external id: several saves of the same dialog, which are waiting in the queue,
+    are coalesced into one. Saves are flushed in batches by a single worker, so the same dialog is never
+    saved concurrently. ``put`` waits while the queue holds ``max_size`` dialogs.
+    """
+    def __init__(self, save_func: Callable[[Dialog], Awaitable], max_size: int = 1000, batch_size: int = 50) -> None:
+        self._save_func = save_func
+        self._max_size = max_size
+        self._batch_size = batch_size
+        self._pending = OrderedDict()
+        self._saving = {}
+        self._worker = None
+        self._has_pending = None
+        self._has_space = None
+        self._idle = None
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._has_pending = self._has_pending or asyncio.Event()
+            self._has_space = self._has_space or asyncio.Event()
+            self._idle = self._idle or asyncio.Event()
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def put(self, dialog: Dialog) -> None:
+        self._ensure_worker()
+        key = dialog.human.external_id
+        while key not in self._pending and len(self._pending) >= self._max_size:
+            self._has_space.clear()
+            await self._has_space.wait()
+        self._pending[key] = dialog
+        self._idle.clear()
+        self._has_pending.set()
+
+    def get_pending(self, user_external_id: str) -> Optional[Dialog]:
+        return self._pending.get(user_external_id) or self._saving.get(user_external_id)
+
+    def __len__(self):
+        return len(self._pending) + len(self._saving)
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_pending.wait()
+            while self._pending:
+                batch = [self._pending.popitem(last=False) for _ in range(min(self._batch_size, len(self._pending)))]
+                self._saving.update(batch)
+                self._has_space.set()
+                results = await asyncio.gather(*[self._save_func(dialog) for _, dialog in batch],
+                                               return_exceptions=True)
+                for (key, dialog), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        logger.error(f'Failed to save dialog {dialog.id}', exc_info=result)
+                    if self._saving.get(key) is dialog:
+                        del self._saving[key]
+            self._has_pending.clear()
+            self._idle.set()
+
+    async def flush(self) -> None:
+        if self._pending or self._saving:
+            self._ensure_worker()
+            await self._idle.wait()
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
@@ -25,10 +25,12 @@ async def init_app(agent, session, consumers, logger_stats, output_formatter,
     pages = PagesHandler(debug)
     stats = WSstatsHandler()
     chat = WSChatHandler(output_formatter)
-    consumers = [asyncio.ensure_future(i.call_service(agent.process)) for i in consumers]
+    workers = consumers
+    consumers = [asyncio.ensure_future(i.call_service(agent.process)) for i in workers]
 
     async def on_startup(app):
         app['consumers'] = consumers
+        app['workers'] = workers
         app['agent'] = agent
         app['client_session'] = session
         app['websockets'] = []
@@ -36,6 +38,7 @@ async def init_app(agent, session, consumers, logger_stats, output_formatter,
         asyncio.ensure_future(agent.state_manager.prepare_db())
 
     async def on_shutdown(app):
+        await app['agent'].state_manager.close()
         for c in app['consumers']:
             c.cancel()
         if app['client_session']:
@@ -46,6 +49,7 @@ async def init_app(agent, session, consumers, logger_stats, output_formatter,
 
     app.router.add_post('', handler.handle_api_request)
     app.router.add_options('', handler.options)
+    app.router.add_get('/api/dialogs/export', handler.dialogs_export)
     app.router.add_get('/api/dialogs/{dialog_id}', handler.dialog)
     app.router.add_get('/api/user/{user_external_id}', handler.dialogs_by_user)
     app.router.add_get('/ping', pages.ping)
@@ -60,6 +64,7 @@ async def init_app(agent, session, consumers, logger_stats, output_formatter,
     app.router.add_options('/rating/dialog', handler.options)
     app.router.add_post('/rating/utterance', handler.utterance_rating)
     app.router.add_options('/rating/utterance', handler.options)
+    app.router.add_post('/api/flush', handler.flush)
 
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from itertools import count
+from logging import getLogger
+from typing import List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from ..core.sharding import HashRing
+
+logger = getLogger(__name__)
+
+# headers, which are set by the proxy connections themselves
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'content-encoding',
+                      'host', 'upgrade'}
+
+
+def _filter_headers(headers) -> dict:
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+
+
+def _get_user_id(body: bytes) -> Optional[str]:
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data.get('user_id') if isinstance(data, dict) else None
+
+
+class Dispatcher:
+    """Proxies requests of the http api to agent worker processes, which listen on unix sockets.
+
+    Messages and ratings of a user, both http and websocket ones, are always proxied to the same
+    worker, which is chosen by a consistent hash of ``user_id``, so a dialog is processed by a single
+    agent. Requests without a user are distributed among the workers in turn. Dialogs of any user are
+    read and rated without a user only after all workers have saved their queued dialogs, and have
+    dropped the rated dialog from their caches.
+    """
+    def __init__(self, socket_paths: List[str], startup_timeout: float = 300) -> None:
+        self.socket_paths = socket_paths
+        self.startup_timeout = startup_timeout
+        self.ring = HashRing(len(socket_paths))
+        self.sessions = []
+        self._next_worker = count()
+
+    def get_worker(self, user_id: Optional[str] = None) -> int:
+        if user_id is None:
+            return next(self._next_worker) % len(self.socket_paths)
+        return self.ring.get_shard(str(user_id))
+
+    async def on_startup(self, app: web.Application) -> None:
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.startup_timeout
+        # sockets are created by workers after their startup is finished
+        while not all(os.path.exists(path) for path in self.socket_paths):
+            if loop.time() > deadline:
+                raise RuntimeError(f'agent workers have not started in {self.startup_timeout} seconds')
+            await asyncio.sleep(0.1)
+        self.sessions = [aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=path),
+                                               timeout=aiohttp.ClientTimeout(total=None))
+                         for path in self.socket_paths]
+        logger.info(f'{len(self.socket_paths)} agent workers are ready')
+
+    async def on_cleanup(self, app: web.Application) -> None:
+        await asyncio.gather(*[session.close() for session in self.sessions])
+
+    async def proxy(self, request: web.Request, worker: int, body: bytes = None) -> web.StreamResponse:
+        if body is None:
+            body = await request.read()
+        async with self.sessions[worker].request(request.method, f'http://worker{request.rel_url}',
+                                                 headers=_filter_headers(request.headers), data=body) as resp:
+            response = web.StreamResponse(status=resp.status, reason=resp.reason,
+                                          headers=_filter_headers(resp.headers))
+            await response.prepare(request)
+            async for chunk in resp.content.iter_any():
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+
+    async def flush_workers(self, body: bytes = b'') -> None:
+        async def flush(session: aiohttp.ClientSession) -> None:
+            async with session.post('http://worker/api/flush', data=body,
+                                    headers={'Content-Type': 'application/json'}) as resp:
+                resp.raise_for_status()
+
+        await asyncio.gather(*[flush(session) for session in self.sessions])
+
+    async def handle_user_request(self, request: web.Request) -> web.StreamResponse:
+        body = await request.read()
+        return await self.proxy(request, self.get_worker(_get_user_id(body)), body)
+
+    async def handle_rating_request(self, request: web.Request) -> web.StreamResponse:
+        body = await request.read()
+        user_id = _get_user_id(body)
+        if user_id is None:
+            # the worker, which holds the rated dialog, is unknown
+            await self.flush_workers(body)
+        return await self.proxy(request, self.get_worker(user_id), body)
+
+    async def handle_dialogs_request(self, request: web.Request) -> web.StreamResponse:
+        await self.flush_workers()
+        return await self.proxy(request, self.get_worker())
+
+    async def handle_user_path_request(self, request: web.Request) -> web.StreamResponse:
+        return await self.proxy(request, self.get_worker(request.match_info['user_external_id']))
+
+    async def handle_request(self, request: web.Request) -> web.StreamResponse:
+        return await self.proxy(request, self.get_worker())
+
+    async def handle_chat_ws(self, request: web.Request) -> web.WebSocketResponse:
+        """Proxies each chat message to the worker of its user, the worker connections are opened on demand."""
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        worker_connections = {}
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.text:
+                    break
+                worker = self.get_worker(_get_user_id(msg.data.encode('utf-8')))
+                if worker not in worker_connections:
+                    worker_connections[worker] = await self.sessions[worker].ws_connect(
+                        f'http://worker{request.rel_url}')
+                worker_ws = worker_connections[worker]
+                await worker_ws.send_str(msg.data)
+                reply = await worker_ws.receive()
+                if reply.type != aiohttp.WSMsgType.text:
+                    break
+                await ws.send_str(reply.data)
+        finally:
+            for worker_ws in worker_connections.values():
+                await worker_ws.close()
+        return ws
+
+    async def handle_stats_ws(self, request: web.Request) -> web.WebSocketResponse:
+        """Proxies load stats of the worker, which is set by ``worker`` query parameter (0 by default)."""
+        try:
+            worker = int(request.query.get('worker', 0))
+        except ValueError:
+            raise web.HTTPBadRequest(reason='worker should be an integer')
+        if worker not in range(len(self.socket_paths)):
+            raise web.HTTPBadRequest(reason=f'worker should be less than {len(self.socket_paths)}')
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async with self.sessions[worker].ws_connect(f'http://worker{request.path}') as worker_ws:
+            async for msg in worker_ws:
+                if msg.type != aiohttp.WSMsgType.text or ws.closed:
+                    break
+                await ws.send_str(msg.data)
+        return ws
+
+
+def init_dispatcher_app(socket_paths: List[str]) -> web.Application:
+    dispatcher = Dispatcher(socket_paths)
+    app = web.Application()
+    app['dispatcher'] = dispatcher
+    app.on_startup.append(dispatcher.on_startup)
+    app.on_cleanup.append(dispatcher.on_cleanup)
+    app.router.add_post('', dispatcher.handle_user_request)
+    app.router.add_post('/rating/dialog', dispatcher.handle_rating_request)
+    app.router.add_post('/rating/utterance', dispatcher.handle_rating_request)
+    app.router.add_get('/api/user/{user_external_id}', dispatcher.handle_user_path_request)
+    # both a single dialog and the export
+    app.router.add_get('/api/dialogs/{dialog_id}', dispatcher.handle_dialogs_request)
+    app.router.add_get('/chat/ws', dispatcher.handle_chat_ws)
+    app.router.add_get('/debug/current_load/ws', dispatcher.handle_stats_ws)
+    app.router.add_route('*', '/{tail:.*}', dispatcher.handle_request)
+    return app
+
+
+def run_worker(socket_path: str, pipeline_configs=None, debug=None, time_limit=None, cors=None) -> None:
+    from . import app_factory
+
+    app = app_factory(pipeline_configs=pipeline_configs, debug=debug, response_time_limit=time_limit, cors=cors)
+    web.run_app(app, path=socket_path, print=None)
+
+
+def run_http_workers(port, workers: int, pipeline_configs=None, debug=None, time_limit=None, cors=None) -> None:
+    """Runs ``workers`` agent processes behind a dispatcher, which listens on the port."""
+    socket_dir = tempfile.mkdtemp(prefix='dp_agent_')
+    socket_paths = [os.path.join(socket_dir, f'worker_{i}.sock') for i in range(workers)]
+    # spawned processes don't inherit state of the dispatcher, e.g. its event loop
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(path, pipeline_configs, debug, time_limit, cors),
+                                 name=f'dp_agent_worker_{i}', daemon=True)
+                 for i, path in enumerate(socket_paths)]
+    for process in processes:
+        process.start()
+    try:
+        web.run_app(init_dispatcher_app(socket_paths), port=port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        shutil.rmtree(socket_dir, ignore_errors=True)
@@ -1,4 +1,5 @@
 import asyncio
+import json
 from datetime import datetime
 from string import hexdigits
 from time import time
@@ -7,6 +8,8 @@ import aiohttp
 import aiohttp_jinja2
 from aiohttp import web
 
+from ..core.admission import AdmissionRejected
+
 
 async def handle_command(payload, user_id, state_manager):
     if payload in {'/start', '/close'} and state_manager:
@@ -42,15 +45,18 @@ class ApiHandler:
             if command_performed:
                 return web.json_response({})
 
-            response = await asyncio.shield(
-                register_msg(utterance=payload, user_external_id=user_id,
-                             user_device_type=data.pop('user_device_type', 'http'),
-                             date_time=datetime.now(),
-                             location=data.pop('location', ''),
-                             channel_type='http_client',
-                             message_attrs=data, require_response=True,
-                             deadline_timestamp=deadline_timestamp)
-            )
+            try:
+                response = await asyncio.shield(
+                    register_msg(utterance=payload, user_external_id=user_id,
+                                 user_device_type=data.pop('user_device_type', 'http'),
+                                 date_time=datetime.now(),
+                                 location=data.pop('location', ''),
+                                 channel_type='http_client',
+                                 message_attrs=data, require_response=True,
+                                 deadline_timestamp=deadline_timestamp)
+                )
+            except AdmissionRejected as e:
+                raise web.HTTPTooManyRequests(reason=str(e))
 
             if response is None:
                 raise RuntimeError('Got None instead of a bot response.')
@@ -67,6 +73,20 @@ class ApiHandler:
             return web.json_response(dialog_obj.to_dict())
         raise web.HTTPBadRequest(reason='dialog id should be 24-character hex string')
 
+    async def dialogs_export(self, request):
+        state_manager = request.app['agent'].state_manager
+        try:
+            date_from, date_to = [datetime.fromisoformat(request.query[k]) if k in request.query else None
+                                  for k in ('from', 'to')]
+        except ValueError:
+            raise web.HTTPBadRequest(reason='from and to should be dates in ISO 8601 format')
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        async for dialog in state_manager.iter_dialogs(date_from, date_to):
+            await response.write((json.dumps(dialog.to_dict(), default=str) + '\n').encode('utf-8'))
+        await response.write_eof()
+        return response
+
     async def dialogs_by_user(self, request):
         state_manager = request.app['agent'].state_manager
         user_external_id = request.match_info['user_external_id']
@@ -91,6 +111,12 @@ class ApiHandler:
         await state_manager.set_rating_utterance(user_id, utt_id, rating)
         return web.Response()
 
+    async def flush(self, request):
+        state_manager = request.app['agent'].state_manager
+        data = await request.json() if request.can_read_body else {}
+        await state_manager.flush_dialog(data.get('dialog_id'), data.get('utt_id'))
+        return web.Response()
+
     async def options(self, request):
         return web.Response(headers={'Access-Control-Allow-Methods': 'POST, OPTIONS'})
 
@@ -119,8 +145,24 @@ class WSstatsHandler:
         await ws.prepare(request)
         request.app['websockets'].append(ws)
         logger_stats = request.app['logger_stats']
+        state_manager = request.app['agent'].state_manager
         while True:
             data = dict(logger_stats.get_current_load())
+            cache_stats = state_manager.get_cache_stats()
+            if cache_stats is not None:
+                data['dialog_cache'] = cache_stats
+            batch_stats = {w.batch_stats for w in request.app['workers'] if getattr(w, 'batch_stats', None)}
+            if batch_stats:
+                data['batching'] = {s.name: s.get_stats() for s in batch_stats}
+            routers = {w.router for w in request.app['workers'] if getattr(w, 'router', None)}
+            if routers:
+                data['replicas'] = {r.name: r.get_stats() for r in routers}
+            if request.app['client_session']:
+                data['http_sessions'] = request.app['client_session'].get_stats()
+            if request.app['agent'].user_admission:
+                data['user_admission'] = request.app['agent'].user_admission.get_stats()
+            if request.app['agent'].admission_controller:
+                data['admission_control'] = request.app['agent'].admission_controller.get_stats()
             await ws.send_json(data)
             await asyncio.sleep(self.update_time)
 
@@ -156,15 +198,19 @@ class WSChatHandler:
                     await ws.send_json('command_performed')
                     continue
 
-                response = await register_msg(
-                    utterance=payload, user_external_id=user_id,
-                    user_device_type=data.pop('user_device_type', 'websocket'),
-                    date_time=datetime.now(),
-                    location=data.pop('location', ''),
-                    channel_type='ws_client',
-                    message_attrs=data, require_response=True,
-                    deadline_timestamp=deadline_timestamp
-                )
+                try:
+                    response = await register_msg(
+                        utterance=payload, user_external_id=user_id,
+                        user_device_type=data.pop('user_device_type', 'websocket'),
+                        date_time=datetime.now(),
+                        location=data.pop('location', ''),
+                        channel_type='ws_client',
+                        message_attrs=data, require_response=True,
+                        deadline_timestamp=deadline_timestamp
+                    )
+                except AdmissionRejected as e:
+                    await ws.send_json({'error': str(e)})
+                    continue
                 if response is None:
                     raise RuntimeError('Got None instead of a bot response.')
                 await ws.send_json(self.output_formatter(response['dialog'].to_dict()))
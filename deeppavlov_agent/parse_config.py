@@ -1,14 +1,17 @@
 import asyncio
 from collections import defaultdict
+from functools import partial
 from importlib import import_module
 from typing import Dict
 
-import aiohttp
-
+from .core.batching import BatchStats, make_batch_controller
+from .core.codecs import get_codec
 from .core.connectors import (AgentGatewayToServiceConnector,
                               AioQueueConnector, HTTPConnector,
                               QueueListenerBatchifyer, PredefinedOutputConnector,
                               PredefinedTextConnector, ConfidenceResponseSelectorConnector)
+from .core.http_session import ClientSessionPool
+from .core.routing import ReplicaRouter
 from .core.service import Service, simple_workflow_formatter
 from .core.state_manager import StateManager
 from .core.transport.mapping import GATEWAYS_MAP
@@ -33,7 +36,7 @@ class PipelineConfigParser:
         self.timeout_service = None
         self.connectors = {}
         self.workers = []
-        self.session = None
+        self.sessions = ClientSessionPool(self.config.get('session'))
         self.gateway = None
         self.imported_modules = {}
 
@@ -59,16 +62,16 @@ class PipelineConfigParser:
             module = import_module(connectors_module_name)
         return module
 
-    def get_session(self):
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-        return self.session
+    def get_session(self, name: str = None, config: Dict = None):
+        return self.sessions.get_session(name, config)
 
     def get_gateway(self, on_channel_callback=None, on_service_callback=None):
         if not self.gateway:
             transport_type = TRANSPORT_SETTINGS['transport']['type']
             gateway_cls = GATEWAYS_MAP[transport_type]['agent']
-            self.gateway = gateway_cls(config=TRANSPORT_SETTINGS,
+            # top level transport settings, e.g. agent_shard_id, can be overridden in the pipeline config
+            transport_settings = {**TRANSPORT_SETTINGS, **self.config.get('transport_settings', {})}
+            self.gateway = gateway_cls(config=transport_settings,
                                        on_service_callback=on_service_callback,
                                        on_channel_callback=on_channel_callback)
         return self.gateway
@@ -86,15 +89,38 @@ class PipelineConfigParser:
         if data['protocol'] == 'http':
             connector = None
             workers = []
-            if 'urllist' in data or 'num_workers' in data or data.get('batch_size', 1) > 1:
+            session = self.get_session(name, data.get('session'))
+            codec = get_codec(data.get('codec'))
+            if 'urllist' in data or 'num_workers' in data or 'max_in_flight' in data \
+                    or data.get('batch_size', 1) > 1:
                 queue = asyncio.Queue()
                 batch_size = data.get('batch_size', 1)
-                urllist = data.get('urllist', [data['url']] * data.get('num_workers', 1))
+                max_wait_ms = data.get('max_wait_ms', 0)
+                if isinstance(max_wait_ms, bool) or not isinstance(max_wait_ms, (int, float)) or max_wait_ms < 0:
+                    raise ValueError(f'max_wait_ms of {name} connector should be a non-negative number, '
+                                     f'got {max_wait_ms!r}')
+                max_in_flight = data.get('max_in_flight', 1)
+                if isinstance(max_in_flight, bool) or not isinstance(max_in_flight, int) or max_in_flight < 1:
+                    raise ValueError(f'max_in_flight of {name} connector should be a positive integer, '
+                                     f'got {max_in_flight!r}')
+                retries = data.get('retries', 0)
+                if isinstance(retries, bool) or not isinstance(retries, int) or retries < 0:
+                    raise ValueError(f'retries of {name} connector should be a non-negative integer, got {retries!r}')
+                urllist = data['urllist'] if 'urllist' in data else [data['url']] * data.get('num_workers', 1)
+                router = None
+                if 'urllist' in data and data.get('routing', 'least_outstanding') != 'none':
+                    router = ReplicaRouter(urllist, data.get('routing', 'least_outstanding'),
+                                           data.get('failure_threshold', 3), data.get('recovery_time', 10), name)
                 connector = AioQueueConnector(queue)
+                batch_stats = BatchStats(name)
                 for url in urllist:
-                    workers.append(QueueListenerBatchifyer(self.get_session(), url, queue, batch_size))
+                    workers.append(QueueListenerBatchifyer(
+                        session, url, queue, batch_size, max_wait_ms=max_wait_ms, batch_stats=batch_stats,
+                        batch_controller=make_batch_controller(data), max_in_flight=max_in_flight, router=router,
+                        retries=retries, retry_backoff_ms=data.get('retry_backoff_ms', 100), codec=codec))
             else:
-                connector = HTTPConnector(self.get_session(), data['url'])
+                connector = HTTPConnector(session, data['url'], data.get('hedge_urls'),
+                                          data.get('hedge_delay_ms', 100), codec)
 
         elif data['protocol'] == 'AMQP':
             gateway = self.get_gateway()
@@ -140,8 +166,17 @@ class PipelineConfigParser:
         service_name = ".".join([i for i in [group, name] if i])
         if 'workflow_formatter' in data and not data['workflow_formatter']:
             workflow_formatter = None
+        elif data.get('history_window') is not None:
+            history_window = data['history_window']
+            if isinstance(history_window, bool) or not isinstance(history_window, int) or history_window < 1:
+                raise ValueError(f'history_window in pipeline.{service_name} should be a positive integer, '
+                                 f'got {history_window!r}')
+            workflow_formatter = partial(simple_workflow_formatter, history_window=history_window)
         else:
             workflow_formatter = simple_workflow_formatter
+        timeout = data.get('timeout')
+        if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+            raise ValueError(f'timeout in pipeline.{service_name} should be a positive number')
         connector = None
         if isinstance(connector_data, str):
             connector = self.connectors.get(connector_data, None)
@@ -190,7 +225,7 @@ class PipelineConfigParser:
             names_previous_services=names_previous_services,
             names_required_previous_services=names_required_previous_services,
             workflow_formatter=workflow_formatter, dialog_formatter=dialog_formatter,
-            response_formatter=response_formatter, label=name)
+            response_formatter=response_formatter, label=name, timeout=timeout)
         if service.is_last_chance():
             self.last_chance_service = service
         elif service.is_timeout():
@@ -16,12 +16,14 @@ def main():
                         action='store_true', default=None)
     parser.add_argument('-d', '--debug', help='run in debug mode', action='store_true')
     parser.add_argument('-tl', '--time_limit', help='response time limit, 0 = no limit', type=int, default=0)
+    parser.add_argument('-w', '--workers', help='number of agent processes for http_client, default 1', type=int,
+                        default=1)
     args = parser.parse_args()
 
     if args.channel == 'cmd_client':
         run_cmd(args.pipeline_configs, args.debug)
     elif args.channel == 'http_client':
-        run_http(args.port, args.pipeline_configs, args.debug, args.time_limit, args.cors)
+        run_http(args.port, args.pipeline_configs, args.debug, args.time_limit, args.cors, args.workers)
     elif args.channel == 'telegram':
         run_telegram(args.pipeline_configs)
 
@@ -3,10 +3,18 @@ import argparse
 from aiohttp import web
 
 from .http_api import app_factory
+from .http_api.dispatcher import run_http_workers
 from .settings import PORT
+from .setup_agent import load_db_config
 
 
-def run_http(port, pipeline_configs=None, debug=None, time_limit=None, cors=None):
+def run_http(port, pipeline_configs=None, debug=None, time_limit=None, cors=None, workers=1):
+    if workers > 1:
+        # each agent process would have its own in-memory storage, and dialogs wouldn't be found by other ones
+        if load_db_config().get('backend') == 'memory':
+            raise ValueError('several agent processes require a shared database, memory backend can not be used')
+        run_http_workers(port, workers, pipeline_configs, debug, time_limit, cors)
+        return
     app = app_factory(pipeline_configs=pipeline_configs, debug=debug, response_time_limit=time_limit, cors=cors)
     web.run_app(app, port=port)
 
@@ -18,7 +26,8 @@ if __name__ == '__main__':
                         type=str, action='append')
     parser.add_argument('-d', '--debug', help='run in debug mode', action='store_true')
     parser.add_argument('-tl', '--time_limit', help='response time limit, 0 = no limit', type=int)
+    parser.add_argument('-w', '--workers', help='number of agent processes, default 1', type=int, default=1)
     args = parser.parse_args()
 
     port = args.port or PORT
-    run_http(port, args.pipeline_configs, args.debug, args.time_limit)
+    run_http(port, args.pipeline_configs, args.debug, args.time_limit, workers=args.workers)
@@ -15,12 +15,23 @@ BASE_PARAMETERS = {
     'db_class': DataBase,
     'pipeline_config': 'pipeline_conf.json',
     'db_config': 'db_conf.json',
+    'dialog_history_depth': None,
+    'dialog_cache_size': 0,
+    'dialog_cache_ttl': 300,
+    'db_bulk_write': False,
+    'write_behind_queue_size': 0,
+    'write_behind_batch_size': 50,
     'overwrite_last_chance': None,
     'overwrite_timeout': None,
     'formatters_module': None,
     'connectors_module': None,
     'response_logger': True,
     'time_limit': 0,
+    'concurrent_messages_policy': False,
+    'max_queued_messages': 10,
+    'max_concurrent_workflows': 0,
+    'max_queued_workflows': 100,
+    'overload_response': 'Sorry, I am overloaded at the moment. Please, try again a bit later.',
     'output_formatter': http_api_output_formatter,
     'debug_output_formatter': http_debug_output_formatter,
     'port': 4242,
@@ -56,12 +67,36 @@ DB_CLASS = DataBase
 
 PIPELINE_CONFIG = setup_parameter('pipeline_config', user_settings)
 DB_CONFIG = setup_parameter('db_config', user_settings)
+# Number of last human and bot utterances loaded with a dialog, None loads the whole dialog
+DIALOG_HISTORY_DEPTH = setup_parameter('dialog_history_depth', user_settings)  # Load whole dialog by default
+
+# In-memory cache of recently active dialogs, should be used only with a single agent process per database
+DIALOG_CACHE_SIZE = setup_parameter('dialog_cache_size', user_settings)  # Disabled by default
+DIALOG_CACHE_TTL = setup_parameter('dialog_cache_ttl', user_settings)
+
+# Save dialog with concurrent bulk writes instead of one write per document
+DB_BULK_WRITE = setup_parameter('db_bulk_write', user_settings)
+
+# Save dialogs in background after the response is sent, queue size limits number of unsaved dialogs
+WRITE_BEHIND_QUEUE_SIZE = setup_parameter('write_behind_queue_size', user_settings)  # Disabled by default
+WRITE_BEHIND_BATCH_SIZE = setup_parameter('write_behind_batch_size', user_settings)
 
 OVERWRITE_LAST_CHANCE = setup_parameter('overwrite_last_chance', user_settings)
 OVERWRITE_TIMEOUT = setup_parameter('overwrite_timeout', user_settings)
 
 RESPONSE_LOGGER = setup_parameter('response_logger', user_settings)
 
+# Handling of a message of a user, whose previous message is still being processed:
+# 'serialize', 'coalesce' or 'reject', False (default) keeps the previous behaviour of raising an error
+CONCURRENT_MESSAGES_POLICY = setup_parameter('concurrent_messages_policy', user_settings)
+MAX_QUEUED_MESSAGES = setup_parameter('max_queued_messages', user_settings)  # Per user
+
+# Admission control of all messages: workflows above the limit are queued, messages, which don't fit
+# into the queue or would miss their deadline, are answered with the overload response
+MAX_CONCURRENT_WORKFLOWS = setup_parameter('max_concurrent_workflows', user_settings)  # Unlimited by default
+MAX_QUEUED_WORKFLOWS = setup_parameter('max_queued_workflows', user_settings)
+OVERLOAD_RESPONSE = setup_parameter('overload_response', user_settings)
+
 # HTTP app configuraion parameters
 TIME_LIMIT = setup_parameter('time_limit', user_settings)  # Without engaging the timeout by default
 CORS = setup_parameter('cors', user_settings)
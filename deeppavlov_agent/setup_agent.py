@@ -3,12 +3,15 @@ import os
 
 import yaml
 
-from .settings import (DB_CLASS, DB_CONFIG, OVERWRITE_LAST_CHANCE,
-                       OVERWRITE_TIMEOUT, PIPELINE_CONFIG,
-                       RESPONSE_LOGGER, STATE_MANAGER_CLASS,
-                       WORKFLOW_MANAGER_CLASS)
+from .settings import (CONCURRENT_MESSAGES_POLICY, DB_BULK_WRITE, DB_CLASS, DB_CONFIG, DIALOG_CACHE_SIZE,
+                       DIALOG_CACHE_TTL, DIALOG_HISTORY_DEPTH, MAX_CONCURRENT_WORKFLOWS, MAX_QUEUED_MESSAGES,
+                       MAX_QUEUED_WORKFLOWS, OVERLOAD_RESPONSE, OVERWRITE_LAST_CHANCE, OVERWRITE_TIMEOUT,
+                       PIPELINE_CONFIG, RESPONSE_LOGGER, STATE_MANAGER_CLASS, WORKFLOW_MANAGER_CLASS,
+                       WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_QUEUE_SIZE)
+from .core.admission import AdmissionController, UserAdmission
 from .core.agent import Agent
 from .core.connectors import EventSetOutputConnector
+from .core.dialog_cache import LRUDialogCache
 from .core.log import LocalResponseLogger
 from .core.pipeline import Pipeline
 from .core.service import Service
@@ -26,7 +29,7 @@ def merge_two_configs(d1, d2):
             d1[k] = v
 
 
-def setup_agent(pipeline_configs=None):
+def load_db_config():
     with open(DB_CONFIG, 'r') as db_config:
         if DB_CONFIG.endswith('.json'):
             db_data = json.load(db_config)
@@ -38,10 +41,19 @@ def setup_agent(pipeline_configs=None):
     if db_data.pop('env', False):
         for k, v in db_data.items():
             db_data[k] = os.getenv(v)
+    return db_data
+
+
+def setup_agent(pipeline_configs=None):
+    db = DB_CLASS(**load_db_config())
 
-    db = DB_CLASS(**db_data)
+    dialog_cache = None
+    if DIALOG_CACHE_SIZE:
+        dialog_cache = LRUDialogCache(max_size=DIALOG_CACHE_SIZE, ttl=DIALOG_CACHE_TTL)
 
-    sm = STATE_MANAGER_CLASS(db.get_db())
+    sm = STATE_MANAGER_CLASS(db.get_db(), history_depth=DIALOG_HISTORY_DEPTH, dialog_cache=dialog_cache,
+                             bulk_save=DB_BULK_WRITE, write_behind_queue_size=WRITE_BEHIND_QUEUE_SIZE,
+                             write_behind_batch_size=WRITE_BEHIND_BATCH_SIZE)
     if pipeline_configs:
         pipeline_data = {}
         for name in pipeline_configs:
@@ -79,9 +91,19 @@ def setup_agent(pipeline_configs=None):
 
     response_logger = LocalResponseLogger(RESPONSE_LOGGER)
 
-    agent = Agent(pipeline, sm, WORKFLOW_MANAGER_CLASS(), response_logger=response_logger)
+    user_admission = None
+    if CONCURRENT_MESSAGES_POLICY:
+        user_admission = UserAdmission(CONCURRENT_MESSAGES_POLICY, MAX_QUEUED_MESSAGES)
+
+    admission_controller = None
+    if MAX_CONCURRENT_WORKFLOWS:
+        admission_controller = AdmissionController(MAX_CONCURRENT_WORKFLOWS, MAX_QUEUED_WORKFLOWS, OVERLOAD_RESPONSE,
+                                                   response_logger.get_response_time)
+
+    agent = Agent(pipeline, sm, WORKFLOW_MANAGER_CLASS(), response_logger=response_logger,
+                  user_admission=user_admission, admission_controller=admission_controller)
     if pipeline_config.gateway:
         pipeline_config.gateway.on_channel_callback = agent.register_msg
         pipeline_config.gateway.on_service_callback = agent.process
 
-    return agent, pipeline_config.session, pipeline_config.workers
+    return agent, pipeline_config.sessions, pipeline_config.workers
@@ -0,0 +1,12 @@
+import asyncio
+from uuid import uuid4
+
+from ..core.state_schema import Dialog, Human
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def make_dialog(external_id):
+    return Dialog(human=Human(external_id=external_id), channel_type='test', dialog_id=uuid4().hex)
@@ -0,0 +1,117 @@
+import asyncio
+import unittest
+from time import time
+
+from ..core.admission import AdmissionController, AdmissionRejected, UserAdmission
+from . import run
+
+
+class TestUserAdmission(unittest.TestCase):
+    def test_turns_are_admitted_in_order(self):
+        async def check():
+            admission = UserAdmission('serialize')
+            first, _ = admission.enqueue('user', 'a')
+            second, _ = admission.enqueue('user', 'b')
+            other, _ = admission.enqueue('other', 'c')
+            states = [first.admitted.done(), second.admitted.done(), other.admitted.done()]
+            admission.release('user')
+            states.append(second.admitted.done())
+            admission.release('user')
+            admission.release('other')
+            return states, admission.get_stats()
+
+        states, stats = run(check())
+        self.assertEqual([True, False, True, True], states)
+        self.assertEqual(0, stats['active_users'])
+
+    def test_queue_depth_cap(self):
+        async def check():
+            admission = UserAdmission('serialize', max_queued=2)
+            for utterance in 'abc':
+                admission.enqueue('user', utterance)
+            with self.assertRaises(AdmissionRejected):
+                admission.enqueue('user', 'd')
+            return admission.get_stats()
+
+        self.assertEqual({'policy': 'serialize', 'active_users': 1, 'queued': 2, 'rejected': 1, 'coalesced': 0},
+                         run(check()))
+
+    def test_cancelled_turn_is_skipped(self):
+        async def check():
+            admission = UserAdmission('serialize')
+            admission.enqueue('user', 'a')
+            second, _ = admission.enqueue('user', 'b')
+            third, _ = admission.enqueue('user', 'c')
+            second.admitted.cancel()
+            admission.release('user')
+            return third.admitted.done()
+
+        self.assertTrue(run(check()))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            UserAdmission('drop')
+
+
+class TestAdmissionController(unittest.TestCase):
+    def test_workflows_are_queued_over_limit(self):
+        async def check():
+            controller = AdmissionController(max_concurrent=1)
+            first = asyncio.ensure_future(controller.acquire())
+            second = asyncio.ensure_future(controller.acquire())
+            await asyncio.sleep(0)
+            states = [first.done(), second.done()]
+            controller.release()
+            await asyncio.sleep(0)
+            states.append(second.done())
+            return states, await first, await second, controller.get_stats()
+
+        states, first, second, stats = run(check())
+        self.assertEqual([True, False, True], states)
+        self.assertTrue(first and second)
+        self.assertEqual({'max_concurrent': 1, 'active': 1, 'queued': 0, 'shed': 0, 'shed_by_deadline': 0}, stats)
+
+    def test_shed_if_queue_is_full(self):
+        async def check():
+            controller = AdmissionController(max_concurrent=1, max_queued=1)
+            await controller.acquire()
+            queued = asyncio.ensure_future(controller.acquire())
+            await asyncio.sleep(0)
+            shed = await controller.acquire()
+            queued.cancel()
+            await asyncio.sleep(0)
+            return shed, controller.get_stats()
+
+        shed, stats = run(check())
+        self.assertFalse(shed)
+        self.assertEqual({'max_concurrent': 1, 'active': 1, 'queued': 0, 'shed': 1, 'shed_by_deadline': 0}, stats)
+
+    def test_shed_if_deadline_would_be_missed(self):
+        async def check():
+            controller = AdmissionController(max_concurrent=2, get_response_time=lambda: 1)
+            await controller.acquire(time() + 0.5)
+            await controller.acquire()
+            # two workflows are in progress, so a queued message completes in about two response times
+            shed = await controller.acquire(time() + 1.5)
+            queued = asyncio.ensure_future(controller.acquire(time() + 3))
+            await asyncio.sleep(0)
+            controller.release()
+            return shed, await queued, controller.get_stats()
+
+        shed, admitted, stats = run(check())
+        self.assertFalse(shed)
+        self.assertTrue(admitted)
+        self.assertEqual(1, stats['shed_by_deadline'])
+
+    def test_expired_message_is_shed_when_admitted(self):
+        async def check():
+            controller = AdmissionController(max_concurrent=1)
+            await controller.acquire()
+            queued = asyncio.ensure_future(controller.acquire(time() + 0.01))
+            await asyncio.sleep(0.02)
+            controller.release()
+            return await queued, controller.get_stats()
+
+        admitted, stats = run(check())
+        self.assertFalse(admitted)
+        self.assertEqual(0, stats['active'])
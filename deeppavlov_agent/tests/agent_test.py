@@ -0,0 +1,146 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from ..core.admission import AdmissionController, AdmissionRejected, UserAdmission
+from ..core.agent import Agent
+from ..core.connectors import EventSetOutputConnector
+from ..core.log import LocalResponseLogger
+from ..core.pipeline import Pipeline
+from ..core.service import Service
+from ..core.state_manager import StateManager
+from ..core.storage import MemoryStorage
+from ..core.workflow_manager import WorkflowManager
+from . import run
+
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self.state_manager = StateManager(MemoryStorage())
+        self.called = []
+
+    async def respond(self, payload, callback):
+        self.called.append(payload['task_id'])
+        await callback(task_id=payload['task_id'], response={'text': 'response'})
+
+    async def never_respond(self, payload, callback):
+        await asyncio.sleep(10)
+
+    async def respond_later(self, payload, callback):
+        await asyncio.sleep(0.02)
+        await self.respond(payload, callback)
+
+    def make_agent(self, services, user_admission=None, admission_controller=None):
+        input_service = Service('input', None, self.state_manager.add_human_utterance, tags=['input'])
+        responder = Service('responder', EventSetOutputConnector('responder').send, self.state_manager.save_dialog,
+                            tags=['responder'])
+        pipeline = Pipeline(services, input_service, responder, None, None)
+        return Agent(pipeline, self.state_manager, WorkflowManager(), LocalResponseLogger(False),
+                     user_admission=user_admission, admission_controller=admission_controller)
+
+    def send_concurrently(self, agent, utterances):
+        async def send():
+            messages = []
+            for utterance in utterances:
+                messages.append(asyncio.ensure_future(agent.register_msg(
+                    utterance, user_external_id='user', channel_type='test', require_response=True)))
+                await asyncio.sleep(0.005)
+            return await asyncio.wait_for(asyncio.gather(*messages, return_exceptions=True), 1)
+
+        return run(send())
+
+    def test_concurrent_messages_are_serialized(self):
+        agent = self.make_agent([Service('slow', self.respond_later)], UserAdmission('serialize'))
+        first, second = self.send_concurrently(agent, ['hello', 'again'])
+        self.assertEqual(['hello', 'again'], [i.text for i in second['dialog'].utterances])
+        self.assertEqual(first['dialog'].id, second['dialog'].id)
+        self.assertEqual(2, len(self.called))
+
+    def test_concurrent_messages_are_coalesced(self):
+        agent = self.make_agent([Service('slow', self.respond_later)], UserAdmission('coalesce'))
+        results = self.send_concurrently(agent, ['hello', 'how', 'are you'])
+        self.assertEqual(['hello', 'how are you'], [i.text for i in results[2]['dialog'].utterances])
+        self.assertIs(results[1], results[2])
+        self.assertEqual(2, len(self.called))
+
+    def test_concurrent_messages_are_rejected(self):
+        agent = self.make_agent([Service('slow', self.respond_later)], UserAdmission('reject'))
+        results = self.send_concurrently(agent, ['hello', 'again'])
+        self.assertIsInstance(results[1], AdmissionRejected)
+        results = self.send_concurrently(agent, ['next turn'])
+        self.assertEqual('next turn', results[0]['dialog'].utterances[-1].text)
+
+    def test_failed_turn_keeps_user_active(self):
+        async def fail(**kwargs):
+            raise ValueError('state processor error')
+
+        agent = self.make_agent([Service('broken', self.respond, fail)], UserAdmission('serialize', max_queued=1))
+
+        async def send():
+            messages = []
+            for utterance in ['hello', 'again', 'one more']:
+                messages.append(asyncio.ensure_future(agent.register_msg(
+                    utterance, user_external_id='user', channel_type='test', require_response=True)))
+                await asyncio.sleep(0.01)
+            pending = [not i.done() for i in messages]
+            for message in messages:
+                message.cancel()
+            return pending, await asyncio.gather(*messages, return_exceptions=True)
+
+        # the record without a deadline is never flushed, so the user isn't released
+        pending, results = run(send())
+        self.assertEqual([True, True, False], pending)
+        self.assertIsInstance(results[2], AdmissionRejected)
+        self.assertEqual(1, agent.user_admission.get_stats()['active_users'])
+
+    def test_overloaded_messages_are_shed(self):
+        controller = AdmissionController(max_concurrent=1, max_queued=1, overload_response='busy')
+        agent = self.make_agent([Service('slow', self.respond_later, self.state_manager.add_annotation)],
+                                admission_controller=controller)
+
+        async def send():
+            messages = [agent.register_msg('hello', user_external_id=f'user{i}', channel_type='test',
+                                           require_response=True) for i in range(3)]
+            return await asyncio.wait_for(asyncio.gather(*messages), 1)
+
+        results = run(send())
+        self.assertEqual(['hello', 'hello', 'busy'], [i['dialog'].utterances[-1].text for i in results])
+        self.assertEqual('overload', results[2]['dialog'].utterances[-1].active_skill)
+        self.assertEqual(2, len(self.called))
+        self.assertEqual(0, controller.active)
+        # the shed message doesn't touch the db
+        self.assertEqual([], run(self.state_manager.get_dialogs_by_user_ext_id('user2')))
+
+    def test_service_timeout_skips_dependent_services(self):
+        slow = Service('slow', self.never_respond, self.state_manager.add_annotation, timeout=0.05)
+        dependent = Service('dependent', self.respond, names_required_previous_services={'slow'})
+        fast = Service('fast', self.respond, self.state_manager.add_annotation)
+        agent = self.make_agent([slow, dependent, fast])
+
+        workflow_record = run(asyncio.wait_for(agent.register_msg(
+            'hello', user_external_id='user', channel_type='test', require_response=True), 1))
+        annotations = workflow_record['dialog'].utterances[-1].annotations
+        self.assertEqual({'fast': {'text': 'response'}}, annotations)
+        self.assertEqual(1, len(self.called))
+
+    def test_completed_task_timer_is_cancelled(self):
+        agent = self.make_agent([Service('fast', self.respond, self.state_manager.add_annotation, timeout=10)])
+        loop = asyncio.get_event_loop()
+        call_later = loop.call_later
+        timers = []
+
+        def record_timer(delay, callback, *args):
+            handle = call_later(delay, callback, *args)
+            if callback == agent.expire_task:
+                timers.append(handle)
+            return handle
+
+        with mock.patch.object(loop, 'call_later', record_timer):
+            run(asyncio.wait_for(agent.register_msg(
+                'hello', user_external_id='user', channel_type='test', require_response=True), 1))
+        self.assertEqual(1, len(timers))
+        self.assertTrue(timers[0].cancelled())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+
+from ..core.batching import AdaptiveBatchSize, BatchStats, collect_batch
+from . import run
+
+
+class TestCollectBatch(unittest.TestCase):
+    def test_queued_items_are_taken_at_once(self):
+        async def collect():
+            queue = asyncio.Queue()
+            for i in range(3):
+                queue.put_nowait(i)
+            return await collect_batch(queue, 2, 10), await collect_batch(queue, 2, 0)
+
+        self.assertEqual(([0, 1], [2]), run(collect()))
+
+    def test_waits_for_late_items(self):
+        async def collect():
+            queue = asyncio.Queue()
+            queue.put_nowait(0)
+            loop = asyncio.get_event_loop()
+            loop.call_later(0.01, queue.put_nowait, 1)
+            loop.call_later(0.5, queue.put_nowait, 2)
+            batch = await collect_batch(queue, 3, 0.1)
+            return batch, queue.qsize()
+
+        self.assertEqual(([0, 1], 0), run(collect()))
+
+    def test_blocks_on_first_item(self):
+        async def collect():
+            queue = asyncio.Queue()
+            asyncio.get_event_loop().call_later(0.01, queue.put_nowait, 0)
+            return await collect_batch(queue, 2, 0)
+
+        self.assertEqual([0], run(collect()))
+
+
+class TestBatchStats(unittest.TestCase):
+    def test_stats(self):
+        stats = BatchStats('service')
+        for size in [1, 4, 4]:
+            stats.add(size)
+        self.assertEqual({'batches': 3, 'items': 9, 'mean_size': 3, 'max_size': 4, 'sizes': {'1': 1, '4': 2},
+                          'in_flight': 0, 'errors': 0, 'adaptive': []},
+                         stats.get_stats())
+
+
+class TestAdaptiveBatchSize(unittest.TestCase):
+    def setUp(self):
+        self.controller = AdaptiveBatchSize(min_size=1, max_size=3, target_p95=0.1, window=4)
+
+    def record_round(self, latency, batch_size=None):
+        for _ in range(self.controller.window):
+            self.controller.record(batch_size or self.controller.size, latency)
+
+    def test_grows_under_target(self):
+        for _ in range(5):
+            self.record_round(0.05)
+        self.assertEqual(3, self.controller.size)
+
+    def test_does_not_grow_on_partial_batches(self):
+        self.record_round(0.05)
+        self.record_round(0.05, batch_size=1)
+        self.assertEqual(2, self.controller.size)
+
+    def test_shrinks_over_target(self):
+        self.record_round(0.05)
+        self.record_round(0.05)
+        self.record_round(0.2)
+        self.assertEqual(1, self.controller.size)
+        self.assertEqual(200, self.controller.get_stats()['p95_ms'])
+
+    def test_wrong_bounds(self):
+        with self.assertRaises(ValueError):
+            AdaptiveBatchSize(min_size=4, max_size=2, target_p95=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
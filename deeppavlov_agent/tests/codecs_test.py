@@ -0,0 +1,32 @@
+import unittest
+
+from ..core import codecs
+
+
+class TestCodecs(unittest.TestCase):
+    payload = {'utterances': [{'text': 'привет', 'annotations': {'ner': [[1, 2]]}, 'confidence': 0.5}]}
+
+    def test_roundtrip(self):
+        for name in ['json', 'orjson', 'msgpack']:
+            try:
+                codec = codecs.get_codec(name)
+            except ValueError:
+                continue
+            with self.subTest(codec=name):
+                self.assertEqual(self.payload, codec.decode(codec.encode(self.payload)))
+                self.assertEqual(self.payload, codecs.decode(codec.encode(self.payload), codec.content_type))
+
+    def test_default_codec(self):
+        self.assertEqual('json', codecs.get_codec().name)
+        self.assertEqual('application/json', codecs.get_codec().accept)
+
+    def test_message_without_content_type_is_json(self):
+        self.assertEqual(self.payload, codecs.decode(codecs.get_codec('json').encode(self.payload)))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            codecs.get_codec('pickle')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import unittest
+
+import aiohttp
+
+from ..core.connectors import AioQueueConnector, HTTPConnector, QueueListenerBatchifyer
+from . import run
+
+
+class FakeResponse:
+    def __init__(self, session, payload):
+        self.session = session
+        self.payload = payload
+
+    async def __aenter__(self):
+        if self.session.failures:
+            self.session.failures -= 1
+            raise aiohttp.ClientConnectionError()
+        self.session.in_flight += 1
+        self.session.max_in_flight = max(self.session.max_in_flight, self.session.in_flight)
+        # first batches take longer, so responses come in reversed order
+        await asyncio.sleep(self.session.delays.pop(0) if self.session.delays else 0)
+        self.session.in_flight -= 1
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    content_type = 'application/json'
+
+    async def read(self):
+        return json.dumps([{'value': i} for i in self.payload['value']]).encode()
+
+
+class FakeSession:
+    def __init__(self, delays=(), failures=0):
+        self.delays = list(delays)
+        self.failures = failures
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def post(self, url, data, headers):
+        return FakeResponse(self, json.loads(data))
+
+
+class TestQueueListenerBatchifyer(unittest.TestCase):
+    def process_tasks(self, session, max_in_flight, tasks_count, retries=0):
+        async def process():
+            queue = asyncio.Queue()
+            connector = AioQueueConnector(queue)
+            worker = QueueListenerBatchifyer(session, 'http://service', queue, 2, max_in_flight=max_in_flight,
+                                             retries=retries, retry_backoff_ms=1)
+            responses = []
+
+            async def callback(task_id, response):
+                responses.append(type(response).__name__ if isinstance(response, Exception) else task_id)
+
+            for i in range(tasks_count):
+                await connector.send({'task_id': i, 'payload': {'value': [i]}})
+            consumer = asyncio.ensure_future(worker.call_service(callback))
+            while len(responses) < tasks_count:
+                await asyncio.sleep(0.01)
+            consumer.cancel()
+            return responses
+
+        return run(process())
+
+    def test_concurrent_batches_keep_order(self):
+        session = FakeSession([0.06, 0.04, 0.02])
+        self.assertEqual(list(range(6)), self.process_tasks(session, 3, 6))
+        self.assertEqual(3, session.max_in_flight)
+
+    def test_single_request_in_flight(self):
+        session = FakeSession([0.02, 0.01])
+        self.assertEqual(list(range(4)), self.process_tasks(session, 1, 4))
+        self.assertEqual(1, session.max_in_flight)
+
+    def test_failed_batch(self):
+        session = FakeSession(failures=1)
+        self.assertEqual(['ClientConnectionError', 'ClientConnectionError', 2], self.process_tasks(session, 1, 3))
+
+    def test_retry(self):
+        session = FakeSession(failures=2)
+        self.assertEqual([0, 1, 2], self.process_tasks(session, 1, 3, retries=2))
+
+    def test_cancel_stops_batches_in_flight(self):
+        async def process():
+            queue = asyncio.Queue()
+            session = FakeSession([10, 10])
+            worker = QueueListenerBatchifyer(session, 'http://service', queue, 1, max_in_flight=2)
+            responses = []
+
+            async def callback(task_id, response):
+                responses.append(task_id)
+
+            for i in range(2):
+                await queue.put({'task_id': i, 'payload': {'value': [i]}})
+            consumer = asyncio.ensure_future(worker.call_service(callback))
+            while session.in_flight < 2:
+                await asyncio.sleep(0.01)
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+            return worker, responses
+
+        worker, responses = run(asyncio.wait_for(process(), 1))
+        self.assertEqual(0, worker.batch_stats.in_flight)
+        self.assertEqual([], responses)
+
+
+class UrlDelaySession(FakeSession):
+    def __init__(self, url_delays):
+        super().__init__()
+        self.url_delays = url_delays
+        self.urls = []
+
+    def post(self, url, data, headers):
+        self.urls.append(url)
+        self.delays = [self.url_delays[url]]
+        return FakeResponse(self, json.loads(data))
+
+
+class TestHTTPConnector(unittest.TestCase):
+    def send(self, connector):
+        responses = []
+
+        async def callback(task_id, response):
+            responses.append(response)
+
+        run(connector.send({'task_id': 0, 'payload': {'value': [1]}}, callback))
+        return responses
+
+    def test_hedged_request(self):
+        session = UrlDelaySession({'http://slow': 1, 'http://fast': 0})
+        connector = HTTPConnector(session, 'http://slow', hedge_urls=['http://fast'], hedge_delay_ms=10)
+        self.assertEqual([{'value': 1}], self.send(connector))
+        self.assertEqual(['http://slow', 'http://fast'], session.urls)
+        self.assertEqual(1, connector.hedged_requests)
+
+    def test_fast_response_is_not_hedged(self):
+        session = UrlDelaySession({'http://main': 0, 'http://hedge': 0})
+        connector = HTTPConnector(session, 'http://main', hedge_urls=['http://hedge'], hedge_delay_ms=100)
+        self.assertEqual([{'value': 1}], self.send(connector))
+        self.assertEqual(['http://main'], session.urls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from ..core.dialog_cache import LRUDialogCache
+from . import make_dialog
+
+
+class TestLRUDialogCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUDialogCache(max_size=2, ttl=300)
+
+    def test_hit_and_miss(self):
+        dialog = make_dialog('user1')
+        self.cache.put(dialog)
+        self.assertIs(dialog, self.cache.get('user1'))
+        self.assertIsNone(self.cache.get('user2'))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0}, self.cache.get_stats())
+
+    def test_least_recently_used_is_evicted(self):
+        first, second, third = make_dialog('user1'), make_dialog('user2'), make_dialog('user3')
+        self.cache.put(first)
+        self.cache.put(second)
+        self.cache.get('user1')
+        self.cache.put(third)
+        self.assertIsNone(self.cache.get('user2'))
+        self.assertIs(first, self.cache.get('user1'))
+        self.assertEqual(1, self.cache.get_stats()['evictions'])
+
+    def test_expired_dialog_is_dropped(self):
+        cache = LRUDialogCache(max_size=2, ttl=-1)
+        cache.put(make_dialog('user1'))
+        self.assertIsNone(cache.get('user1'))
+        self.assertEqual(0, cache.get_stats()['size'])
+
+    def test_pop_by_dialog_id(self):
+        dialog = make_dialog('user1')
+        self.cache.put(dialog)
+        self.assertIs(dialog, self.cache.pop_by_dialog_id(dialog._id))
+        self.assertIsNone(self.cache.get('user1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
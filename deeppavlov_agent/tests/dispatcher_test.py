@@ -0,0 +1,135 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+from ..http_api.dispatcher import init_dispatcher_app
+from . import run
+
+
+def make_worker_app(worker, flushes):
+    async def handle_message(request):
+        data = await request.json()
+        return web.json_response({'worker': worker, 'user_id': data['user_id']})
+
+    async def handle_user(request):
+        return web.json_response({'worker': worker})
+
+    async def handle_chat(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            await ws.send_json({'worker': worker, 'user_id': msg.json()['user_id']})
+        return ws
+
+    async def handle_flush(request):
+        flushes.append((worker, await request.read()))
+        return web.Response()
+
+    async def handle_dialogs(request):
+        return web.json_response({'worker': worker, 'flushed': sorted(i for i, _ in flushes)})
+
+    app = web.Application()
+    app.router.add_post('', handle_message)
+    app.router.add_post('/api/flush', handle_flush)
+    app.router.add_get('/api/dialogs/{dialog_id}', handle_dialogs)
+    app.router.add_post('/rating/dialog', handle_dialogs)
+    app.router.add_get('/api/user/{user_external_id}', handle_user)
+    app.router.add_get('/ping', handle_user)
+    app.router.add_get('/chat/ws', handle_chat)
+    return app
+
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.socket_paths = [os.path.join(self.socket_dir, f'worker_{i}.sock') for i in range(3)]
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.flushes = []
+
+    def tearDown(self):
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    async def start(self):
+        runners = []
+        for worker, path in enumerate(self.socket_paths):
+            runner = web.AppRunner(make_worker_app(worker, self.flushes))
+            await runner.setup()
+            await web.UnixSite(runner, path).start()
+            runners.append(runner)
+        runner = web.AppRunner(init_dispatcher_app(self.socket_paths))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', self.port).start()
+        return runners + [runner]
+
+    def check(self, client_coro):
+        async def check():
+            runners = await self.start()
+            try:
+                async with aiohttp.ClientSession() as session:
+                    return await client_coro(session, f'http://127.0.0.1:{self.port}')
+            finally:
+                for runner in reversed(runners):
+                    await runner.cleanup()
+
+        return run(check())
+
+    def test_user_messages_are_sticky(self):
+        async def send(session, url):
+            workers = {}
+            for i in range(30):
+                user_id = f'user{i % 10}'
+                async with session.post(url, json={'user_id': user_id, 'payload': 'hi'}) as resp:
+                    data = await resp.json()
+                self.assertEqual(user_id, data['user_id'])
+                workers.setdefault(user_id, set()).add(data['worker'])
+            async with session.get(f'{url}/api/user/user0') as resp:
+                user_api_worker = (await resp.json())['worker']
+            async with session.get(f'{url}/ping') as resp:
+                self.assertEqual(200, resp.status)
+            return workers, user_api_worker
+
+        workers, user_api_worker = self.check(send)
+        self.assertTrue(all(len(i) == 1 for i in workers.values()))
+        self.assertGreater(len(set.union(*workers.values())), 1)
+        self.assertEqual(workers['user0'], {user_api_worker})
+
+    def test_chat_messages_are_sticky(self):
+        async def chat(session, url):
+            replies = []
+            async with session.ws_connect(f'{url}/chat/ws') as ws:
+                for user_id in ['user1', 'user2', 'user1']:
+                    await ws.send_json({'user_id': user_id, 'payload': 'hi'})
+                    replies.append(await ws.receive_json())
+            return replies
+
+        replies = self.check(chat)
+        self.assertEqual(['user1', 'user2', 'user1'], [i['user_id'] for i in replies])
+        self.assertEqual(replies[0]['worker'], replies[2]['worker'])
+
+    def test_dialogs_are_read_after_flush(self):
+        async def read(session, url):
+            async with session.get(f'{url}/api/dialogs/export') as resp:
+                return await resp.json()
+
+        data = self.check(read)
+        self.assertEqual([0, 1, 2], data['flushed'])
+        self.assertEqual([b''] * 3, [body for _, body in self.flushes])
+
+    def test_rating_without_user(self):
+        async def rate(session, url):
+            async with session.post(f'{url}/rating/dialog', json={'user_id': 'user1', 'rating': 5}) as resp:
+                by_user = await resp.json()
+            async with session.post(f'{url}/rating/dialog', json={'dialog_id': 'dialog', 'rating': 5}) as resp:
+                return by_user, await resp.json()
+
+        by_user, without_user = self.check(rate)
+        self.assertEqual([], by_user['flushed'])
+        self.assertEqual([0, 1, 2], without_user['flushed'])
+        self.assertTrue(all(b'"dialog_id": "dialog"' in body for _, body in self.flushes))
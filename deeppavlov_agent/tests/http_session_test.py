@@ -0,0 +1,29 @@
+import unittest
+
+from ..core.http_session import ClientSessionPool
+from . import run
+
+
+class TestClientSessionPool(unittest.TestCase):
+    def test_sessions(self):
+        async def make_sessions():
+            pool = ClientSessionPool({'limit': 10})
+            dedicated = pool.get_session('skill', {'limit': 2, 'read_timeout': 5})
+            self.assertIs(pool.get_session('annotator'), pool.get_session())
+            self.assertIsNot(dedicated, pool.get_session())
+            self.assertEqual(5, dedicated.timeout.sock_read)
+            stats = pool.get_stats()
+            await pool.close()
+            return stats
+
+        stats = run(make_sessions())
+        self.assertEqual({'default', 'skill'}, set(stats))
+        self.assertEqual({'limit': 2, 'limit_per_host': 0, 'acquired': 0, 'idle': 0, 'waiting': 0}, stats['skill'])
+
+    def test_unknown_parameter(self):
+        with self.assertRaises(ValueError):
+            ClientSessionPool({'pool_size': 10})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from ..core import codecs
+from ..core.transport.messages import (SCHEMA_HEADER, FromChannelMessage, ServiceResponseMessage, ServiceTaskMessage,
+                                       decode_message, encode_message)
+
+
+class TestTransportMessages(unittest.TestCase):
+    def setUp(self):
+        self.codec = codecs.get_codec()
+
+    def test_round_trip(self):
+        message = FromChannelMessage(agent_name='agent', channel_id='cmd', user_id='user', utterance='hi',
+                                     reset_dialog=True)
+        body, headers = encode_message(message, self.codec)
+        self.assertEqual(b'"hi"', body)
+        self.assertEqual(2, headers[SCHEMA_HEADER])
+
+        decoded = decode_message(body, self.codec.content_type, headers)
+        self.assertIsInstance(decoded, FromChannelMessage)
+        self.assertEqual(message.to_json(), decoded.to_json())
+
+    def test_body_is_decoded_lazily(self):
+        message = ServiceResponseMessage(task_id='task', agent_name='agent', response={'text': 'hello'})
+        body, headers = encode_message(message, self.codec)
+
+        decoded = decode_message(body, self.codec.content_type, headers)
+        self.assertEqual('task', decoded.task_id)
+        self.assertIs(body, decoded._raw_body)
+        self.assertEqual({'text': 'hello'}, decoded.response)
+        self.assertIsNone(decoded._raw_body)
+
+    def test_byte_header_values(self):
+        message = ServiceResponseMessage(task_id='task', agent_name='agent', response=None)
+        body, headers = encode_message(message, self.codec)
+        headers = {k: v.encode() if isinstance(v, str) else v for k, v in headers.items()}
+
+        decoded = decode_message(body, self.codec.content_type, headers)
+        self.assertEqual(('agent', 'task'), (decoded.agent_name, decoded.task_id))
+
+    def test_schema_version_1(self):
+        message = ServiceTaskMessage(agent_name='agent', payload={'task_id': 'task', 'payload': {}})
+        body, headers = encode_message(message, self.codec, schema_version=1)
+        self.assertEqual({}, headers)
+        self.assertEqual('service_task', self.codec.decode(body)['msg_type'])
+
+        decoded = decode_message(body, self.codec.content_type, headers)
+        self.assertEqual(message.to_json(), decoded.to_json())
+
+    def test_unsupported_schema_version(self):
+        with self.assertRaises(ValueError):
+            decode_message(b'null', headers={SCHEMA_HEADER: 3, 'msg_type': 'service_task', 'agent_name': 'agent'})
+
+    def test_messages_have_no_dict(self):
+        message = ServiceTaskMessage(agent_name='agent', payload={})
+        with self.assertRaises(AttributeError):
+            message.extra = 1
+
+    def test_optional_shard_id(self):
+        message = ServiceTaskMessage(agent_name='agent', payload={})
+        self.assertNotIn('shard_id', message.to_json())
+        body, headers = encode_message(message, self.codec)
+        self.assertIsNone(decode_message(body, self.codec.content_type, headers).shard_id)
+
+        message = ServiceTaskMessage(agent_name='agent', payload={}, shard_id=3)
+        body, headers = encode_message(message, self.codec)
+        self.assertEqual(3, decode_message(body, self.codec.content_type, headers).shard_id)
@@ -0,0 +1,69 @@
+import unittest
+
+from ..core.state_manager import StateManager
+from ..core.storage import MemoryStorage
+from ..parse_config import PipelineConfigParser
+from . import run
+
+
+def make_config(**service_params):
+    skill = {'connector': {'protocol': 'python', 'class_name': 'PredefinedTextConnector', 'response_text': 'hi'}}
+    skill.update(service_params)
+    return {'services': {'skill': skill}}
+
+
+class TestHistoryWindow(unittest.TestCase):
+    def parse(self, config):
+        async def parse():
+            return PipelineConfigParser(StateManager(MemoryStorage()), config)
+
+        return run(parse())
+
+    def test_history_window(self):
+        service, = self.parse(make_config(history_window=2)).services
+        self.assertEqual(2, service.workflow_formatter.keywords['history_window'])
+
+    def test_invalid_history_window(self):
+        for history_window in (0, -1, True, '3'):
+            with self.subTest(history_window=history_window):
+                with self.assertRaises(ValueError):
+                    self.parse(make_config(history_window=history_window))
+
+    def test_invalid_timeout(self):
+        for timeout in (0, -1, True, '3'):
+            with self.subTest(timeout=timeout):
+                with self.assertRaises(ValueError):
+                    self.parse(make_config(timeout=timeout))
+
+
+class TestBatchingConnector(unittest.TestCase):
+    def test_settings_are_passed_to_workers(self):
+        async def parse():
+            connector = {'protocol': 'http', 'urllist': ['http://a', 'http://b'], 'batch_size': 4, 'max_wait_ms': 5,
+                         'max_in_flight': 2, 'retries': 3, 'retry_backoff_ms': 7}
+            config = {'services': {'skill': {'connector': connector}}}
+            parser = PipelineConfigParser(StateManager(MemoryStorage()), config)
+            await parser.sessions.close()
+            return parser.workers
+
+        workers = run(parse())
+        self.assertEqual(['http://a', 'http://b'], [i.url for i in workers])
+        worker = workers[0]
+        settings = (worker.batch_size, worker.max_wait, worker.max_in_flight, worker.retries, worker.retry_backoff)
+        self.assertEqual((4, 0.005, 2, 3, 0.007), settings)
+        self.assertEqual('skill', worker.batch_stats.name)
+        self.assertEqual('skill', worker.router.name)
+
+    def test_invalid_settings(self):
+        async def parse(**settings):
+            connector = {'protocol': 'http', 'url': 'http://a', 'batch_size': 2, **settings}
+            PipelineConfigParser(StateManager(MemoryStorage()), {'services': {'skill': {'connector': connector}}})
+
+        for settings in ({'max_in_flight': True}, {'retries': False}, {'max_wait_ms': True}, {'max_in_flight': 0}):
+            with self.subTest(**settings):
+                with self.assertRaises(ValueError):
+                    run(parse(**settings))
+
+
+if __name__ == '__main__':
+    unittest.main()
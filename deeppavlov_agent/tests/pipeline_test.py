@@ -0,0 +1,74 @@
+import unittest
+
+from ..core.pipeline import Pipeline
+from ..core.service import Service
+
+
+def make_pipeline():
+    services = [
+        Service('annotator', None),
+        Service('selector', None, tags=['selector'], names_previous_services={'annotator'}),
+        Service('skill_a', None, names_previous_services={'selector'}),
+        Service('skill_b', None, names_previous_services={'selector'}),
+        Service('post', None, names_previous_services={'skill_a', 'skill_b'}),
+    ]
+    return Pipeline(services, Service('input', None, tags=['input']), Service('responder', None, tags=['responder']),
+                    Service('last_chance', None, tags=['last_chance']), Service('timeout', None, tags=['timeout']))
+
+
+def names(services):
+    return sorted(s.name for s in services)
+
+
+class TestPipelineSchedule(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = make_pipeline()
+        self.schedule = self.pipeline.new_schedule()
+        self.pipeline.mark_launched(self.schedule, self.pipeline.services['input'])
+
+    def finish(self, name, skipped=False):
+        self.pipeline.mark_finished(self.schedule, self.pipeline.services[name], skipped)
+
+    def launch(self):
+        ready = self.pipeline.get_ready_services(self.schedule)
+        for service in ready:
+            self.pipeline.mark_launched(self.schedule, service)
+        return names(ready)
+
+    def test_full_run(self):
+        self.finish('input')
+        self.assertEqual(['annotator'], self.launch())
+        self.finish('annotator')
+        self.assertEqual(['selector'], self.launch())
+        self.finish('selector')
+        self.assertEqual(['skill_a', 'skill_b'], self.launch())
+        self.finish('skill_a')
+        self.assertEqual([], self.launch())
+        self.finish('skill_b')
+        self.assertEqual(['post'], self.launch())
+        self.finish('post')
+        self.assertEqual(['responder'], self.launch())
+
+    def test_matches_get_next_services(self):
+        self.assertEqual(['annotator'], names(self.pipeline.get_next_services({'input'})))
+        self.assertEqual(['skill_a'], names(self.pipeline.get_next_services(
+            {'input', 'annotator', 'selector'}, skipped={'skill_b'})))
+        self.assertEqual(['post'], names(self.pipeline.get_next_services(
+            {'input', 'annotator', 'selector', 'skill_a'}, skipped={'skill_b'})))
+
+    def test_all_previous_skipped(self):
+        for name in ['input', 'annotator']:
+            self.finish(name)
+            self.launch()
+        self.finish('skill_a', skipped=True)
+        self.finish('skill_b', skipped=True)
+        self.finish('selector')
+        self.assertEqual(['last_chance'], self.launch())
+        self.assertEqual([], self.launch())
+        self.pipeline.mark_finished(self.schedule, self.pipeline.last_chance_service)
+        self.assertEqual(['responder'], self.launch())
+        self.assertEqual([], self.launch())
+
+
+if __name__ == '__main__':
+    unittest.main()
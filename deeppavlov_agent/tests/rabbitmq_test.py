@@ -0,0 +1,323 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+import aio_pika
+
+from ..core import codecs
+from ..core.transport.gateways.rabbitmq import (BatchPublisher, RabbitMQAgentGateway, RabbitMQChannelGateway,
+                                                RabbitMQServiceGateway, get_delivery_mode)
+from ..core.transport.messages import (ServiceErrorMessage, ServiceTaskMessage, ToChannelMessage, decode_message,
+                                       encode_message)
+from . import run
+
+
+class FakeExchange:
+    def __init__(self, fail_keys=()):
+        self.fail_keys = fail_keys
+        self.published = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def publish(self, message, routing_key):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if routing_key in self.fail_keys:
+            raise ConnectionError(routing_key)
+        self.published.append((message, routing_key))
+
+
+class FakeIncomingMessage:
+    def __init__(self, task_id, shard_id=None):
+        task = ServiceTaskMessage(agent_name='agent', payload={'task_id': task_id, 'payload': {'x': [task_id]}},
+                                  shard_id=shard_id)
+        self.body, self.headers = encode_message(task, codecs.get_codec())
+        self.content_type = codecs.JSON_CONTENT_TYPE
+        self.acked = self.rejected = False
+
+    async def ack(self):
+        self.acked = True
+
+    async def reject(self):
+        self.rejected = True
+
+
+class FakeQueue:
+    async def consume(self, callback):
+        pass
+
+
+class OfflineServiceGateway(RabbitMQServiceGateway):
+    async def _connect(self):
+        self._in_queue = FakeQueue()
+
+    async def _setup_queues(self):
+        pass
+
+    async def _send_results(self, task, response):
+        self.results.append((task.payload['task_id'], response))
+
+
+class OfflineAgentGateway(RabbitMQAgentGateway):
+    async def _connect(self):
+        self._in_queue = FakeQueue()
+        self._agent_out_exchange = FakeExchange()
+
+    async def _setup_queues(self):
+        pass
+
+
+class OfflineChannelGateway(RabbitMQChannelGateway):
+    async def _connect(self):
+        self._agent_in_exchange = FakeExchange()
+
+    async def _setup_queues(self):
+        self._in_queue = FakeQueue()
+
+
+class DeliveredMessage:
+    def __init__(self, message):
+        self.body, self.headers, self.content_type = message.body, message.headers, message.content_type
+
+    async def ack(self):
+        pass
+
+
+def make_gateway(service_config, to_service_callback):
+    config = {'utterance_lifetime_sec': 1, 'service': {'name': 'service', **service_config}}
+    gateway = OfflineServiceGateway(config, to_service_callback)
+    gateway.results = []
+    return gateway
+
+
+def stop(gateway):
+    gateway._batches_task.cancel()
+    run(asyncio.sleep(0))
+
+
+class TestServiceGateway(unittest.TestCase):
+    def test_batches_are_inferred_concurrently(self):
+        running = []
+        max_running = []
+
+        async def infer(payloads):
+            running.append(payloads)
+            max_running.append(len(running))
+            await asyncio.sleep(0.02)
+            running.remove(payloads)
+            return [payload['x'][0] for payload in payloads]
+
+        gateway = make_gateway({'batch_size': 2, 'max_in_flight': 3}, infer)
+        self.assertEqual(8, gateway._prefetch_count)
+        messages = [FakeIncomingMessage(i) for i in range(6)]
+
+        async def consume():
+            for message in messages:
+                await gateway._on_message_callback(message)
+            await asyncio.sleep(0.05)
+
+        run(consume())
+        stop(gateway)
+        self.assertEqual(3, max(max_running))
+        self.assertEqual([(i, i) for i in range(6)], sorted(gateway.results))
+        self.assertTrue(all(message.acked for message in messages))
+
+    def test_partial_batch_is_sent_after_max_wait(self):
+        batches = []
+
+        async def infer(payloads):
+            batches.append(len(payloads))
+            return [None] * len(payloads)
+
+        gateway = make_gateway({'batch_size': 4, 'max_wait_ms': 10}, infer)
+
+        async def consume():
+            await gateway._on_message_callback(FakeIncomingMessage(0))
+            await asyncio.sleep(0.005)
+            await gateway._on_message_callback(FakeIncomingMessage(1))
+            await asyncio.sleep(0.05)
+
+        run(consume())
+        stop(gateway)
+        self.assertEqual([2], batches)
+
+    def infer_failed_batch(self, infer, messages, lifetime=1, **config):
+        gateway = make_gateway(config, infer)
+        gateway._utterance_lifetime_sec = lifetime
+        exchange = gateway._agent_in_exchange = FakeExchange()
+
+        async def consume():
+            for message in messages:
+                await gateway._on_message_callback(message)
+            await asyncio.sleep(0.05)
+
+        run(consume())
+        stop(gateway)
+        self.assertTrue(all(message.acked for message in messages))
+        self.assertEqual([], gateway.results)
+        return [decode_message(i.body, i.content_type, i.headers) for i, _ in exchange.published]
+
+    def test_failed_batch_is_reported(self):
+        async def infer(payloads):
+            raise ValueError('model error')
+
+        errors = self.infer_failed_batch(infer, [FakeIncomingMessage(i) for i in range(2)], batch_size=2)
+        self.assertEqual([0, 1], sorted(error.task_id for error in errors))
+        self.assertTrue(all(isinstance(error, ServiceErrorMessage) for error in errors))
+        self.assertIn('model error', errors[0].formatted_exc)
+
+    def test_timed_out_batch_is_reported(self):
+        async def infer(payloads):
+            await asyncio.sleep(1)
+
+        errors = self.infer_failed_batch(infer, [FakeIncomingMessage(0)], lifetime=0.01)
+        self.assertEqual([0], [error.task_id for error in errors])
+        self.assertIn('has not responded', errors[0].formatted_exc)
+
+    def test_unreadable_message_is_rejected(self):
+        async def infer(payloads):
+            return [payload['x'][0] for payload in payloads]
+
+        gateway = make_gateway({'batch_size': 2}, infer)
+        broken, message = FakeIncomingMessage(0), FakeIncomingMessage(1)
+        broken.body = b'{'
+
+        async def consume():
+            await gateway._on_message_callback(broken)
+            await gateway._on_message_callback(message)
+            await asyncio.sleep(0.01)
+
+        run(consume())
+        stop(gateway)
+        self.assertTrue(broken.rejected)
+        self.assertTrue(message.acked)
+        self.assertEqual([(1, 1)], gateway.results)
+
+
+class TestSharding(unittest.TestCase):
+    def test_response_is_routed_to_shard(self):
+        async def infer(payloads):
+            return [None] * len(payloads)
+
+        gateway = make_gateway({}, infer)
+        exchange = gateway._agent_in_exchange = FakeExchange()
+        messages = [FakeIncomingMessage(0, shard_id=2), FakeIncomingMessage(1)]
+
+        async def send_results():
+            for message in messages:
+                await RabbitMQServiceGateway._send_results(gateway, gateway._read_message(message), None)
+
+        run(send_results())
+        self.assertEqual(['agent.agent.shard.2', 'agent.agent'], [key for _, key in exchange.published])
+
+    def test_agent_shard_id(self):
+        config = {'utterance_lifetime_sec': 1, 'agent_name': 'agent', 'agent_shards': 2}
+        with self.assertRaises(ValueError):
+            OfflineAgentGateway(config)
+
+        gateway = OfflineAgentGateway({**config, 'agent_shard_id': 1, 'message_schema_version': 2})
+        run(gateway.send_to_service('skill', {'task_id': 'task', 'payload': {}}))
+        message, routing_key = gateway._agent_out_exchange.published[0]
+        self.assertEqual('service.skill', routing_key)
+        self.assertEqual(1, message.headers['shard_id'])
+
+    def test_channel_message_is_processed_by_shard(self):
+        registered = []
+
+        async def register_msg(**kwargs):
+            registered.append(kwargs)
+            return {'dialog': SimpleNamespace(utterances=[SimpleNamespace(text='hi')])}
+
+        config = {'utterance_lifetime_sec': 1, 'agent_name': 'agent', 'agent_shards': 2}
+        channel = OfflineChannelGateway({**config, 'channel': {'id': 'tg'}}, None)
+        run(channel.send_to_agent(utterance='hello', channel_id='tg', user_id='user', reset_dialog=False))
+        message, routing_key = channel._agent_in_exchange.published[0]
+        shard_id = channel._shards_ring.get_shard('user')
+        self.assertEqual(f'agent.agent.shard.{shard_id}', routing_key)
+
+        gateway = OfflineAgentGateway({**config, 'agent_shard_id': shard_id}, on_channel_callback=register_msg)
+
+        async def consume():
+            await gateway._on_message_callback(DeliveredMessage(message))
+            await asyncio.sleep(0.05)
+
+        run(consume())
+        expected = {'utterance': 'hello', 'user_external_id': 'user', 'channel_type': 'tg', 'require_response': True}
+        self.assertEqual([expected], registered)
+        message, routing_key = gateway._agent_out_exchange.published[0]
+        self.assertEqual('agent.agent.channel.tg.any', routing_key)
+        response = decode_message(message.body, message.content_type, message.headers)
+        self.assertIsInstance(response, ToChannelMessage)
+        self.assertEqual(('user', 'hi'), (response.user_id, response.response))
+
+
+class TestSchemaVersion(unittest.TestCase):
+    def send_task(self, **config):
+        gateway = OfflineAgentGateway({'utterance_lifetime_sec': 1, 'agent_name': 'agent', **config})
+        run(gateway.send_to_service('skill', {'task_id': 'task', 'payload': {}}))
+        message, _ = gateway._agent_out_exchange.published[0]
+        return message
+
+    def test_previous_version_by_default(self):
+        message = self.send_task()
+        self.assertFalse(message.headers)
+        self.assertEqual('service_task', codecs.get_codec().decode(message.body)['msg_type'])
+
+    def test_versions_are_readable(self):
+        for version in (1, 2):
+            with self.subTest(version=version):
+                message = self.send_task(message_schema_version=version)
+                task = decode_message(message.body, message.content_type, message.headers)
+                self.assertEqual({'task_id': 'task', 'payload': {}}, task.payload)
+
+
+class TestBatchPublisher(unittest.TestCase):
+    def test_fan_out_is_published_in_one_batch(self):
+        exchange = FakeExchange()
+        publisher = BatchPublisher(exchange)
+
+        async def fan_out():
+            await asyncio.gather(*[publisher.publish(i, f'service.{i}') for i in range(30)])
+
+        run(fan_out())
+        self.assertEqual(30, len(exchange.published))
+        self.assertEqual(30, exchange.max_in_flight)
+        self.assertEqual(1, publisher.batches)
+
+    def test_window_and_batch_size(self):
+        exchange = FakeExchange()
+        publisher = BatchPublisher(exchange, window_ms=20, max_batch_size=4)
+
+        async def publish_late():
+            await asyncio.sleep(0.005)
+            await publisher.publish('late', 'service.late')
+
+        async def fan_out():
+            await asyncio.gather(publish_late(), *[publisher.publish(i, f'service.{i}') for i in range(5)])
+
+        run(fan_out())
+        self.assertEqual(6, len(exchange.published))
+        self.assertEqual(2, publisher.batches)
+
+    def test_error_is_raised_to_its_publisher(self):
+        exchange = FakeExchange(fail_keys=('service.1',))
+        publisher = BatchPublisher(exchange)
+
+        async def fan_out():
+            return await asyncio.gather(*[publisher.publish(i, f'service.{i}') for i in range(3)],
+                                        return_exceptions=True)
+
+        results = run(fan_out())
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], ConnectionError)
+        self.assertIsNone(results[2])
+
+
+class TestDeliveryMode(unittest.TestCase):
+    def test_delivery_mode(self):
+        self.assertEqual(aio_pika.DeliveryMode.NOT_PERSISTENT, get_delivery_mode('not_persistent'))
+        self.assertEqual(aio_pika.DeliveryMode.PERSISTENT, get_delivery_mode('persistent'))
+        with self.assertRaises(ValueError):
+            get_delivery_mode('transient')
@@ -0,0 +1,51 @@
+import unittest
+from unittest.mock import patch
+
+from ..core import routing
+from ..core.routing import ReplicaRouter
+
+
+class TestReplicaRouter(unittest.TestCase):
+    def test_least_outstanding(self):
+        router = ReplicaRouter(['a', 'b'])
+        first, second = router.choose(), router.choose()
+        self.assertEqual({'a', 'b'}, {first.url, second.url})
+        router.release(first, 0.1)
+        self.assertIs(first, router.choose())
+
+    def test_ewma(self):
+        router = ReplicaRouter(['a', 'b'], policy='ewma')
+        for latency in [0.5, 0.1]:
+            router.release(router.choose(), latency)
+        self.assertEqual('b', router.choose().url)
+
+    def test_circuit_breaker(self):
+        router = ReplicaRouter(['a', 'b'], failure_threshold=2, recovery_time=10)
+        with patch.object(routing, 'monotonic', return_value=100):
+            for _ in range(2):
+                replica = router.choose()
+                self.assertEqual('a', replica.url)
+                router.release(replica, 0.1, ok=False)
+            self.assertEqual('open', router.replicas[0].state)
+            self.assertEqual(['b', 'b'], [router.choose().url, router.choose().url])
+        with patch.object(routing, 'monotonic', return_value=111):
+            probe = router.choose()
+            self.assertEqual('a', probe.url)
+            self.assertEqual('half_open', probe.state)
+            self.assertEqual('b', router.choose().url)
+            router.release(probe, 0.1)
+            self.assertEqual('closed', probe.state)
+
+    def test_all_replicas_ejected(self):
+        router = ReplicaRouter(['a'], failure_threshold=1)
+        router.release(router.choose(), 0.1, ok=False)
+        self.assertIsNone(router.choose())
+        self.assertEqual(1, router.get_stats()['a']['errors'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            ReplicaRouter(['a'], policy='random')
+
+
+if __name__ == '__main__':
+    unittest.main()
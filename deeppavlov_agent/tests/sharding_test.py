@@ -0,0 +1,28 @@
+import unittest
+from collections import Counter
+
+from ..core.sharding import HashRing, stable_hash
+
+
+class TestHashRing(unittest.TestCase):
+    def test_keys_are_spread_over_shards(self):
+        ring = HashRing(4)
+        counts = Counter(ring.get_shard(f'user{i}') for i in range(4000))
+        self.assertEqual({0, 1, 2, 3}, set(counts))
+        self.assertLess(max(counts.values()), 1.5 * min(counts.values()))
+
+    def test_added_shard_takes_keys_only_from_others(self):
+        ring, bigger_ring = HashRing(4), HashRing(5)
+        for i in range(1000):
+            shard = bigger_ring.get_shard(f'user{i}')
+            if shard != 4:
+                self.assertEqual(ring.get_shard(f'user{i}'), shard)
+
+    def test_single_shard(self):
+        self.assertEqual(0, HashRing(1).get_shard('user'))
+        with self.assertRaises(ValueError):
+            HashRing(0)
+
+    def test_stable_hash(self):
+        # the hash should be equal in all processes, so it is checked against a constant
+        self.assertEqual(0x5d41402abc4b2a76, stable_hash('hello'))
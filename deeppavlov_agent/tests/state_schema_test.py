@@ -0,0 +1,80 @@
+import unittest
+
+from ..core.state_schema import Bot, BotUtterance, Dialog, Human, HumanUtterance
+
+
+class TestUtteranceDictCache(unittest.TestCase):
+    def setUp(self):
+        self.utterance = HumanUtterance(_in_dialog_id=0, text='hello')
+
+    def test_snapshot_is_reused(self):
+        self.utterance.to_dict()
+        snapshot = self.utterance._dict_cache
+        self.utterance.to_dict()
+        self.assertIs(snapshot, self.utterance._dict_cache)
+
+    def test_changed_copy_is_not_saved(self):
+        self.utterance.to_dict()['text'] = 'changed by formatter'
+        self.assertEqual('hello', self.utterance.to_dict()['text'])
+        self.assertEqual('hello', self.utterance.get_save_data()['text'])
+
+    def test_assignment_invalidates_snapshot(self):
+        first = self.utterance.to_dict()
+        self.utterance.text = 'bye'
+        second = self.utterance.to_dict()
+        self.assertIsNot(first, second)
+        self.assertEqual('bye', second['text'])
+
+    def test_mark_dirty_invalidates_snapshot(self):
+        first = self.utterance.to_dict()
+        self.utterance.annotations['ner'] = {'tokens': []}
+        self.utterance.mark_dirty()
+        second = self.utterance.to_dict()
+        self.assertIsNot(first, second)
+        self.assertIn('ner', second['annotations'])
+
+    def test_non_serialized_field_keeps_snapshot(self):
+        self.utterance.to_dict()
+        snapshot = self.utterance._dict_cache
+        self.utterance.actual = True
+        self.utterance.to_dict()
+        self.assertIs(snapshot, self.utterance._dict_cache)
+
+    def test_bot_utterance(self):
+        utterance = BotUtterance(_in_dialog_id=1)
+        first = utterance.to_dict()
+        utterance.active_skill = 'chitchat'
+        self.assertEqual('chitchat', utterance.to_dict()['active_skill'])
+        self.assertIsNot(first, utterance.to_dict())
+
+
+class TestDialogHistoryWindow(unittest.TestCase):
+    def setUp(self):
+        self.dialog = Dialog(human=Human(external_id='test'), channel_type='test')
+        self.dialog.bot = Bot()
+        for i in range(5):
+            self.dialog.add_human_utterance()
+            self.dialog.utterances[-1].text = f'human {i}'
+            self.dialog.add_bot_utterance()
+            self.dialog.utterances[-1].text = f'bot {i}'
+
+    def test_full_history(self):
+        dialog_dict = self.dialog.to_dict()
+        self.assertEqual(10, len(dialog_dict['utterances']))
+        self.assertEqual(5, len(dialog_dict['human_utterances']))
+
+    def test_windowed_history(self):
+        dialog_dict = self.dialog.to_dict(history_window=3)
+        self.assertEqual(['bot 3', 'human 4', 'bot 4'], [i['text'] for i in dialog_dict['utterances']])
+        self.assertEqual(['human 2', 'human 3', 'human 4'], [i['text'] for i in dialog_dict['human_utterances']])
+        self.assertEqual(['bot 2', 'bot 3', 'bot 4'], [i['text'] for i in dialog_dict['bot_utterances']])
+
+    def test_invalid_history_window(self):
+        for history_window in (0, -1, True, 2.5):
+            with self.subTest(history_window=history_window):
+                with self.assertRaises(ValueError):
+                    self.dialog.to_dict(history_window=history_window)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from ..core.state_manager import StateManager
+from ..core.state_schema import Dialog, HumanUtterance
+from ..core.storage import MemoryStorage, SQLiteStorage
+from . import run
+
+
+class StorageTestMixin:
+    def make_storage(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.storage = self.make_storage()
+        self.state_manager = StateManager(self.storage)
+        run(self.state_manager.prepare_db())
+
+    async def make_turns(self, user_id, count, bulk=False):
+        for i in range(count):
+            dialog = await self.state_manager.get_or_create_dialog(user_id, 'test')
+            await self.state_manager.add_human_utterance(dialog, f'human {i}', 'input')
+            await self.state_manager.add_annotation(dialog, {'index': i}, 'annotator')
+            await self.state_manager.add_bot_utterance(
+                dialog, {'text': f'bot {i}', 'skill_name': 'skill', 'confidence': 1}, 'responder')
+            await dialog.save(self.storage, bulk=bulk)
+
+    async def make_dated_dialogs(self, count):
+        """Makes dialogs of user0, user1, ... started on January 1, 2, ... 2020."""
+        for i in range(count):
+            await self.make_turns(f'user{i}', 1)
+            dialog = await self.state_manager.get_or_create_dialog(f'user{i}', 'test')
+            await self.storage['dialog'].update_one({'_id': dialog._id},
+                                                    {'$set': {'date_start': datetime(2020, 1, i + 1)}})
+
+    def test_dialog_roundtrip(self):
+        run(self.make_turns('user', 3))
+        dialog = run(self.state_manager.get_or_create_dialog('user', 'test'))
+        self.assertEqual(['human 0', 'bot 0', 'human 1', 'bot 1', 'human 2', 'bot 2'],
+                         [i.text for i in dialog.utterances])
+        self.assertEqual({'index': 2}, dialog.human_utterances[-1].annotations['annotator'])
+        self.assertEqual(['test'], run(self.state_manager.get_channels()))
+
+    def test_bulk_save(self):
+        run(self.make_turns('user', 3, bulk=True))
+        dialog = run(self.state_manager.get_or_create_dialog('user', 'test'))
+        self.assertEqual(6, len(dialog.utterances))
+        self.assertEqual(list(range(6)), [i._in_dialog_id for i in dialog.utterances])
+
+    def test_failed_bulk_save_is_retried(self):
+        async def save_new_dialog():
+            dialog = await self.state_manager.get_or_create_dialog('user', 'test')
+            await self.state_manager.add_human_utterance(dialog, 'hello', 'input')
+            await self.state_manager.add_bot_utterance(
+                dialog, {'text': 'hi', 'skill_name': 'skill', 'confidence': 1}, 'responder')
+            bot_utterances = self.storage['bot_utterance']
+            with mock.patch.object(bot_utterances, 'bulk_write', side_effect=RuntimeError('write failed')):
+                with self.assertRaises(RuntimeError):
+                    await dialog.save(self.storage, bulk=True)
+            self.assertIsNone(dialog.bot_utterances[-1]._id)
+            self.assertFalse(dialog.utterances[-1].actual)
+            await dialog.save(self.storage, bulk=True)
+            return dialog
+
+        saved = run(save_new_dialog())
+        dialog = run(self.state_manager.get_or_create_dialog('user', 'test'))
+        self.assertEqual(saved._id, dialog._id)
+        self.assertEqual(['hello', 'hi'], [i.text for i in dialog.utterances])
+        self.assertEqual(1, len(run(self.state_manager.get_dialogs_by_user_ext_id('user'))))
+
+    def test_history_depth(self):
+        run(self.make_turns('user', 5))
+        dialog = run(Dialog.get_or_create_by_ext_id(self.storage, 'user', 'test', history_depth=3))
+        self.assertEqual(['bot 3', 'human 4', 'bot 4'], [i.text for i in dialog.utterances])
+        self.assertEqual(2, run(dialog.load_previous_utterances(self.storage, 2)))
+        self.assertEqual(['bot 2', 'human 3', 'bot 3', 'human 4', 'bot 4'], [i.text for i in dialog.utterances])
+
+    def test_latest_utterances(self):
+        run(self.make_turns('user', 3))
+        dialog = run(self.state_manager.get_or_create_dialog('user', 'test'))
+        latest = run(HumanUtterance.get_many(self.storage, dialog._id, limit=2))
+        self.assertEqual(['human 1', 'human 2'], [i.text for i in latest])
+        self.assertTrue(all(i.actual for i in latest))
+        previous = run(HumanUtterance.get_many(self.storage, dialog._id, limit=2, before=latest[0]._in_dialog_id))
+        self.assertEqual(['human 0'], [i.text for i in previous])
+
+    def test_truncated_dialog_keeps_date_start(self):
+        run(self.make_turns('user', 3))
+        date_start = run(self.state_manager.get_or_create_dialog('user', 'test')).utterances[0].date_time
+        dialog = run(Dialog.get_or_create_by_ext_id(self.storage, 'user', 'test', history_depth=2))
+        dialog.add_human_utterance()
+        dialog.utterances[-1].text = 'human 3'
+        run(dialog.save(self.storage))
+        dialog = run(self.state_manager.get_or_create_dialog('user', 'test'))
+        self.assertEqual(date_start, dialog.date_start)
+        self.assertEqual(7, len(dialog.utterances))
+
+    def test_cursor_batches(self):
+        async def find(name, query=None, limit=0):
+            collection = self.storage[name]
+            await collection.create_index('index')
+            for i in range(5):
+                await collection.insert_one({'index': i % 3, 'name': f'doc {i}'})
+            cursor = collection.find(query).sort('index').limit(limit).batch_size(2)
+            return [i['name'] async for i in cursor]
+
+        self.assertEqual(['doc 0', 'doc 3', 'doc 1', 'doc 4', 'doc 2'], run(find('all')))
+        self.assertEqual(['doc 0', 'doc 3', 'doc 1'], run(find('limited', limit=3)))
+        self.assertEqual(['doc 1', 'doc 4'], run(find('not_indexed', {'name': {'$in': ['doc 1', 'doc 4']}})))
+
+    def test_iter_dialogs(self):
+        async def export(**kwargs):
+            await self.make_dated_dialogs(5)
+            with mock.patch.object(Dialog, '_load_batch', wraps=Dialog._load_batch) as load_batch:
+                dialogs = [i async for i in self.state_manager.iter_dialogs(batch_size=2, **kwargs)]
+            return dialogs, load_batch.call_count
+
+        dialogs, batches = run(export())
+        self.assertEqual([f'user{i}' for i in range(5)], [i.human.external_id for i in dialogs])
+        self.assertEqual(['human 0', 'bot 0'], [i.text for i in dialogs[0].utterances])
+        self.assertEqual(3, batches)
+
+    def test_iter_dialogs_date_filter(self):
+        async def export():
+            await self.make_dated_dialogs(5)
+            return [i.human.external_id async for i in self.state_manager.iter_dialogs(
+                date_from=datetime(2020, 1, 2), date_to=datetime(2020, 1, 4))]
+
+        self.assertEqual(['user1', 'user2'], run(export()))
+
+    def test_get_all_dialogs(self):
+        async def export():
+            await self.make_dated_dialogs(3)
+            with self.assertWarns(DeprecationWarning):
+                return await self.state_manager.get_all_dialogs()
+
+        self.assertEqual(['user0', 'user1', 'user2'], [i.human.external_id for i in run(export())])
+
+    def test_drop_active_dialog(self):
+        run(self.make_turns('user', 1))
+        run(self.state_manager.drop_active_dialog('user'))
+        dialog = run(self.state_manager.get_or_create_dialog('user', 'test'))
+        self.assertEqual([], dialog.utterances)
+        self.assertEqual(1, len(run(self.state_manager.get_dialogs_by_user_ext_id('user'))))
+
+
+class TestMemoryStorage(StorageTestMixin, unittest.TestCase):
+    def make_storage(self):
+        return MemoryStorage()
+
+
+class TestSQLiteStorage(StorageTestMixin, unittest.TestCase):
+    def make_storage(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        return SQLiteStorage(os.path.join(self.tmp_dir.name, 'agent.sqlite'))
+
+    def tearDown(self):
+        self.storage.connection.close()
+        self.tmp_dir.cleanup()
+
+    def test_rows_are_fetched_by_pages(self):
+        async def find():
+            collection = self.storage['test']
+            await collection.create_index('index')
+            for i in range(5):
+                await collection.insert_one({'index': i})
+            with mock.patch.object(collection, '_find_page', wraps=collection._find_page) as find_page:
+                documents = [i async for i in collection.find({'index': {'$gte': 1}}).sort('index').batch_size(2)]
+            return documents, find_page.call_count
+
+        documents, pages = run(find())
+        self.assertEqual([1, 2, 3, 4], [i['index'] for i in documents])
+        self.assertEqual(3, pages)
+
+
+class TestHistoryDepth(unittest.TestCase):
+    def test_invalid_history_depth(self):
+        for history_depth in (0, -1, True, '3'):
+            with self.subTest(history_depth=history_depth):
+                with self.assertRaises(ValueError):
+                    StateManager(MemoryStorage(), history_depth=history_depth)
+
+
+if __name__ == '__main__':
+    unittest.main()
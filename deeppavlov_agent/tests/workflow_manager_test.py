@@ -1,5 +1,5 @@
 import unittest
-from ..core.workflow_manager import WorkflowManager
+from ..core.workflow_manager import TaskRecord, WorkflowManager, WorkflowRecord
 from uuid import uuid4
 
 
@@ -36,7 +36,7 @@ class TestWorkflowManagerDialog(unittest.TestCase):
 
     def test_flush_record(self):
         workflow_record = self.workflow.flush_record(self.dialog_id)
-        self.assertTrue(isinstance(workflow_record, dict))
+        self.assertTrue(isinstance(workflow_record, WorkflowRecord))
         self.assertEqual(workflow_record['dialog'].id, self.dialog_id)
 
     def test_add_task(self):
@@ -53,8 +53,8 @@ class TestWorkflowManagerDialog(unittest.TestCase):
         task_service = TestService('testservice')
         task_id = self.workflow.add_task(self.dialog_id, task_service, payload, 1)
         workflow_record, task = self.workflow.complete_task(task_id, response)
-        self.assertTrue(isinstance(task, dict))
-        self.assertTrue(isinstance(workflow_record, dict))
+        self.assertTrue(isinstance(task, TaskRecord))
+        self.assertTrue(isinstance(workflow_record, WorkflowRecord))
         self.assertEqual(task['service'].name, task_service.name)
         self.assertEqual(task['dialog'], workflow_record['dialog'].id)
 
@@ -85,6 +85,26 @@ class TestWorkflowManagerDialog(unittest.TestCase):
         self.assertTrue(waiting_service.name in waiting)
         self.assertTrue(skipped_service.name in skipped)
 
+    def test_failed_service(self):
+        failed_service = TestService(uuid4().hex)
+        first_task_id = self.workflow.add_task(self.dialog_id, failed_service, uuid4().hex, 0)
+        second_task_id = self.workflow.add_task(self.dialog_id, failed_service, uuid4().hex, 1)
+        self.workflow.complete_task(first_task_id, '123')
+        self.assertTrue(self.workflow.has_pending_tasks(self.dialog_id, failed_service))
+        self.workflow.complete_task(second_task_id, ValueError())
+        self.assertFalse(self.workflow.has_pending_tasks(self.dialog_id, failed_service))
+        done, waiting, skipped = self.workflow.get_services_status(self.dialog_id)
+        self.assertEqual({failed_service.name}, skipped)
+
+    def test_extra_record_fields(self):
+        another_dialog_id = uuid4().hex
+        self.workflow.add_workflow_record(TestDialog(another_dialog_id), hold_flush=True, user_external_id='user')
+        workflow_record = self.workflow.get_workflow_record(another_dialog_id)
+        self.assertTrue(workflow_record.get('hold_flush'))
+        self.assertEqual('user', workflow_record['user_external_id'])
+        self.assertTrue('user_external_id' in workflow_record)
+        self.assertFalse('timeout_response_task' in workflow_record)
+
     def test_flush(self):
         payload = uuid4().hex
         response = '123'
@@ -0,0 +1,205 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from ..core.dialog_cache import LRUDialogCache
+from ..core.state_manager import StateManager
+from ..core.state_schema import Dialog
+from ..core.storage import MemoryStorage
+from ..core.write_behind import WriteBehindQueue
+from . import make_dialog, run
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+    def setUp(self):
+        self.saved = []
+        self.can_save = None
+
+    async def save(self, dialog):
+        await self.can_save.wait()
+        self.saved.append(dialog)
+
+    def test_pending_saves_are_coalesced(self):
+        async def check():
+            self.can_save = asyncio.Event()
+            queue = WriteBehindQueue(self.save, max_size=10, batch_size=1)
+            await queue.put(first)
+            await asyncio.sleep(0.01)
+            await queue.put(second)
+            await queue.put(third)
+            pending = queue.get_pending('user2')
+            self.can_save.set()
+            await queue.flush()
+            size = len(queue)
+            await queue.close()
+            return pending, size
+
+        first, second, third = make_dialog('user1'), make_dialog('user2'), make_dialog('user2')
+        pending, size = run(check())
+        self.assertIs(third, pending)
+        self.assertEqual([first, third], self.saved)
+        self.assertEqual(0, size)
+
+    def test_put_waits_for_space(self):
+        async def check():
+            self.can_save = asyncio.Event()
+            queue = WriteBehindQueue(self.save, max_size=1, batch_size=1)
+            await queue.put(dialogs[0])
+            await asyncio.sleep(0.01)
+            await queue.put(dialogs[1])
+            blocked = asyncio.ensure_future(queue.put(dialogs[2]))
+            await asyncio.sleep(0.01)
+            was_blocked = not blocked.done()
+            self.can_save.set()
+            await asyncio.wait_for(blocked, 1)
+            await queue.close()
+            return was_blocked
+
+        dialogs = [make_dialog(f'user{i}') for i in range(3)]
+        self.assertTrue(run(check()))
+        self.assertEqual(dialogs, self.saved)
+
+
+class TestStateManagerWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+
+    async def make_turn(self, state_manager, dialog, text):
+        await state_manager.add_human_utterance(dialog, text, 'input')
+        await state_manager.add_annotation(dialog, {'text': text}, 'annotator')
+        await state_manager.add_bot_utterance(
+            dialog, {'text': f'reply to {text}', 'skill_name': 'skill', 'confidence': 1}, 'responder')
+        await state_manager.save_dialog(dialog, {}, 'responder')
+
+    def test_next_turn_during_save(self):
+        async def slow_insert(document):
+            await asyncio.sleep(0.02)
+            return await insert_one(document)
+
+        async def check():
+            state_manager = StateManager(self.storage, write_behind_queue_size=10)
+            with mock.patch.object(dialogs, 'insert_one', slow_insert):
+                dialog = await state_manager.get_or_create_dialog('user', 'test')
+                await self.make_turn(state_manager, dialog, 'hello')
+                await asyncio.sleep(0.01)
+                # the first turn is being saved, while the next one adds its utterance to the same dialog
+                dialog = await state_manager.get_or_create_dialog('user', 'test')
+                await state_manager.add_human_utterance(dialog, 'again', 'input')
+                await asyncio.sleep(0.03)
+                await state_manager.add_annotation(dialog, {'text': 'again'}, 'annotator')
+                await state_manager.add_bot_utterance(
+                    dialog, {'text': 'reply to again', 'skill_name': 'skill', 'confidence': 1}, 'responder')
+                await state_manager.save_dialog(dialog, {}, 'responder')
+                await state_manager.close()
+            return await StateManager(self.storage).get_or_create_dialog('user', 'test')
+
+        dialogs = self.storage['dialog']
+        insert_one = dialogs.insert_one
+        dialog = run(check())
+        self.assertEqual(['hello', 'reply to hello', 'again', 'reply to again'], [i.text for i in dialog.utterances])
+        self.assertEqual({'text': 'again'}, dialog.human_utterances[-1].annotations['annotator'])
+
+    def test_save_returns_before_write(self):
+        async def blocked_insert(document):
+            await can_write.wait()
+            return await insert_one(document)
+
+        async def check():
+            state_manager = StateManager(self.storage, write_behind_queue_size=10)
+            with mock.patch.object(dialogs, 'insert_one', blocked_insert):
+                dialog = await state_manager.get_or_create_dialog('user', 'test')
+                await asyncio.wait_for(self.make_turn(state_manager, dialog, 'hello'), 0.1)
+                saved_before = await dialogs.find_one({'dialog_id': dialog.dialog_id})
+                can_write.set()
+                await state_manager.close()
+            return saved_before, await dialogs.find_one({'dialog_id': dialog.dialog_id})
+
+        can_write = asyncio.Event()
+        dialogs = self.storage['dialog']
+        insert_one = dialogs.insert_one
+        saved_before, saved_after = run(check())
+        self.assertIsNone(saved_before)
+        self.assertIsNotNone(saved_after)
+
+    def test_dialog_queued_behind_another_save(self):
+        async def blocked_save(dialog):
+            if dialog.human.external_id == 'user1':
+                await can_save.wait()
+            await persist_dialog(dialog)
+
+        async def check():
+            with mock.patch.object(state_manager, '_persist_dialog', blocked_save):
+                state_manager._write_behind._save_func = state_manager._persist_dialog
+                first = await state_manager.get_or_create_dialog('user1', 'test')
+                await self.make_turn(state_manager, first, 'hello')
+                second = await state_manager.get_or_create_dialog('user2', 'test')
+                await self.make_turn(state_manager, second, 'hello')
+                # the next turn of the second user gets its dialog, which is waiting for the save
+                second = await state_manager.get_or_create_dialog('user2', 'test')
+                await state_manager.add_human_utterance(second, 'again', 'input')
+                can_save.set()
+                await asyncio.sleep(0.01)
+                await state_manager.add_annotation(second, {'text': 'again'}, 'annotator')
+                await state_manager.add_bot_utterance(
+                    second, {'text': 'reply to again', 'skill_name': 'skill', 'confidence': 1}, 'responder')
+                await state_manager.save_dialog(second, {}, 'responder')
+                await state_manager.close()
+            return await StateManager(self.storage).get_or_create_dialog('user2', 'test')
+
+        can_save = asyncio.Event()
+        state_manager = StateManager(self.storage, write_behind_queue_size=10, write_behind_batch_size=1)
+        persist_dialog = state_manager._persist_dialog
+        dialog = run(check())
+        self.assertEqual(['hello', 'reply to hello', 'again', 'reply to again'], [i.text for i in dialog.utterances])
+        self.assertEqual({'text': 'again'}, dialog.human_utterances[-1].annotations['annotator'])
+
+    def test_only_cached_copy_is_trimmed(self):
+        async def check():
+            state_manager = StateManager(self.storage, history_depth=2, dialog_cache=LRUDialogCache(10, 300))
+            dialog = await state_manager.get_or_create_dialog('user', 'test')
+            await self.make_turn(state_manager, dialog, 'hello')
+            await self.make_turn(state_manager, dialog, 'again')
+            return dialog, await state_manager.get_or_create_dialog('user', 'test')
+
+        dialog, cached_dialog = run(check())
+        self.assertEqual(4, len(dialog.utterances))
+        self.assertEqual(['again', 'reply to again'], [i.text for i in cached_dialog.utterances])
+
+    def test_reads_wait_for_queued_saves(self):
+        async def check():
+            state_manager = StateManager(self.storage, write_behind_queue_size=10)
+            dialog = await state_manager.get_or_create_dialog('user', 'test')
+            await self.make_turn(state_manager, dialog, 'hello')
+            by_user = await state_manager.get_dialogs_by_user_ext_id('user')
+            exported = [i async for i in state_manager.iter_dialogs()]
+            await state_manager.close()
+            return by_user, exported
+
+        by_user, exported = run(check())
+        self.assertEqual(1, len(by_user))
+        self.assertEqual(['hello', 'reply to hello'], [i.text for i in exported[0].utterances])
+
+    def test_flush_dialog_drops_it_from_cache(self):
+        async def check():
+            state_manager = StateManager(self.storage, dialog_cache=LRUDialogCache(10, 300),
+                                         write_behind_queue_size=10)
+            dialog = await state_manager.get_or_create_dialog('user', 'test')
+            await self.make_turn(state_manager, dialog, 'hello')
+            await state_manager.flush_dialog(dialog_id=dialog.dialog_id)
+            by_dialog_id = state_manager.get_cache_stats()['size']
+            saved = await Dialog.get_by_dialog_id(self.storage, dialog.dialog_id)
+
+            dialog = await state_manager.get_or_create_dialog('user', 'test')
+            await self.make_turn(state_manager, dialog, 'again')
+            await state_manager.flush_dialog(utt_id=dialog.bot_utterances[-1].utt_id)
+            by_utt_id = state_manager.get_cache_stats()['size']
+            await state_manager.close()
+            return by_dialog_id, saved, by_utt_id
+
+        by_dialog_id, saved, by_utt_id = run(check())
+        self.assertEqual((0, 0), (by_dialog_id, by_utt_id))
+        self.assertIsNotNone(saved)
+
+
+if __name__ == '__main__':
+    unittest.main()
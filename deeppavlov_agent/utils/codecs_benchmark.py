@@ -0,0 +1,54 @@
+import argparse
+import json
+from timeit import timeit
+
+from deeppavlov_agent.core.codecs import get_codec
+from deeppavlov_agent.core.state_schema import Bot, Dialog, Human
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-u', '--utterances', help='number of utterances in the dialog', type=int, default=40)
+parser.add_argument('-n', '--number', help='number of encode/decode rounds', type=int, default=1000)
+
+
+def make_payload(utterances_count):
+    dialog = Dialog(human=Human(external_id='user'), channel_type='benchmark')
+    dialog.bot = Bot()
+    for i in range(utterances_count // 2):
+        dialog.add_human_utterance()
+        dialog.utterances[-1].text = f'human utterance number {i} ' * 3
+        dialog.utterances[-1].annotations = {'ner': [[{'start_pos': 0, 'end_pos': 5, 'type': 'PER'}]],
+                                             'sentiment': {'positive': 0.7, 'negative': 0.3}}
+        dialog.utterances[-1].hypotheses = [{'skill_name': f'skill_{j}', 'text': f'hypothesis {j}',
+                                             'confidence': j / 10} for j in range(5)]
+        dialog.add_bot_utterance()
+        dialog.utterances[-1].text = f'bot utterance number {i} ' * 3
+        dialog.utterances[-1].annotations = {'toxic': False}
+    # payloads are json compatible, as they are produced by formatters
+    return json.loads(json.dumps(dialog.to_dict(), default=str))
+
+
+def main():
+    args = parser.parse_args()
+    payload = make_payload(args.utterances)
+    body = json.dumps(payload).encode('utf-8')
+    # previous path: json.dumps(...).encode and json.loads
+    encode_time = timeit(lambda: json.dumps(payload).encode('utf-8'), number=args.number)
+    decode_time = timeit(lambda: json.loads(body), number=args.number)
+    print(f'payload of {args.utterances} utterances')
+    print(f'stdlib json (current): encode {encode_time / args.number * 1e6:.0f} us, '
+          f'decode {decode_time / args.number * 1e6:.0f} us, size {len(body)} bytes')
+    for name in ['json', 'orjson', 'msgpack']:
+        try:
+            codec = get_codec(name)
+        except ValueError as e:
+            print(f'{name}: skipped, {e}')
+            continue
+        data = codec.encode(payload)
+        encode_time = timeit(lambda: codec.encode(payload), number=args.number)
+        decode_time = timeit(lambda: codec.decode(data), number=args.number)
+        print(f'{name} codec: encode {encode_time / args.number * 1e6:.0f} us, '
+              f'decode {decode_time / args.number * 1e6:.0f} us, size {len(data)} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import gc
+import tracemalloc
+from collections import defaultdict
+from time import time
+from uuid import uuid4
+
+from deeppavlov_agent.core.workflow_manager import WorkflowManager
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--dialogs', help='number of concurrent dialogs', type=int, default=5000)
+parser.add_argument('-s', '--services', help='number of services in the pipeline', type=int, default=20)
+parser.add_argument('-t', '--tasks', help='number of tasks per service', type=int, default=2)
+
+
+class Dialog:
+    def __init__(self):
+        self.id = uuid4().hex
+
+
+class Service:
+    def __init__(self, name):
+        self.name = name
+
+
+class DictWorkflowManager:
+    """Previous dict based workflow records layout, kept for comparison."""
+    def __init__(self):
+        self.tasks = defaultdict(dict)
+        self.workflow_records = defaultdict(dict)
+
+    def add_workflow_record(self, dialog, **kwargs):
+        workflow_record = {'dialog': dialog, 'services': defaultdict(dict), 'tasks': dict()}
+        workflow_record.update(kwargs)
+        self.workflow_records[str(dialog.id)] = workflow_record
+
+    def add_task(self, dialog_id, service, payload, ind):
+        workflow_record = self.workflow_records[dialog_id]
+        task_id = uuid4().hex
+        task_data = {'service': service, 'payload': payload, 'dialog': dialog_id, 'ind': ind}
+        if service.name not in workflow_record['services']:
+            workflow_record['services'][service.name] = {'pending_tasks': set(), 'done': False, 'skipped': False}
+        workflow_record['services'][service.name][task_id] = {
+            'send': True, 'done': False, 'error': False,
+            'agent_send_time': time(), 'agent_done_time': None
+        }
+        workflow_record['services'][service.name]['pending_tasks'].add(task_id)
+        workflow_record['tasks'][task_id] = {'task_data': task_data, 'task_object': None}
+        self.tasks[task_id] = task_data
+        return task_id
+
+    def complete_task(self, task_id, response):
+        task = self.tasks.pop(task_id)
+        workflow_record = self.workflow_records[task['dialog']]
+        workflow_record['tasks'].pop(task_id, None)
+        service_record = workflow_record['services'][task['service'].name]
+        service_record['pending_tasks'].discard(task_id)
+        if not service_record['pending_tasks']:
+            service_record['done'] = True
+        service_record[task_id]['agent_done_time'] = time()
+        service_record[task_id]['done'] = True
+        return workflow_record, task
+
+
+def measure(workflow_manager, dialogs, services, tasks_per_service):
+    gc.collect()
+    tracemalloc.start()
+    start_time = time()
+    for dialog in dialogs:
+        workflow_manager.add_workflow_record(dialog, user_external_id=dialog.id)
+        dialog_id = str(dialog.id)
+        # half of the services are completed, the rest are waiting for responses
+        for service_ind, service in enumerate(services):
+            task_ids = [workflow_manager.add_task(dialog_id, service, None, i) for i in range(tasks_per_service)]
+            if service_ind % 2 == 0:
+                for task_id in task_ids:
+                    workflow_manager.complete_task(task_id, 'response')
+    elapsed = time() - start_time
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak, elapsed
+
+
+def main():
+    args = parser.parse_args()
+    services = [Service(f'service_{i}') for i in range(args.services)]
+    for name, workflow_manager in [('dict', DictWorkflowManager()), ('slots', WorkflowManager())]:
+        dialogs = [Dialog() for _ in range(args.dialogs)]
+        current, peak, elapsed = measure(workflow_manager, dialogs, services, args.tasks)
+        print(f'{name}: current {current / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB, '
+              f'{current / args.dialogs / 1024:.2f} KiB per dialog, {elapsed:.2f} s')
+
+
+if __name__ == '__main__':
+    main()